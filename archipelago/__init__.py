@@ -1,2 +1,3 @@
-from .pnr_ import pnr
+from .pnr_ import pnr, pnr_async
+from .config import PnRConfig
 from .virtualize import pnr_virtualize
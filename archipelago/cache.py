@@ -0,0 +1,334 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import weakref
+
+from .watchdog import PnRToolError, classify, run_watched, run_watched_async
+
+# On-disk cache for the external placer and router. A run is keyed by the
+# contents of every file on its command line, the rest of the command line
+# and the PNR_* variables the binaries read, so the same inputs in a
+# different directory still hit. Turned on by pointing PNR_CACHE_DIR at a
+# directory, PNR_CACHE_SIZE_MB bounds it and the least recently used
+# entries are evicted first.
+#
+# Architecture dumps from interconnect.dump_pnr are cached separately under
+# PNR_ARCH_CACHE_DIR, keyed by an interconnect fingerprint and the column
+# count. The fingerprint covers every routing graph node and its
+# connections, so any wiring or register change gets its own entry. There
+# are only a few per fabric so they are never evicted.
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE_MB = 2048
+
+# Settings archipelago reads itself, they don't change what the binaries do
+ARCHIPELAGO_VARS = {
+    "PNR_CACHE_DIR",
+    "PNR_CACHE_SIZE_MB",
+    "PNR_SWEEP_JOBS",
+    "PNR_SWEEP_ROUTE_JOBS",
+    "PNR_SPECULATIVE_JOBS",
+    "PNR_COMPACT_JOBS",
+    "PNR_EXP_HISTORY",
+    "PNR_ARCH_CACHE_DIR",
+    "PNR_ARCH_KEY",
+    "PNR_PLACE_TIMEOUT",
+    "PNR_ROUTE_TIMEOUT",
+    "PNR_STALL_TIMEOUT",
+    "PNR_ROUTE_FAIL_PATTERN",
+    "PNR_ROUTE_MAX_FAILED",
+}
+
+# (path, inode, size, mtime, ctime) -> sha256, the routing graphs are large
+# and shared by every call
+_file_hashes = {}
+# Files changed more recently than this are hashed again every time, on a
+# filesystem with coarse timestamps they may be rewritten within one tick
+# without any of the stat fields changing
+RACY_NS = 2 * 10**9
+# interconnect -> fingerprint, taken once per interconnect object
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def hash_file(filename):
+    st = os.stat(filename)
+    key = (
+        os.path.abspath(filename),
+        st.st_ino,
+        st.st_size,
+        st.st_mtime_ns,
+        st.st_ctime_ns,
+    )
+    if key in _file_hashes:
+        return _file_hashes[key]
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) >= RACY_NS:
+        _file_hashes[key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def tool_env(env):
+    # The variables the placer and router read
+    return {
+        name: value
+        for name, value in env.items()
+        if name.startswith("PNR_") and name not in ARCHIPELAGO_VARS
+    }
+
+
+def cache_key(args, outputs, env):
+    outputs = [os.path.abspath(filename) for filename in outputs]
+    key_args = []
+    for arg in args:
+        arg = str(arg)
+        path = os.path.abspath(arg)
+        if path in outputs:
+            # Fixed placement is read from the file the placer writes to
+            entry = ["output", outputs.index(path)]
+            if os.path.isfile(arg):
+                entry.append(hash_file(arg))
+        elif os.path.isfile(arg):
+            entry = ["file", hash_file(arg)]
+        else:
+            entry = ["arg", arg]
+        key_args.append(entry)
+    data = json.dumps([CACHE_VERSION, key_args, sorted(tool_env(env).items())])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def restore_entry(entry, outputs):
+    # Returncode of the cached run, or None if the entry is gone
+    try:
+        with open(os.path.join(entry, "result.json")) as f:
+            result = json.load(f)
+        for idx, present in enumerate(result["outputs"]):
+            if present:
+                shutil.copyfile(os.path.join(entry, str(idx)), outputs[idx])
+        os.utime(os.path.join(entry, "result.json"))
+    except (OSError, ValueError):
+        return None
+    return result["returncode"]
+
+
+def store_entry(cache_dir, entry, outputs, returncode):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp")
+    present = []
+    for idx, filename in enumerate(outputs):
+        present.append(returncode == 0 and os.path.isfile(filename))
+        if present[-1]:
+            shutil.copyfile(filename, os.path.join(tmp_dir, str(idx)))
+    with open(os.path.join(tmp_dir, "result.json"), "w") as f:
+        json.dump({"returncode": returncode, "outputs": present}, f)
+    try:
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # Stored by a concurrent run in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    # Drop least recently used entries until the cache fits, except keep
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(
+                os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+            )
+            last_used = os.path.getmtime(os.path.join(entry, "result.json"))
+        except OSError:
+            continue
+        entries.append((last_used, size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+
+def lookup(args, outputs, env):
+    # (entry, returncode) of a cached run. entry is None when caching is
+    # off, returncode is None when the command still has to be run.
+    cache_dir = env.get("PNR_CACHE_DIR")
+    if not cache_dir:
+        return None, None
+    entry = os.path.join(cache_dir, cache_key(args, outputs, env))
+    return entry, restore_entry(entry, outputs)
+
+
+def store(entry, outputs, returncode, env):
+    if entry is None or returncode < 0:
+        return
+    cache_dir = os.path.dirname(entry)
+    store_entry(cache_dir, entry, outputs, returncode)
+    size_mb = env.get("PNR_CACHE_SIZE_MB", "")
+    size_mb = int(size_mb) if size_mb.isnumeric() else DEFAULT_CACHE_SIZE_MB
+    evict(cache_dir, size_mb * 1024 * 1024, keep=os.path.basename(entry))
+
+
+def cached_check_call(args, outputs, env=None, watchdog=None, failure="crash"):
+    """subprocess.check_call(args, env=env) for a command that writes the
+    files in outputs, None entries are ignored. With PNR_CACHE_DIR set the
+    outputs are restored from the cache when the same command has been run
+    on the same inputs before. Failures are cached as well, except when
+    the binary was killed by a signal.
+
+    The run is killed when watchdog says so. Failures raise PnRToolError,
+    a non-zero exit is classified as failure."""
+    if env is None:
+        env = os.environ
+    outputs = [filename for filename in outputs if filename is not None]
+    entry, returncode = lookup(args, outputs, env)
+    kind = None
+    if returncode is None:
+        if watchdog is None:
+            returncode = subprocess.call(args, env=env)
+        else:
+            returncode, kind = run_watched(args, env, watchdog)
+        store(entry, outputs, returncode, env)
+    kind = kind or classify(returncode, failure)
+    if kind is not None:
+        raise PnRToolError(kind, returncode, args)
+
+
+async def cached_exec(args, outputs, env=None, watchdog=None, failure="crash"):
+    """cached_check_call() on an asyncio event loop. The process is also
+    killed when the awaiting task is cancelled, which isn't cached."""
+    if env is None:
+        env = os.environ
+    outputs = [filename for filename in outputs if filename is not None]
+    entry, returncode = lookup(args, outputs, env)
+    kind = None
+    if returncode is None:
+        if watchdog is None:
+            proc = await asyncio.create_subprocess_exec(*args, env=env)
+            try:
+                returncode = await proc.wait()
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+        else:
+            returncode, kind = await run_watched_async(args, env, watchdog)
+        store(entry, outputs, returncode, env)
+    kind = kind or classify(returncode, failure)
+    if kind is not None:
+        raise PnRToolError(kind, returncode, args)
+
+
+def graph_fingerprint(graph, h):
+    # Every node reachable from the switch boxes, with its fan-in and
+    # fan-out, so ports, registers and register muxes are covered too
+    nodes = {}
+    pending = []
+    for x, y in graph:
+        pending += graph[x, y].switchbox.get_all_sbs()
+    while pending:
+        node = pending.pop()
+        name = str(node)
+        if name in nodes:
+            continue
+        nodes[name] = node
+        pending += list(node) + list(node.get_conn_in())
+    for name in sorted(nodes):
+        fan_out = sorted(str(n) for n in nodes[name])
+        fan_in = sorted(str(n) for n in nodes[name].get_conn_in())
+        h.update(repr((name, fan_out, fan_in)).encode())
+
+
+def interconnect_fingerprint(interconnect):
+    # Grid size, bit widths, the core and pnr tags of every tile and the
+    # connectivity of every routing graph
+    if interconnect in _fingerprints:
+        return _fingerprints[interconnect]
+    h = hashlib.sha256()
+    h.update(
+        repr(
+            (interconnect.x_max, interconnect.y_max, interconnect.get_bit_widths())
+        ).encode()
+    )
+    for (x, y), tile_circuit in sorted(interconnect.tile_circuits.items()):
+        tags = tile_circuit.core.pnr_info()
+        if not isinstance(tags, list):
+            tags = [tags]
+        h.update(
+            repr(
+                (
+                    x,
+                    y,
+                    type(tile_circuit.core).__name__,
+                    [(t.tag_name, t.priority_major, t.priority_minor) for t in tags],
+                )
+            ).encode()
+        )
+    for bit_width in sorted(interconnect.get_bit_widths()):
+        h.update(repr(bit_width).encode())
+        graph_fingerprint(interconnect.get_graph(bit_width), h)
+    _fingerprints[interconnect] = h.hexdigest()
+    return _fingerprints[interconnect]
+
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.symlink(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def cached_dump_pnr(interconnect, dir_name, max_num_col=None, env=None):
+    """interconnect.dump_pnr(dir_name, "design", max_num_col=max_num_col).
+    With PNR_ARCH_CACHE_DIR set the files are dumped once per fingerprint
+    and column count, and linked into dir_name with design.info pointing
+    at the links."""
+    if env is None:
+        env = os.environ
+    cache_dir = env.get("PNR_ARCH_CACHE_DIR")
+    if not cache_dir:
+        interconnect.dump_pnr(dir_name, "design", max_num_col=max_num_col)
+        return
+
+    cache_dir = os.path.abspath(cache_dir)
+    fingerprint = env.get("PNR_ARCH_KEY") or interconnect_fingerprint(interconnect)
+    entry = os.path.join(cache_dir, f"{fingerprint}_{max_num_col}")
+    if not os.path.isfile(os.path.join(entry, "design.info")):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp")
+        interconnect.dump_pnr(tmp_dir, "design", max_num_col=max_num_col)
+        # design.info has absolute paths, point them at the final entry
+        info_filename = os.path.join(tmp_dir, "design.info")
+        with open(info_filename) as f:
+            info = f.read()
+        with open(info_filename, "w") as f:
+            f.write(info.replace(tmp_dir, entry))
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # Dumped by a concurrent run in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    dir_name = os.path.abspath(dir_name)
+    os.makedirs(dir_name, exist_ok=True)
+    for filename in os.listdir(entry):
+        if filename != "design.info":
+            link_or_copy(os.path.join(entry, filename), os.path.join(dir_name, filename))
+    with open(os.path.join(entry, "design.info")) as f:
+        info = f.read()
+    with open(os.path.join(dir_name, "design.info"), "w") as f:
+        f.write(info.replace(entry, dir_name))
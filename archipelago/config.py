@@ -0,0 +1,173 @@
+import os
+
+# Settings that change pipelining and STA results
+PIPELINE_VARS = (
+    "PIPELINED",
+    "IO_DELAY",
+    "POST_PNR_ITR",
+    "PIPELINE_TARGET_FREQ",
+    "EXHAUSTIVE_PIPE",
+    "EXHAUSTIVE_PIPE_MAX_REGS",
+    "EXHAUSTIVE_PIPE_MAX_LATENCY",
+    "PIPELINE_WHAT_IF",
+    "PIPELINE_RETIME",
+    "BRANCH_DELAY_ENGINE",
+    "IO2MEM_REG_CHAIN",
+    "MEM2PE_REG_CHAIN",
+)
+
+
+class PnRConfig:
+    """Settings for one pnr() call.
+
+    Every setting is read from a snapshot of the environment variables
+    archipelago has always used, taken when the config is made. Calls that
+    each hold their own config can run concurrently in one process, and
+    subprocesses get the settings through subprocess_env() instead of
+    os.environ."""
+
+    def __init__(self, env=None, **overrides):
+        self.env = dict(os.environ if env is None else env)
+        for name, value in overrides.items():
+            if value is None:
+                self.env.pop(name, None)
+            else:
+                self.env[name] = str(value)
+
+    @classmethod
+    def from_env(cls, **overrides):
+        return cls(None, **overrides)
+
+    def replace(self, **overrides):
+        # New config with some variables changed, None removes a variable
+        return PnRConfig(self.env, **overrides)
+
+    def subprocess_env(self):
+        return dict(self.env)
+
+    def get(self, name, default=None):
+        return self.env.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.env
+
+    def get_int(self, name, default=None):
+        value = self.env.get(name, "")
+        return int(value) if value.isnumeric() else default
+
+    def get_float(self, name, default=None):
+        try:
+            return float(self.env[name])
+        except (KeyError, ValueError):
+            return default
+
+    def pipeline_settings(self):
+        return {name: self.env[name] for name in PIPELINE_VARS if name in self.env}
+
+    @property
+    def pe_latency(self):
+        return self.get_int("PIPELINED", 1)
+
+    @property
+    def io_latency(self):
+        return 0 if self.env.get("IO_DELAY") == "0" else 1
+
+    @property
+    def placer_exp(self):
+        return self.get_int("PNR_PLACER_EXP")
+
+    @property
+    def sweep_placer_exp(self):
+        return "SWEEP_PNR_PLACER_EXP" in self.env
+
+    @property
+    def sweep_jobs(self):
+        return self.get_int("PNR_SWEEP_JOBS")
+
+    @property
+    def sweep_route_jobs(self):
+        return self.get_int("PNR_SWEEP_ROUTE_JOBS")
+
+    @property
+    def speculative_jobs(self):
+        return self.get_int("PNR_SPECULATIVE_JOBS", 0)
+
+    @property
+    def compact_jobs(self):
+        return self.get_int("PNR_COMPACT_JOBS")
+
+    @property
+    def place_timeout(self):
+        return self.get_float("PNR_PLACE_TIMEOUT")
+
+    @property
+    def route_timeout(self):
+        return self.get_float("PNR_ROUTE_TIMEOUT")
+
+    @property
+    def stall_timeout(self):
+        return self.get_float("PNR_STALL_TIMEOUT")
+
+    @property
+    def route_fail_pattern(self):
+        return self.env.get("PNR_ROUTE_FAIL_PATTERN")
+
+    @property
+    def route_max_failed(self):
+        return self.get_int("PNR_ROUTE_MAX_FAILED")
+
+    @property
+    def exp_history_file(self):
+        # Empty PNR_EXP_HISTORY turns the history off
+        return self.env.get(
+            "PNR_EXP_HISTORY",
+            os.path.join(
+                os.path.expanduser("~"),
+                ".cache",
+                "archipelago",
+                "pnr_exp_history.json",
+            ),
+        )
+
+    @property
+    def post_pnr_itr(self):
+        return self.env.get("POST_PNR_ITR")
+
+    @property
+    def target_freq(self):
+        if "PIPELINE_TARGET_FREQ" not in self.env:
+            return None
+        return float(self.env["PIPELINE_TARGET_FREQ"])
+
+    @property
+    def exhaustive_pipe(self):
+        return self.env.get("EXHAUSTIVE_PIPE", "0") not in ("", "0")
+
+    @property
+    def exhaustive_max_regs(self):
+        return self.get_int("EXHAUSTIVE_PIPE_MAX_REGS")
+
+    @property
+    def exhaustive_max_latency(self):
+        return self.get_int("EXHAUSTIVE_PIPE_MAX_LATENCY")
+
+    @property
+    def what_if(self):
+        return self.get_int("PIPELINE_WHAT_IF", 1)
+
+    @property
+    def what_if_jobs(self):
+        return self.get_int("PIPELINE_WHAT_IF_JOBS")
+
+    @property
+    def retime(self):
+        return self.env.get("PIPELINE_RETIME", "0") != "0"
+
+    @property
+    def branch_delay_engine(self):
+        return self.env.get("BRANCH_DELAY_ENGINE")
+
+    @property
+    def reg_chain(self):
+        # Register chains are matched by the caller, leave branches alone
+        return "IO2MEM_REG_CHAIN" in self.env or "MEM2PE_REG_CHAIN" in self.env
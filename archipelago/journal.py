@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from .cache import hash_file, tool_env
+
+# Append-only log of the finished trials of a long pnr search, the placer
+# exp sweep or the compact column search. Every trial is flushed to disk as
+# it finishes, so a search that got preempted can skip the trials it already
+# ran when it's started again. The first line holds a key of the search
+# inputs, a journal written for other inputs is started over.
+
+
+def journal_key(files, config, *values):
+    # Contents of files, the settings in config that change place, route or
+    # pipelining results, and any other values that do
+    h = hashlib.sha256()
+    for filename in files:
+        h.update(hash_file(filename).encode())
+    settings = dict(tool_env(config.env), **config.pipeline_settings())
+    h.update(repr((sorted(settings.items()), values)).encode())
+    return h.hexdigest()
+
+
+class Journal:
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+        self.lock = threading.Lock()
+        entries = self.__load() if os.path.isfile(filename) else None
+        self.resumed = entries is not None
+        self.entries = entries if entries is not None else {}
+        # Rewrite it whole, an interrupted run may have cut the last line short
+        lines = [{"key": key}] + list(self.entries.values())
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or ".", suffix=".tmp"
+        )
+        with os.fdopen(fd, "w") as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+        os.replace(tmp_filename, filename)
+
+    def __load(self):
+        with open(self.filename) as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if header.get("key") != self.key:
+            return None
+        entries = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry["trial"]] = entry
+        return entries
+
+    def get(self, trial):
+        return self.entries.get(trial)
+
+    def record(self, trial, **data):
+        entry = dict(trial=trial, **data)
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[trial] = entry
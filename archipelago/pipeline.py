@@ -1,7 +1,12 @@
+import bisect
 import copy
+import functools
 import os
 import glob
 import json
+import multiprocessing
+import shutil
+import tempfile
 from archipelago.pnr_graph import (
     KernelNodeType,
     construct_graph,
@@ -10,8 +15,12 @@ from archipelago.pnr_graph import (
     RouteType,
     TileNode,
     RouteNode,
+    RouteIndex,
+    UndoJournal,
+    JournaledDict,
 )
-from archipelago.sta import sta
+from archipelago.sta import sta, compute_timing, TimingState
+from archipelago.config import PnRConfig
 import pythunder
 
 
@@ -34,45 +43,15 @@ class bcolors:
 
 
 def find_break_idx(graph, crit_path):
-    crit_path_adjusted = [abs(c - crit_path[-1][1] / 2) for n, c in crit_path]
-    break_idx = crit_path_adjusted.index(min(crit_path_adjusted))
-
     if len(crit_path) < 2:
         raise ValueError("Can't find available register on critical path")
 
     if graph.sparse and len(crit_path) < 5:
         raise ValueError("Can't find available FIFO on critical path")
 
-    min_path = crit_path[-1][1]
-    min_idx = -1
-
-    if graph.sparse:
-        for idx, node in enumerate(crit_path[:-4]):
-            if (
-                isinstance(crit_path[idx][0], RouteNode)
-                and crit_path[idx][0].route_type == RouteType.SB
-                and crit_path[idx + 1][0].route_type == RouteType.RMUX
-                and isinstance(crit_path[idx + 2][0], RouteNode)
-                and crit_path[idx + 2][0].route_type == RouteType.SB
-                and isinstance(crit_path[idx + 3][0], RouteNode)
-                and crit_path[idx + 3][0].route_type == RouteType.SB
-                and isinstance(crit_path[idx + 4][0], RouteNode)
-                and crit_path[idx + 4][0].route_type == RouteType.RMUX
-            ):
-                if crit_path_adjusted[idx] < min_path:
-                    min_path = crit_path_adjusted[idx]
-                    min_idx = idx
-    else:
-        for idx, node in enumerate(crit_path[:-1]):
-            if (
-                isinstance(crit_path[idx][0], RouteNode)
-                and crit_path[idx][0].route_type == RouteType.SB
-                and isinstance(crit_path[idx + 1][0], RouteNode)
-                and crit_path[idx + 1][0].route_type == RouteType.RMUX
-            ):
-                if crit_path_adjusted[idx] < min_path:
-                    min_path = crit_path_adjusted[idx]
-                    min_idx = idx
+    min_idx = graph.get_register_sites().nearest_free_site(
+        [n for n, c in crit_path], [c for n, c in crit_path]
+    )
 
     if min_idx == -1:
         raise ValueError("Can't find available register on critical path")
@@ -80,124 +59,145 @@ def find_break_idx(graph, crit_path):
     return min_idx
 
 
-def reg_into_route(routes, g_break_node_source, new_reg_route_source):
-    for net_id, net in routes.items():
-        for route in net:
-            for idx, segment in enumerate(route):
-                if g_break_node_source.to_route() == segment:
-                    route.insert(idx + 1, new_reg_route_source.to_route())
-                    return
+def reg_into_route(
+    routes, g_break_node_source, new_reg_route_source, route_index=None
+):
+    if route_index is None or route_index.routes is not routes:
+        route_index = RouteIndex(routes)
+    if route_index.insert_after(
+        g_break_node_source.to_route(), new_reg_route_source.to_route()
+    ):
+        return
     assert (
         False
     ), f"Couldn't find segment {g_break_node_source.to_route()} in routing file"
 
 
-def break_crit_path(graph, id_to_name, crit_path, placement, routes):
-    break_idx = find_break_idx(graph, crit_path)
-
-    break_node_source = crit_path[break_idx][0]
-    break_node_dest = graph.sinks[break_node_source][0]
-
-    assert isinstance(break_node_source, RouteNode)
-    assert break_node_source.route_type == RouteType.SB
-    assert isinstance(break_node_dest, RouteNode)
-    assert break_node_dest.route_type == RouteType.RMUX
-
-    x = break_node_source.x
-    y = break_node_source.y
-    track = break_node_source.track
-    bw = break_node_source.bit_width
-    net_id = break_node_source.net_id
-    kernel = break_node_source.kernel
-    side = break_node_source.side
-    verboseprint("\nBreaking net:", net_id, "Kernel:", kernel)
+# Graph, timing and critical path a what-if worker evaluates against. Only
+# set inside forked workers, which inherit it through the pool initializer
+# without pickling.
+_what_if_state = None
 
-    dir_map = {0: "EAST", 1: "SOUTH", 2: "WEST", 3: "NORTH"}
 
-    new_segment = ["REG", f"T{track}_{dir_map[side]}", track, x, y, bw]
-    new_reg_route_source = graph.segment_to_node(new_segment, net_id, kernel)
-    new_reg_route_source.reg = True
-    new_reg_route_source.update_tile_id()
-    new_reg_route_dest = graph.segment_to_node(new_segment, net_id, kernel)
-    new_reg_tile = TileNode(x, y, tile_id=f"r{graph.added_regs}", kernel=kernel)
+def init_what_if_worker(state):
+    global _what_if_state
+    _what_if_state = state
 
-    new_reg_tile.input_port_latencies["reg"] = 1
-    new_reg_tile.input_port_break_path["reg"] = True
 
-    graph.added_regs += 1
+def evaluate_break_in_worker(break_idx):
+    return evaluate_break(_what_if_state, break_idx)
 
-    graph.edges.remove((break_node_source, break_node_dest))
-    graph.add_node(new_reg_route_source)
-    graph.add_node(new_reg_tile)
-    graph.add_node(new_reg_route_dest)
 
-    graph.add_edge(break_node_source, new_reg_route_source)
-    graph.add_edge(new_reg_route_source, new_reg_tile)
-    graph.add_edge(new_reg_tile, new_reg_route_dest)
-    graph.add_edge(new_reg_route_dest, break_node_dest)
+def evaluate_break(state, break_idx):
+    # Time the graph with a register at crit_path[break_idx], then take it
+    # back out so the next candidate starts from the same graph
+    graph, timing, crit_path = state
+    added_regs = graph.added_regs
+    paired_edge = None
+    if graph.sparse:
+        paired_node_source = crit_path[break_idx + 3][0]
+        paired_edge = (paired_node_source, graph.sinks[paired_node_source][0])
+    break_node_source = crit_path[break_idx][0]
+    regs = graph.insert_register(
+        (break_node_source, graph.sinks[break_node_source][0]),
+        paired_edge=paired_edge,
+    )
+    _, new_crit_path, _ = timing.sta(verbose=False)
+    for reg in reversed(regs):
+        graph.remove_register(reg)
+    graph.added_regs = added_regs
+    timing.update()
+    return new_crit_path[-1][1]
 
-    reg_into_route(routes, break_node_source, new_reg_route_source)
-    placement[new_reg_tile.tile_id] = (new_reg_tile.x, new_reg_tile.y)
-    id_to_name[new_reg_tile.tile_id] = f"pnr_pipelining_{graph.added_regs}@T{track}_{dir_map[side]}"
 
-    graph.update_sources_and_sinks()
-    graph.update_edge_kernels()
+def what_if_break_idx(
+    graph, crit_path, west_in_io_sides, count, jobs=None, timing=None
+):
+    """Try a register at each of the count free sites closest to the middle
+    of the critical path and return the one giving the highest frequency.
+    Candidates are timed in forked worker processes when jobs allows, and
+    serially when already running in a pool worker. timing
+    is an up to date TimingState to start from, built here if not given."""
+    if len(crit_path) < 2:
+        raise ValueError("Can't find available register on critical path")
+    candidates = graph.get_register_sites().ranked_free_sites(
+        [n for n, c in crit_path], [c for n, c in crit_path], count
+    )
+    if len(candidates) == 0:
+        raise ValueError("Can't find available register on critical path")
+    if len(candidates) == 1:
+        return candidates[0]
 
-    if graph.sparse:
-        break_idx += 3
-        break_node_source = crit_path[break_idx][0]
-        break_node_dest = graph.sinks[break_node_source][0]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(candidates))
 
-        assert isinstance(break_node_source, RouteNode)
-        assert break_node_source.route_type == RouteType.SB
-        assert isinstance(break_node_dest, RouteNode)
-        assert break_node_dest.route_type == RouteType.RMUX
+    if timing is None:
+        timing = TimingState(graph, west_in_io_sides)
+    else:
+        timing.update()
+    state = (graph, timing, crit_path)
+    # Daemonic pool workers, e.g. a sweep trial, can't have children
+    if (
+        jobs > 1
+        and not multiprocessing.current_process().daemon
+        and "fork" in multiprocessing.get_all_start_methods()
+    ):
+        with multiprocessing.get_context("fork").Pool(
+            jobs, initializer=init_what_if_worker, initargs=(state,)
+        ) as pool:
+            delays = pool.map(evaluate_break_in_worker, candidates)
+    else:
+        delays = [evaluate_break(state, idx) for idx in candidates]
 
-        x = break_node_source.x
-        y = break_node_source.y
-        track = break_node_source.track
-        bw = break_node_source.bit_width
-        net_id = break_node_source.net_id
-        kernel = break_node_source.kernel
-        side = break_node_source.side
-        verboseprint("\nBreaking net:", net_id, "Kernel:", kernel)
+    # Ties go to the site closest to the middle, same as find_break_idx
+    best = min(range(len(candidates)), key=lambda i: delays[i])
+    verboseprint(
+        "\tWhat-if critical path delays:", dict(zip(candidates, delays))
+    )
+    return candidates[best]
 
-        dir_map = {0: "EAST", 1: "SOUTH", 2: "WEST", 3: "NORTH"}
 
-        new_segment = ["REG", f"T{track}_{dir_map[side]}", track, x, y, bw]
-        new_reg_route_source = graph.segment_to_node(new_segment, net_id, kernel)
-        new_reg_route_source.reg = True
-        new_reg_route_source.update_tile_id()
-        new_reg_route_dest = graph.segment_to_node(new_segment, net_id, kernel)
-        new_reg_tile = TileNode(x, y, tile_id=f"r{graph.added_regs}", kernel=kernel)
+def choose_break_idx(
+    graph, crit_path, west_in_io_sides, what_if=1, jobs=None, timing=None
+):
+    if what_if > 1:
+        return what_if_break_idx(
+            graph, crit_path, west_in_io_sides, what_if, jobs, timing
+        )
+    return find_break_idx(graph, crit_path)
 
-        new_reg_tile.input_port_latencies["reg"] = 1
-        new_reg_tile.input_port_break_path["reg"] = True
 
-        graph.added_regs += 1
+def break_crit_path(graph, id_to_name, crit_path, placement, routes, break_idx=None):
+    if break_idx is None:
+        break_idx = find_break_idx(graph, crit_path)
 
-        graph.edges.remove((break_node_source, break_node_dest))
-        graph.add_node(new_reg_route_source)
-        graph.add_node(new_reg_tile)
-        graph.add_node(new_reg_route_dest)
+    break_node_source = crit_path[break_idx][0]
+    break_node_dest = graph.sinks[break_node_source][0]
+    verboseprint(
+        "\nBreaking net:", break_node_source.net_id, "Kernel:", break_node_source.kernel
+    )
 
-        graph.add_edge(break_node_source, new_reg_route_source)
-        graph.add_edge(new_reg_route_source, new_reg_tile)
-        graph.add_edge(new_reg_tile, new_reg_route_dest)
-        graph.add_edge(new_reg_route_dest, break_node_dest)
+    paired_edge = None
+    if graph.sparse:
+        paired_node_source = crit_path[break_idx + 3][0]
+        paired_edge = (paired_node_source, graph.sinks[paired_node_source][0])
 
-        reg_into_route(routes, break_node_source, new_reg_route_source)
-        placement[new_reg_tile.tile_id] = (new_reg_tile.x, new_reg_tile.y)
-        id_to_name[new_reg_tile.tile_id] = f"pnr_pipelining_{graph.added_regs}@T{track}_{dir_map[side]}"
+    graph.insert_register(
+        (break_node_source, break_node_dest), paired_edge=paired_edge
+    )
 
-        graph.update_sources_and_sinks()
-        graph.update_edge_kernels()
 
+def break_at(graph, node1, id_to_name, placement, routing, cycles=1):
+    # Add cycles registers on the wire around node1 in one edit, or absorb
+    # them into a pond found upstream
+    if cycles <= 0:
+        return
 
-def break_at(graph, node1, id_to_name, placement, routing):
     path = []
     curr_node = node1
     kernel = curr_node.kernel
+    ponds = set(graph.get_ponds())
 
     while len(graph.sinks[curr_node]) == 1:
         if (
@@ -207,96 +207,593 @@ def break_at(graph, node1, id_to_name, placement, routing):
             break
         curr_node = graph.sinks[curr_node][0]
 
-    idx = 0
     while len(graph.sources[curr_node]) == 1:
         if (
             len(graph.sinks[curr_node]) > 1
             or graph.sources[curr_node][0].kernel != kernel
         ):
             break
-        path.append((curr_node, idx))
+        path.append(curr_node)
         curr_node = graph.sources[curr_node][0]
-        if curr_node in graph.get_ponds():
+        if curr_node in ponds:
             break
 
-    if curr_node in graph.get_ponds():
+    if curr_node in ponds:
         verboseprint("\t\tFound pond for branch delay matching", curr_node)
-        curr_node.input_port_latencies["data_in_pond"] += 1
+        curr_node.input_port_latencies["data_in_pond"] += cycles
+        graph.change_log.append(curr_node)
         return
 
     if len(path) == 0:
         raise ValueError(f"Cant break at node: {node1}")
     path.reverse()
-    ret = []
-    for p in path:
-        ret.append((p[0], idx))
-        idx += 1
-    break_crit_path(graph, id_to_name, ret, placement, routing)
 
+    if graph.sparse and len(path) < 5:
+        raise ValueError("Can't find available FIFO on critical path")
+
+    break_idxs = graph.get_register_sites().spread_free_sites(path, cycles)
+    if len(break_idxs) < cycles:
+        raise ValueError(
+            f"Can't find {cycles} available registers at node: {node1},"
+            f" only {len(break_idxs)} are free"
+        )
 
-def exhaustive_pipe(graph, id_to_name, placement, routing):
+    sites = []
+    for idx in break_idxs:
+        paired_edge = None
+        if graph.sparse:
+            paired_edge = (path[idx + 3], path[idx + 4])
+        sites.append(((path[idx], path[idx + 1]), paired_edge))
+    graph.insert_registers(sites)
+
+
+def find_exhaustive_sites(graph):
+    # Walk every single-fanout chain once and collect the SB -> RMUX sites
+    # (SB/RMUX/SB/SB/RMUX windows in sparse mode) as (edge, paired_edge)
+    register_sites = graph.get_register_sites()
+    sites = []
+    seen = set()
     for node in graph.nodes:
-        if node in graph.get_tiles() or len(graph.sinks[node]) > 1:
+        if not (isinstance(node, TileNode) or len(graph.sinks[node]) > 1):
+            continue
+        for sink in graph.sinks[node]:
+            path = []
+            curr_node = sink
+            while True:
+                path.append(curr_node)
+                if len(graph.sinks[curr_node]) != 1:
+                    break
+                curr_node = graph.sinks[curr_node][0]
+
+            for idx in register_sites.free_sites(path):
+                if path[idx] in seen:
+                    continue
+                if graph.sparse:
+                    if path[idx + 3] in seen:
+                        continue
+                    seen.add(path[idx])
+                    seen.add(path[idx + 3])
+                    sites.append(
+                        ((path[idx], path[idx + 1]), (path[idx + 3], path[idx + 4]))
+                    )
+                else:
+                    seen.add(path[idx])
+                    sites.append(((path[idx], path[idx + 1]), None))
+    return sites
+
+
+def rank_register_sites(graph, sites, timing_info):
+    # A register at arrival time a on a path of delay d leaves max(a, d - a)
+    # behind, so min(a, d - a) is how much it shortens that path
+    downstream_max = {}
+    for node in reversed(graph.topological_sort()):
+        if isinstance(node, RouteNode):
+            downstream_max[node] = max(
+                [timing_info[node].get_total()]
+                + [downstream_max[s] for s in graph.sinks[node] if s in downstream_max]
+            )
+
+    def benefit(site):
+        node = site[0][0]
+        arrival = timing_info[node].get_total()
+        return min(arrival, downstream_max[node] - arrival)
+
+    return sorted(sites, key=benefit, reverse=True)
+
+
+def get_route_leaves(graph):
+    # Last route node before each tile input, reachable from every route node
+    leaves = {}
+    for node in reversed(graph.topological_sort()):
+        if isinstance(node, RouteNode):
+            node_leaves = set()
             for sink in graph.sinks[node]:
-                path = []
-                curr_node = sink
-                while True:
-                    path.append((curr_node, len(path)))
-                    if len(graph.sinks[curr_node]) != 1:
-                        break
-                    curr_node = graph.sinks[curr_node][0]
-
-                for idx in range(len(path)):
-                    if graph.sparse:
-                        if idx + 4 >= len(path):
-                            break
-                        if (
-                            isinstance(path[idx][0], RouteNode)
-                            and path[idx][0].route_type == RouteType.SB
-                            and path[idx + 1][0].route_type == RouteType.RMUX
-                            and isinstance(path[idx + 2][0], RouteNode)
-                            and path[idx + 2][0].route_type == RouteType.SB
-                            and isinstance(path[idx + 3][0], RouteNode)
-                            and path[idx + 3][0].route_type == RouteType.SB
-                            and isinstance(path[idx + 4][0], RouteNode)
-                            and path[idx + 4][0].route_type == RouteType.RMUX
-                        ):
-                            try:
-                                break_crit_path(
-                                    graph,
-                                    id_to_name,
-                                    path[idx : idx + 5],
-                                    placement,
-                                    routing,
-                                )
-                            except:
-                                verboseprint("Skip")
-                    else:
-                        if idx + 1 >= len(path):
-                            break
-                        if (
-                            isinstance(path[idx][0], RouteNode)
-                            and path[idx][0].route_type == RouteType.SB
-                            and isinstance(path[idx + 1][0], RouteNode)
-                            and path[idx + 1][0].route_type == RouteType.RMUX
-                        ):
-                            try:
-                                break_crit_path(
-                                    graph,
-                                    id_to_name,
-                                    path[idx : idx + 2],
-                                    placement,
-                                    routing,
-                                )
-                            except:
-                                verboseprint("Skip")
+                if sink in leaves:
+                    node_leaves |= leaves[sink]
+                else:
+                    node_leaves.add(node)
+            leaves[node] = node_leaves
+    return leaves
+
+
+def plan_exhaustive_pipe(graph, timing_info=None, max_regs=None, max_latency=None):
+    sites = find_exhaustive_sites(graph)
+    if timing_info is not None:
+        sites = rank_register_sites(graph, sites, timing_info)
+    if max_regs is None and max_latency is None:
+        return sites
+
+    regs_per_site = 2 if graph.sparse else 1
+    leaves = get_route_leaves(graph) if max_latency is not None else None
+    leaf_latency = {}
+    planned = []
+    for site in sites:
+        if max_regs is not None and (len(planned) + 1) * regs_per_site > max_regs:
+            break
+        if max_latency is not None:
+            site_leaves = leaves[site[0][0]]
+            if any(
+                leaf_latency.get(leaf, 0) + regs_per_site > max_latency
+                for leaf in site_leaves
+            ):
+                continue
+            for leaf in site_leaves:
+                leaf_latency[leaf] = leaf_latency.get(leaf, 0) + regs_per_site
+        planned.append(site)
+    return planned
+
+
+def exhaustive_pipe(
+    graph,
+    id_to_name,
+    placement,
+    routing,
+    max_regs=None,
+    max_latency=None,
+    west_in_io_sides=False,
+):
+    timing_info = None
+    if max_regs is not None or max_latency is not None:
+        # Only need timing to decide which sites fit in the budget
+        timing_info = compute_timing(graph, west_in_io_sides)
+    sites = plan_exhaustive_pipe(graph, timing_info, max_regs, max_latency)
+    graph.insert_registers(sites)
+
+
+def get_pipeline_depth(graph):
+    # Longest input to output path in cycles, ignoring the flush network
+    depth = {}
+    for node in graph.topological_sort():
+        cycles = [0]
+        for parent in graph.sources[node]:
+            if "reset" in parent.kernel:
+                continue
+            c = depth.get(parent, 0)
+            if isinstance(node, TileNode):
+                c += node.input_port_latencies.get(parent.port, 0)
+            cycles.append(c)
+        depth[node] = max(cycles)
+    return max(depth.values(), default=0)
+
+
+def pipeline_to_target(
+    graph,
+    id_to_name,
+    placement,
+    routing,
+    target_freq,
+    west_in_io_sides,
+    rebalance=None,
+    what_if=1,
+    what_if_jobs=None,
+):
+    # Break the critical path until STA meets the target, timing each step
+    # incrementally instead of rerunning full STA
+    starting_regs = graph.added_regs
+    starting_depth = get_pipeline_depth(graph)
+    timing = TimingState(graph, west_in_io_sides)
+    curr_freq, crit_path, crit_nets = timing.sta(verbose=False)
+
+    itr = 0
+    while curr_freq < target_freq:
+        try:
+            break_idx = choose_break_idx(
+                graph, crit_path, west_in_io_sides, what_if, what_if_jobs, timing
+            )
+            break_crit_path(
+                graph, id_to_name, crit_path, placement, routing, break_idx
+            )
+        except ValueError:
+            print(
+                bcolors.WARNING
+                + f"\nCouldn't reach {target_freq} MHz, stopped at {curr_freq} MHz"
+                + bcolors.ENDC
+            )
+            break
+        if rebalance is not None:
+            rebalance()
+        curr_freq, crit_path, crit_nets = timing.sta(verbose=False)
+        itr += 1
+
+    print(
+        f"\nBroke {itr} critical paths to reach {curr_freq} MHz:",
+        graph.added_regs - starting_regs,
+        "registers,",
+        get_pipeline_depth(graph) - starting_depth,
+        "cycles of latency",
+    )
+    return curr_freq
+
+
+def find_violating_paths(graph, timing_info, period):
+    # One path per endpoint that misses the period, traced back through the
+    # STA parents to where it was last broken
+    paths = []
+    for node in graph.nodes:
+        if timing_info[node].get_total() <= period:
+            continue
+        if any(
+            timing_info[sink].parent is node
+            and timing_info[sink].get_total() > period
+            for sink in graph.sinks[node]
+        ):
+            continue
+
+        path = []
+        curr_node = node
+        while curr_node is not None:
+            path.append((curr_node, timing_info[curr_node].get_total()))
+            curr_node = timing_info[curr_node].parent
+        path.reverse()
+        paths.append(path)
+    return paths
+
+
+def get_closing_sites(graph, path, period):
+    # Sites on the path where a register brings both halves under the period,
+    # mapped to the longer half they leave behind. If no single register can,
+    # cut as late as the first half allows so the next round has the shortest
+    # remainder to deal with.
+    nodes = [n for n, c in path]
+    delays = [c for n, c in path]
+    register_sites = graph.get_register_sites()
+
+    sites = {}
+    for idx in register_sites.free_sites(nodes):
+        if graph.sparse:
+            sites[idx] = ((nodes[idx], nodes[idx + 1]), (nodes[idx + 3], nodes[idx + 4]))
+        else:
+            sites[idx] = ((nodes[idx], nodes[idx + 1]), None)
+    if len(sites) == 0:
+        return {}
+
+    remainder = {idx: max(delays[idx], delays[-1] - delays[idx]) for idx in sites}
+    early = [idx for idx in sites if delays[idx] <= period]
+    closing = [idx for idx in early if delays[-1] - delays[idx] <= period]
+    if len(closing) > 0:
+        return {sites[idx]: remainder[idx] for idx in closing}
+    if len(early) > 0:
+        idx = max(early, key=lambda idx: delays[idx])
+    else:
+        idx = min(sites, key=lambda idx: delays[idx])
+    return {sites[idx]: remainder[idx]}
+
+
+def select_register_cover(path_sites):
+    # Smallest set of sites hitting every path: a set cover ILP when scipy is
+    # available, greedy (most uncovered paths first) otherwise. Ties go to the
+    # site leaving the shortest remaining path.
+    sites = []
+    site_to_idx = {}
+    worst = {}
+    for candidates in path_sites:
+        for site, remainder in candidates.items():
+            if site not in site_to_idx:
+                site_to_idx[site] = len(sites)
+                sites.append(site)
+            worst[site] = max(worst.get(site, 0), remainder)
+    if len(sites) == 0:
+        return []
+
+    try:
+        import numpy as np
+        from scipy.optimize import milp, LinearConstraint, Bounds
+
+        cover = np.zeros((len(path_sites), len(sites)))
+        for path_idx, candidates in enumerate(path_sites):
+            for site in candidates:
+                cover[path_idx][site_to_idx[site]] = 1
+        # Tie-break term stays below the cost of one register in total
+        max_worst = max(worst.values()) or 1
+        cost = [1 + worst[site] / max_worst / (len(sites) + 1) for site in sites]
+        res = milp(
+            c=np.array(cost),
+            constraints=LinearConstraint(cover, lb=1),
+            integrality=np.ones(len(sites)),
+            bounds=Bounds(0, 1),
+        )
+        if res.success:
+            return [site for site, x in zip(sites, res.x) if x > 0.5]
+    except ImportError:
+        pass
+
+    uncovered = set(range(len(path_sites)))
+    site_paths = {site: set() for site in sites}
+    for path_idx, candidates in enumerate(path_sites):
+        for site in candidates:
+            site_paths[site].add(path_idx)
+
+    selected = []
+    while uncovered:
+        best = max(
+            sites, key=lambda site: (len(site_paths[site] & uncovered), -worst[site])
+        )
+        selected.append(best)
+        uncovered -= site_paths[best]
+    return selected
+
+
+def solve_timing_closure(graph, target_freq, west_in_io_sides, rebalance=None):
+    period = 1.0e6 / target_freq
+    starting_regs = graph.added_regs
+    rounds = 0
+
+    while True:
+        timing_info = compute_timing(graph, west_in_io_sides)
+        paths = find_violating_paths(graph, timing_info, period)
+        if len(paths) == 0:
+            break
+
+        path_sites = [get_closing_sites(graph, path, period) for path in paths]
+        path_sites = [candidates for candidates in path_sites if len(candidates) > 0]
+        if len(path_sites) == 0:
+            print(
+                bcolors.WARNING
+                + f"\nNo register sites left to reach {target_freq} MHz"
+                + bcolors.ENDC
+            )
+            break
+
+        # Sparse FIFO pairs can share an SB, keep the first of overlapping sites
+        used = set()
+        sites = []
+        for site in select_register_cover(path_sites):
+            edges = graph.register_site_edges(*site)
+            if any(edge[0] in used for edge in edges):
+                continue
+            used.update(edge[0] for edge in edges)
+            sites.append(site)
+
+        graph.insert_registers(sites)
+        if rebalance is not None:
+            rebalance()
+        rounds += 1
+        verboseprint(f"\tRound {rounds}: inserted {len(sites)} register sites")
+
+    print(
+        f"\nTiming closure took {rounds} rounds,",
+        graph.added_regs - starting_regs,
+        "registers added",
+    )
+    return graph.added_regs - starting_regs
+
+
+def register_segment(graph, reg_tile):
+    # Wire a register can slide along without changing the latency of any
+    # path: the single fanin, single fanout run it sits on, up to and
+    # including the closest branch points
+    source = graph.sources[graph.sources[reg_tile][0]][0]
+    dest = graph.sinks[graph.sinks[reg_tile][0]][0]
+
+    path = [source]
+    curr_node = source
+    while len(graph.sources[curr_node]) == 1:
+        parent = graph.sources[curr_node][0]
+        if not isinstance(parent, RouteNode):
+            break
+        path.append(parent)
+        if len(graph.sinks[parent]) > 1:
+            break
+        curr_node = parent
+    path.reverse()
+
+    path.append(dest)
+    curr_node = dest
+    while len(graph.sinks[curr_node]) == 1:
+        sink = graph.sinks[curr_node][0]
+        if not isinstance(sink, RouteNode) or len(graph.sources[sink]) > 1:
+            break
+        path.append(sink)
+        curr_node = sink
+
+    return path
+
+
+def get_retimable_regs(graph):
+    # Registers added by pipelining can be moved or removed, registers from
+    # the netlist can only be moved. Shift registers are left alone.
+    movable = []
+    removable = []
+    for reg in graph.get_regs():
+        if reg in graph.get_shift_regs():
+            continue
+        movable.append(reg)
+        if graph.id_to_name[reg.tile_id].startswith("pnr_pipelining_"):
+            removable.append(reg)
+    return movable, removable
+
+
+def get_crit_path_regs(graph, crit_path):
+    # Registers launching and capturing the critical path. The path starts
+    # after the launching register and ends a step or two before capture.
+    regs = []
+    launch = crit_path[0][0]
+    for node in [launch] + graph.sources[launch]:
+        if isinstance(node, TileNode) and node.tile_type == TileType.REG:
+            regs.append(node)
+            break
+
+    capture = crit_path[-1][0]
+    nodes = [capture] + graph.sinks[capture]
+    for sink in graph.sinks[capture]:
+        nodes += graph.sinks[sink]
+    for node in nodes:
+        if isinstance(node, TileNode) and node.tile_type == TileType.REG:
+            regs.append(node)
+            break
+    return regs
+
+
+def register_stage_delay(graph, timing, reg):
+    # Longest of the paths into and out of a register
+    delay = timing.totals[graph.sources[reg][0]]
+    seen = set()
+    stack = [reg]
+    while stack:
+        node = stack.pop()
+        for sink in graph.sinks[node]:
+            if sink in seen:
+                continue
+            if isinstance(sink, TileNode) and sink.input_port_break_path.get(
+                node.port
+            ):
+                continue
+            seen.add(sink)
+            delay = max(delay, timing.totals[sink])
+            stack.append(sink)
+    return delay
+
+
+def retime_move(graph, timing, tile_id):
+    # Slide a register to the free site on its wire with the shortest
+    # critical path, and among those the shortest stage through the register.
+    # Returns whether it moved.
+    reg = graph.get_tile(tile_id)
+    kernel = reg.kernel
+    name = graph.id_to_name[tile_id].split("@", 1)[0]
+    path = register_segment(graph, reg)
+
+    _, crit_path, _ = timing.sta(verbose=False)
+    best_cost = (crit_path[-1][1], register_stage_delay(graph, timing, reg))
+    start_edge = graph.remove_register(reg)
+    best_edge = start_edge
+    for idx in graph.get_register_sites().free_sites(path):
+        edge = (path[idx], path[idx + 1])
+        if edge == start_edge:
+            continue
+        reg = graph.splice_register(edge, tile_id=tile_id, name=name)
+        _, crit_path, _ = timing.sta(verbose=False)
+        cost = (crit_path[-1][1], register_stage_delay(graph, timing, reg))
+        if cost < best_cost:
+            best_edge = edge
+            best_cost = cost
+        graph.remove_register(reg)
+
+    reg = graph.splice_register(best_edge, tile_id=tile_id, name=name)
+    reg.kernel = kernel
+    return best_edge != start_edge
+
+
+def retime_registers(graph, west_in_io_sides, rebalance=None, max_rounds=None):
+    """Move pipeline registers along their wires to shorten the critical
+    path, then drop pnr_pipelining registers that timing doesn't need.
+    Removals need rebalance to redo latency matching and are only kept when
+    matching doesn't add registers back. Returns the change in register
+    count."""
+    if graph.sparse:
+        print(
+            bcolors.WARNING
+            + "\nRegister retiming doesn't support sparse FIFO pairs, skipping"
+            + bcolors.ENDC
+        )
+        return 0
+
+    movable, removable = get_retimable_regs(graph)
+    starting_regs = len(graph.get_regs())
+    timing = TimingState(graph, west_in_io_sides)
+    _, crit_path, _ = timing.sta(verbose=False)
+    crit_delay = crit_path[-1][1]
+
+    if max_rounds is None:
+        max_rounds = len(movable)
+    moved = 0
+    for _ in range(max_rounds):
+        movable_ids = {reg.tile_id for reg in movable}
+        candidates = [
+            reg
+            for reg in get_crit_path_regs(graph, crit_path)
+            if reg.tile_id in movable_ids
+        ]
+        improved = False
+        for reg in candidates:
+            if retime_move(graph, timing, reg.tile_id):
+                improved = True
+                moved += 1
+                break
+        if not improved:
+            break
+        _, crit_path, _ = timing.sta(verbose=False)
+        crit_delay = crit_path[-1][1]
+        movable, removable = get_retimable_regs(graph)
+
+    removed = 0
+    if rebalance is not None:
+        for tile_id in [reg.tile_id for reg in removable]:
+            reg = graph.get_tile(tile_id)
+            name = graph.id_to_name[tile_id].split("@", 1)[0]
+            added_regs = graph.added_regs
+            pond_latencies = {
+                pond: dict(pond.input_port_latencies) for pond in graph.get_ponds()
+            }
+
+            edge = graph.remove_register(reg)
+            _, crit_path, _ = timing.sta(verbose=False)
+            keep = crit_path[-1][1] <= crit_delay
+            if keep:
+                try:
+                    rebalance()
+                    _, crit_path, _ = timing.sta(verbose=False)
+                    keep = (
+                        crit_path[-1][1] <= crit_delay
+                        and graph.added_regs == added_regs
+                        and all(
+                            pond.input_port_latencies == latencies
+                            for pond, latencies in pond_latencies.items()
+                        )
+                    )
+                except Exception:
+                    keep = False
+
+            if keep:
+                removed += 1
+                continue
+
+            # Undo whatever latency matching added, then put the register back
+            for reg_id in range(graph.added_regs - 1, added_regs - 1, -1):
+                new_reg = graph.get_tile(f"r{reg_id}")
+                if new_reg is not None:
+                    graph.remove_register(new_reg)
+            for pond, latencies in pond_latencies.items():
+                if pond.input_port_latencies != latencies:
+                    pond.input_port_latencies = latencies
+                    graph.change_log.append(pond)
+            graph.splice_register(edge, tile_id=tile_id, name=name)
+        rebalance()
+
+    print(
+        "\nRetiming moved",
+        moved,
+        "registers and removed",
+        removed,
+        "registers",
+    )
+    return len(graph.get_regs()) - starting_regs
 
 
 def add_delay_to_kernel(graph, kernel, added_delay, id_to_name, placement, routing):
     kernel_output_nodes = graph.get_output_tiles_of_kernel(kernel)
     for node in kernel_output_nodes:
-        for _ in range(added_delay):
-            break_at(graph, node, id_to_name, placement, routing)
+        break_at(graph, node, id_to_name, placement, routing, cycles=added_delay)
 
 
 def branch_delay_match_all_nodes(graph, id_to_name, placement, routing):
@@ -337,37 +834,153 @@ def branch_delay_match_all_nodes(graph, id_to_name, placement, routing):
             node_cycles[node] = None
 
 
-def find_closest_match(kernel_target, candidates):
-    candidates = [c for c in candidates if "io1_" not in c]
+class KernelMatcher:
+    """Matches clockwork kernel names to kernels in the routing graph, which
+    were renamed along the way. Lookup tables are built once per candidate
+    set and every result is kept."""
+
+    def __init__(self, candidates):
+        self.candidates = [c for c in candidates if "io1_" not in c]
+        self.exact = set(self.candidates)
+        # All candidates joined so a substring search is a single str.find,
+        # offsets map a hit back to the candidate it landed in
+        self.haystack = "\n".join(self.candidates)
+        self.offsets = []
+        offset = 0
+        for c in self.candidates:
+            self.offsets.append(offset)
+            offset += len(c) + 1
+        # kernel -> match, None if nothing matched
+        self.results = {}
+
+    def find(self, pattern):
+        # First candidate containing pattern
+        start = self.haystack.find(pattern)
+        if start == -1:
+            return None
+        return self.candidates[bisect.bisect_right(self.offsets, start) - 1]
 
-    if "op_" + kernel_target in candidates:
-        return "op_" + kernel_target
+    def patterns(self, kernel_target):
+        yield kernel_target + "_write"
+        kernel_target_in = kernel_target + "_read"
+        yield kernel_target_in.replace(
+            "global_wrapper_global_wrapper", "global_wrapper_glb"
+        )
+        yield kernel_target_in.replace("cgra", "glb")
 
-    kernel_target_out = kernel_target + "_write"
-    for c in candidates:
-        if kernel_target_out in c:
-            return c
+    def match(self, kernel_target):
+        if kernel_target in self.results:
+            return self.results[kernel_target]
 
-    kernel_target_in = kernel_target + "_read"
-    kernel_target_in = kernel_target_in.replace(
-        "global_wrapper_global_wrapper", "global_wrapper_glb"
-    )
-    for c in candidates:
-        if kernel_target_in in c:
-            return c
+        result = None
+        if "op_" + kernel_target in self.exact:
+            result = "op_" + kernel_target
+        else:
+            for pattern in self.patterns(kernel_target):
+                result = self.find(pattern)
+                if result is not None:
+                    break
+
+        self.results[kernel_target] = result
+        return result
+
+
+@functools.lru_cache(maxsize=8)
+def get_kernel_matcher(candidates):
+    return KernelMatcher(candidates)
+
+
+def find_closest_match(kernel_target, candidates):
+    match = get_kernel_matcher(tuple(candidates)).match(kernel_target)
+    if match is None:
+        print("No match for", kernel_target)
+    return match
+
+
+class KernelPortIndex:
+    """Routing graph nodes looked up by the tile names and ports clockwork
+    uses in the kernel latency file. Built once per latency matching pass."""
+
+    def __init__(self, graph, port_remap_r):
+        # Full tile name -> tiles, and the same with any "@" track info removed
+        self.tiles_by_name = {}
+        self.tiles_by_stripped_name = {}
+        # (tile, remapped port) -> source nodes, through live and removed edges
+        self.port_sources = {}
+        self.removed_port_sources = {}
+
+        for tile in graph.get_tiles():
+            full_name = graph.id_to_name[str(tile)]
+            # In case we have track info in reg name beginning with "@"
+            assert (
+                len(full_name.split("@")) <= 2
+            ), f"Assume we only have <= one @ in the name {full_name}"
+            self.tiles_by_name.setdefault(full_name, []).append(tile)
+            self.tiles_by_stripped_name.setdefault(
+                full_name.split("@", 1)[0], []
+            ).append(tile)
+
+            for source in graph.sources[tile]:
+                if source.port in port_remap_r:
+                    self.port_sources.setdefault(
+                        (tile, port_remap_r[source.port]), []
+                    ).append(source)
+
+        for source_node, dest_node in graph.removed_edges:
+            if source_node.port in port_remap_r:
+                self.removed_port_sources.setdefault(
+                    (dest_node, port_remap_r[source_node.port]), []
+                ).append(source_node)
+
+
+def get_ports_with_unique_latencies(
+    graph, kernel_latencies, node_cycles, port_remap_r
+):
+    # Groups of kernel input nodes that clockwork expects to have the same latency
+    port_index = KernelPortIndex(graph, port_remap_r)
+    ports_with_unique_latenices = {}
+    for kernel, latency_dict in kernel_latencies.items():
+        if "_glb_" in kernel:
+            continue
+        match = find_closest_match(kernel, list(node_cycles.keys()))
+        if match is not None:
+            ports_with_unique_latenices[match] = []
+            for kernel_port, d1 in latency_dict.items():
+                if d1["pe_port"] != []:
+                    port_nodes = []
+                    for compute_file_tile, compute_file_port in d1["pe_port"]:
+                        found = False
+                        for pe in port_index.tiles_by_stripped_name.get(
+                            f"{match}$inner_compute${compute_file_tile}", []
+                        ):
+                            sources = port_index.port_sources.get(
+                                (pe, compute_file_port), []
+                            ) + port_index.removed_port_sources.get(
+                                (pe, compute_file_port), []
+                            )
+                            if len(sources) > 0:
+                                found = True
+                                port_nodes += sources
+                            else:
+                                print("Couldn't find pe port")
+                                print(latency_dict)
+                                breakpoint()
+
+                        if not found:
+                            print("Couldn't find pe")
+                            print(latency_dict)
+                            breakpoint()
 
-    kernel_target_in = kernel_target + "_read"
-    kernel_target_in = kernel_target_in.replace("cgra", "glb")
-    for c in candidates:
-        if kernel_target_in in c:
-            return c
+                    ports_with_unique_latenices[match].append(port_nodes)
 
-    print("No match for", kernel_target)
+    return ports_with_unique_latenices
 
 
 def branch_delay_match_within_kernels(
-    graph, id_to_name, placement, routing, kernel_latencies, port_remap
+    graph, id_to_name, placement, routing, kernel_latencies, port_remap, config=None
 ):
+    if config is None:
+        config = PnRConfig.from_env()
     port_remap_r = {v: k for k, v in port_remap["pe"].items()}
     port_remap_r["reg"] = "reg"
     nodes = graph.topological_sort()
@@ -406,7 +1019,7 @@ def branch_delay_match_within_kernels(
             cycles.remove(None)
 
         if len(cycles) > 1:
-            if "IO2MEM_REG_CHAIN" in os.environ or "MEM2PE_REG_CHAIN" in os.environ:
+            if config.reg_chain:
                 continue
             verboseprint(
                 f"\tIncorrect delay within kernel: {node.kernel} {node} {cycles}"
@@ -419,14 +1032,14 @@ def branch_delay_match_within_kernels(
             ]
             max_sink_cycles = max(sink_cycles)
             for sink in graph.sinks[node]:
-                for _ in range(max_sink_cycles - node_cycles[node.kernel][sink]):
-                    break_at(
-                        graph,
-                        node,
-                        id_to_name,
-                        placement,
-                        routing,
-                    )
+                break_at(
+                    graph,
+                    node,
+                    id_to_name,
+                    placement,
+                    routing,
+                    cycles=max_sink_cycles - node_cycles[node.kernel][sink],
+                )
             node_cycles[node.kernel][node] = max(cycles)
         elif len(cycles) == 1:
             node_cycles[node.kernel][node] = max(cycles)
@@ -435,53 +1048,9 @@ def branch_delay_match_within_kernels(
 
     # Only certain inputs of compute kernels can have different latencies (dictated by clockwork and H2H)
     # First determine which nodes can have unique latencies
-    ports_with_unique_latenices = {}
-    for kernel, latency_dict in kernel_latencies.items():
-        if "_glb_" in kernel:
-            continue
-        match = find_closest_match(kernel, list(node_cycles.keys()))
-        if match is not None:
-            ports_with_unique_latenices[match] = []
-            for kernel_port, d1 in latency_dict.items():
-                if d1["pe_port"] != []:
-                    port_nodes = []
-                    for compute_file_tile, compute_file_port in d1["pe_port"]:
-                        found = False
-                        for pe in graph.get_tiles():
-                            pe_full_name = graph.id_to_name[str(pe)]
-                            # In case we have track info in reg name beginning with "@"
-                            assert len(pe_full_name.split('@')) <= 2, f"Assume we only have <= one @ in the name {pe_full_name}"
-                            pe_stripped  = pe_full_name.split('@', 1)[0]
-                            if pe_stripped == f"{match}$inner_compute${compute_file_tile}":
-                                found_port = False
-                                for source in graph.sources[pe]:
-                                    if source.port in port_remap_r:
-                                        port = port_remap_r[source.port]
-                                        if port == compute_file_port:
-                                            found = True
-                                            found_port = True
-                                            port_nodes.append(source)
-
-                                for source_node, dest_node in graph.removed_edges:
-                                    if dest_node == pe:
-                                        if source_node.port in port_remap_r:
-                                            port = port_remap_r[source_node.port]
-                                            if port == compute_file_port:
-                                                found = True
-                                                found_port = True
-                                                port_nodes.append(source_node)
-
-                                if not found_port:
-                                    print("Couldn't find pe port")
-                                    print(latency_dict)
-                                    breakpoint()
-
-                        if not found:
-                            print("Couldn't find pe")
-                            print(latency_dict)
-                            breakpoint()
-
-                    ports_with_unique_latenices[match].append(port_nodes)
+    ports_with_unique_latenices = get_ports_with_unique_latencies(
+        graph, kernel_latencies, node_cycles, port_remap_r
+    )
 
     # Then branch delay match the nodes without unique latencies
     for kernel in node_cycles:
@@ -509,16 +1078,15 @@ def branch_delay_match_within_kernels(
                         f"\tFixing branching delays at: {node_with_same_latency}"
                     )
                     for sink in graph.sinks[node_with_same_latency]:
-                        for _ in range(
-                            same_latency - node_cycles[kernel][node_with_same_latency]
-                        ):
-                            break_at(
-                                graph,
-                                sink,
-                                id_to_name,
-                                placement,
-                                routing,
-                            )
+                        break_at(
+                            graph,
+                            sink,
+                            id_to_name,
+                            placement,
+                            routing,
+                            cycles=same_latency
+                            - node_cycles[kernel][node_with_same_latency],
+                        )
                     node_cycles[node.kernel][node_with_same_latency] = same_latency
 
     kernel_latencies = {}
@@ -590,6 +1158,247 @@ def branch_delay_match_kernels(kernel_graph, graph, id_to_name, placement, routi
             node_cycles[node] = None
 
 
+def branch_segment(graph, node1, node2):
+    # Widest single-fanin, single-fanout stretch of wire around the edge
+    # node1 -> node2. Any register placed on it delays only that branch.
+    kernel = node1.kernel
+    path = [node1, node2]
+
+    # Only wire that fans out to nothing but this branch, a register before
+    # a fork would delay the other branches as well
+    curr_node = node1
+    while (
+        isinstance(curr_node, RouteNode)
+        and len(graph.sinks[curr_node]) == 1
+        and len(graph.sources[curr_node]) == 1
+        and graph.sources[curr_node][0].kernel == kernel
+    ):
+        curr_node = graph.sources[curr_node][0]
+        path.insert(0, curr_node)
+
+    curr_node = node2
+    while (
+        isinstance(curr_node, RouteNode)
+        and len(graph.sinks[curr_node]) == 1
+        and len(graph.sources[graph.sinks[curr_node][0]]) == 1
+    ):
+        curr_node = graph.sinks[curr_node][0]
+        path.append(curr_node)
+
+    return path
+
+
+def solve_branch_delays(graph, kernel_latencies, port_remap, config=None):
+    # Branch delay matching as a difference constraint system. Every node gets
+    # its latency to the kernel output in one reverse longest path pass, and
+    # each edge is assigned the slack it needs to meet that latency. Nothing
+    # is inserted here, see materialize_branch_delays.
+    if config is None:
+        config = PnRConfig.from_env()
+    port_remap_r = {v: k for k, v in port_remap["pe"].items()}
+    port_remap_r["reg"] = "reg"
+    nodes = graph.topological_sort()
+    nodes.reverse()
+    node_cycles = {}
+    edge_delays = {}
+
+    for node in nodes:
+        if node.kernel not in node_cycles:
+            node_cycles[node.kernel] = {}
+
+        sink_cycles = {}
+        if len(graph.sinks[node]) == 0:
+            sink_cycles[None] = 0
+
+        for sink in graph.sinks[node]:
+            if sink not in node_cycles[node.kernel]:
+                node_cycles[node.kernel][sink] = 0
+
+            c = node_cycles[node.kernel][sink]
+
+            if c != None and isinstance(sink, TileNode):
+                c += sink.input_port_latencies[node.port]
+            elif node in graph.get_input_ios():
+                # Need special case for input IOs
+                c += node.input_port_latencies["output"]
+
+            if (
+                isinstance(node, TileNode)
+                and node.tile_type == TileType.PE
+                and sink.port == "PondTop_output_width_17_num_0"
+            ):
+                continue
+            if c != None:
+                sink_cycles[sink] = c
+
+        cycles = set(sink_cycles.values())
+        if len(cycles) > 1:
+            if config.reg_chain:
+                continue
+            for sink, c in sink_cycles.items():
+                if c < max(cycles):
+                    edge_delays[(node, sink)] = max(cycles) - c
+
+        if len(cycles) > 0:
+            node_cycles[node.kernel][node] = max(cycles)
+        else:
+            node_cycles[node.kernel][node] = None
+
+    # Kernel inputs clockwork expects to arrive together get the same latency
+    ports_with_unique_latenices = get_ports_with_unique_latencies(
+        graph, kernel_latencies, node_cycles, port_remap_r
+    )
+    for kernel, port_groups in ports_with_unique_latenices.items():
+        for nodes_with_same_latency in port_groups:
+            same_latency = max(
+                node_cycles[kernel][node] for node in nodes_with_same_latency
+            )
+            for node in nodes_with_same_latency:
+                delay = same_latency - node_cycles[kernel][node]
+                if delay == 0:
+                    continue
+                for sink in graph.sinks[node]:
+                    edge_delays[(node, sink)] = (
+                        edge_delays.get((node, sink), 0) + delay
+                    )
+                node_cycles[kernel][node] = same_latency
+
+    kernel_latencies = {}
+    for kernel in node_cycles:
+        kernel_latencies[kernel] = max(node_cycles[kernel].values())
+
+    return kernel_latencies, node_cycles, edge_delays
+
+
+def solve_kernel_delays(kernel_graph, graph, edge_delays):
+    # Forward longest path over the kernel graph. A kernel that arrives early
+    # at any consumer is delayed by its largest deficit on its output edges.
+    nodes = kernel_graph.topological_sort()
+    node_cycles = {}
+    kernel_delays = {}
+
+    for node in nodes:
+        cycles = set()
+
+        if len(kernel_graph.sources[node]) == 0:
+            if (
+                node.kernel_type == KernelNodeType.COMPUTE
+                or node.kernel_type == KernelNodeType.MEM
+            ):
+                cycles = {None}
+            else:
+                cycles = {0}
+
+        for parent in kernel_graph.sources[node]:
+            if parent not in node_cycles:
+                c = 0
+            else:
+                c = node_cycles[parent]
+
+            if c is not None:
+                c += node.latency
+
+            if not (
+                "reset" in parent.kernel
+                or (parent.kernel_type == KernelNodeType.MEM and str(parent)[0] == "m")
+            ):
+                cycles.add(c)
+
+        if None in cycles:
+            cycles.remove(None)
+
+        if len(kernel_graph.sources[node]) > 1 and len(cycles) > 1:
+            source_cycles = [
+                node_cycles[source]
+                for source in kernel_graph.sources[node]
+                if node_cycles[source] != None
+            ]
+            max_cycle = max(source_cycles)
+            for source in kernel_graph.sources[node]:
+                if node_cycles[source] != None and node_cycles[source] != max_cycle:
+                    kernel_delays[source.kernel] = max(
+                        kernel_delays.get(source.kernel, 0),
+                        max_cycle - node_cycles[source],
+                    )
+        if len(cycles) > 0:
+            node_cycles[node] = max(cycles)
+        else:
+            node_cycles[node] = None
+
+    for kernel, delay in kernel_delays.items():
+        for tile in graph.get_output_tiles_of_kernel(kernel):
+            for sink in graph.sinks[tile]:
+                edge_delays[(tile, sink)] = edge_delays.get((tile, sink), 0) + delay
+
+    return kernel_delays
+
+
+def materialize_branch_delays(graph, edge_delays, node_cycles=None):
+    # Turn per edge delays into registers in a single graph edit. Delays on
+    # a branch fed by a pond are absorbed into the pond instead.
+    segment_delays = {}
+    segments = {}
+    for (node1, node2), delay in edge_delays.items():
+        path = branch_segment(graph, node1, node2)
+        key = (path[0], path[-1])
+        segments[key] = path
+        segment_delays[key] = segment_delays.get(key, 0) + delay
+
+    register_sites = graph.get_register_sites()
+    site_len = 5 if graph.sparse else 2
+    sites = []
+    filled = []
+    for key, delay in segment_delays.items():
+        path = segments[key]
+        driver = path[0]
+        if len(graph.sources[driver]) == 1 and driver not in graph.get_ponds():
+            driver = graph.sources[driver][0]
+        if driver in graph.get_ponds():
+            verboseprint("\t\tFound pond for branch delay matching", driver)
+            driver.input_port_latencies["data_in_pond"] += delay
+            graph.change_log.append(driver)
+            continue
+
+        free_sites = []
+        for idx in register_sites.free_sites(path):
+            if len(free_sites) == 0 or idx >= free_sites[-1] + site_len:
+                free_sites.append(idx)
+        if len(free_sites) < delay:
+            raise ValueError(
+                f"Cant break at node: {path[0]}, need {delay} registers but only"
+                f" {len(free_sites)} sites are free"
+            )
+
+        # Spread the registers evenly along the branch
+        for i in range(delay):
+            idx = free_sites[i * len(free_sites) // delay]
+            if graph.sparse:
+                sites.append(
+                    ((path[idx], path[idx + 1]), (path[idx + 3], path[idx + 4]))
+                )
+            else:
+                sites.append(((path[idx], path[idx + 1]), None))
+        filled.append(path)
+
+    graph.insert_registers(sites)
+
+    if node_cycles is not None:
+        # New register nodes take their latency from the branch they sit on
+        for path in filled:
+            curr_node = path[-1]
+            while curr_node is not path[0]:
+                parent = graph.sources[curr_node][0]
+                cycles = node_cycles.setdefault(parent.kernel, {})
+                if parent not in cycles:
+                    c = cycles.get(curr_node, 0)
+                    if c is not None and isinstance(curr_node, TileNode):
+                        c += curr_node.input_port_latencies[parent.port]
+                    cycles[parent] = c
+                curr_node = parent
+
+    return len(sites)
+
+
 def flush_cycles(
     graph, id_to_name, harden_flush, pipeline_config_interval, pes_with_packed_ponds
 ):
@@ -618,6 +1427,7 @@ def flush_cycles(
                 break
         assert io.kernel == "io1in_reset"
         flush_cycles = {}
+        flush_arrivals = graph.get_flush_arrivals(io)
 
         for mem in graph.get_mems() + graph.get_ponds():
             for parent_node in graph.sources[mem]:
@@ -626,15 +1436,11 @@ def flush_cycles(
             if parent_node.port != "flush":
                 continue
 
-            curr_node = mem
             flush_cycles[mem] = 0
-            while parent_node != io:
-                if isinstance(curr_node, TileNode):
-                    flush_cycles[mem] += curr_node.input_port_latencies[
-                        parent_node.port
-                    ]
-                curr_node = parent_node
-                parent_node = graph.sources[parent_node][0]
+            if parent_node != io:
+                flush_cycles[mem] = (
+                    flush_arrivals[parent_node] + mem.input_port_latencies["flush"]
+                )
 
     if flush_cycles == {}:
         max_flush_cycles = 0
@@ -667,6 +1473,7 @@ def calculate_latencies(
     graph, kernel_graph, node_latencies, kernel_latencies, port_remap, instance_to_instr
 ):
     port_remap_r = {v: k for k, v in port_remap["pe"].items()}
+    port_index = KernelPortIndex(graph, port_remap_r)
 
     max_latencies = {}
 
@@ -720,36 +1527,32 @@ def calculate_latencies(
                     for compute_file_tile, compute_file_port in d1["pe_port"]:
                         # Within this loop, all the ports should have the same latency
                         found_lat = None
-                        for pe in graph.get_tiles():
-                            if (
-                                graph.id_to_name[str(pe)]
-                                == f"{match}$inner_compute${compute_file_tile}"
-                            ):
-                                found_port = False
-                                for source in graph.sources[pe]:
-                                    if source.port in port_remap_r:
-                                        port = port_remap_r[source.port]
-                                        if port == compute_file_port:
-                                            reg = graph.get_connected_reg(source)
-                                            if reg is not None:
-                                                lat = node_latencies[match][reg]
-                                            else:
-                                                lat = node_latencies[match][source]
-
-                                            if found_lat is not None:
-                                                assert (
-                                                    lat == found_lat
-                                                ), f"Found multiple latencies for {kernel} {kernel_port} {compute_file_tile} {compute_file_port} {lat} {found_lat}"
-                                            kernel_latencies[kernel][kernel_port]["latency"] = lat
-                                            found = True
-                                            found_port = True
-                                            found_lat = lat
-                                            break
-                                if not found_port:
-                                    found = True
-                                    kernel_latencies[kernel][kernel_port][
-                                        "latency"
-                                    ] = node_latencies[match][graph.sources[pe][0]]
+                        for pe in port_index.tiles_by_name.get(
+                            f"{match}$inner_compute${compute_file_tile}", []
+                        ):
+                            found = True
+                            sources = port_index.port_sources.get(
+                                (pe, compute_file_port), []
+                            )
+                            if len(sources) == 0:
+                                kernel_latencies[kernel][kernel_port][
+                                    "latency"
+                                ] = node_latencies[match][graph.sources[pe][0]]
+                                continue
+
+                            source = sources[0]
+                            reg = graph.get_connected_reg(source)
+                            if reg is not None:
+                                lat = node_latencies[match][reg]
+                            else:
+                                lat = node_latencies[match][source]
+
+                            if found_lat is not None:
+                                assert (
+                                    lat == found_lat
+                                ), f"Found multiple latencies for {kernel} {kernel_port} {compute_file_tile} {compute_file_port} {lat} {found_lat}"
+                            kernel_latencies[kernel][kernel_port]["latency"] = lat
+                            found_lat = lat
 
                     if not found:
                         print("Couldn't find tile port in kernel latencies", kernel)
@@ -757,6 +1560,189 @@ def calculate_latencies(
     return kernel_latencies, stencil_valid_adjust
 
 
+def write_json_atomic(filename, data):
+    # Write the whole file next to its destination and rename it into place
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or ".", suffix=".tmp"
+    )
+    with os.fdopen(fd, "w") as fout:
+        fout.write(json.dumps(data, indent=4))
+    if os.path.exists(filename):
+        shutil.copymode(filename, tmp_filename)
+    else:
+        os.chmod(tmp_filename, 0o644)
+    os.replace(tmp_filename, filename)
+
+
+class KernelLatencyState:
+    """Latency matching inputs and outputs for one app. The input files are
+    read once, latencies are only recomputed when the routing graph changed
+    since the last update and the output files are written once by write()."""
+
+    def __init__(
+        self,
+        dir_name,
+        existing_kernel_latencies,
+        harden_flush,
+        instance_to_instr,
+        pipeline_config_interval,
+        pes_with_packed_ponds,
+        sparse,
+        config=None,
+    ):
+        self.dir_name = dir_name
+        self.existing_kernel_latencies = existing_kernel_latencies
+        self.harden_flush = harden_flush
+        self.instance_to_instr = instance_to_instr
+        self.pipeline_config_interval = pipeline_config_interval
+        self.pes_with_packed_ponds = pes_with_packed_ponds
+        self.sparse = sparse
+        self.config = PnRConfig.from_env() if config is None else config
+
+        self.loaded = False
+        # (graph, length of its change log) the outputs were computed from
+        self.generation = None
+        # Output file -> contents, written out by write()
+        self.outputs = {}
+
+    def load(self):
+        if self.loaded:
+            return
+        dir_name = self.dir_name
+        self.port_remap = json.load(open(f"{dir_name}/design.port_remap"))
+        self.kernel_latencies_file = glob.glob(
+            f"{dir_name}/*_compute_kernel_latencies.json"
+        )[0]
+
+        # updated_kernel_latencies.json only for residual add and manual placed resnet for now
+        self.updated_kernel_latencies = None
+        if os.path.exists(f"{dir_name}/updated_kernel_latencies.json"):
+            self.updated_kernel_latencies = json.load(
+                open(f"{dir_name}/updated_kernel_latencies.json")
+            )
+        # ub_latency.json only for manual placed resnet
+        self.ub_latencies = None
+        if os.path.exists(f"{dir_name}/ub_latency.json"):
+            self.ub_latencies = json.load(open(f"{dir_name}/ub_latency.json"))
+        self.loaded = True
+
+    def update(self, graph, id_to_name, placement, routing):
+        if self.sparse:
+            return
+        if (graph, len(graph.change_log)) == self.generation:
+            return
+        self.load()
+        self.outputs = self.compute(graph, id_to_name, placement, routing)
+        # compute inserts branch delay registers, which are logged too
+        self.generation = (graph, len(graph.change_log))
+
+    def compute(self, graph, id_to_name, placement, routing):
+        existing_kernel_latencies = self.existing_kernel_latencies
+        port_remap = self.port_remap
+
+        if self.config.branch_delay_engine == "constraints":
+            kernel_latencies, node_latencies, edge_delays = solve_branch_delays(
+                graph, existing_kernel_latencies, port_remap, self.config
+            )
+            kernel_graph = construct_kernel_graph(graph, kernel_latencies)
+            solve_kernel_delays(kernel_graph, graph, edge_delays)
+            materialize_branch_delays(graph, edge_delays, node_latencies)
+        else:
+            kernel_latencies, node_latencies = branch_delay_match_within_kernels(
+                graph,
+                id_to_name,
+                placement,
+                routing,
+                existing_kernel_latencies,
+                port_remap,
+                self.config,
+            )
+
+            kernel_graph = construct_kernel_graph(graph, kernel_latencies)
+
+            branch_delay_match_kernels(
+                kernel_graph, graph, id_to_name, placement, routing
+            )
+
+        # branch_delay_match_all_nodes(graph, id_to_name, placement, routing)
+
+        flush_latencies, max_flush_cycles = flush_cycles(
+            graph,
+            id_to_name,
+            self.harden_flush,
+            self.pipeline_config_interval,
+            self.pes_with_packed_ponds,
+        )
+        for node in kernel_graph.nodes:
+            if "io16in" in node.kernel or "io1in" in node.kernel:
+                node.latency -= max_flush_cycles
+                assert (
+                    node.latency >= 0
+                ), f"{node.kernel} has negative compute kernel latency"
+
+        matched_kernel_latencies, stencil_valid_adjust = calculate_latencies(
+            graph,
+            kernel_graph,
+            node_latencies,
+            existing_kernel_latencies,
+            port_remap,
+            self.instance_to_instr,
+        )
+        if self.updated_kernel_latencies is not None:
+            updated_kernel_latencies = self.updated_kernel_latencies
+            for kernel, latency_dict in matched_kernel_latencies.items():
+                if "hcompute_output_cgra_stencil" in kernel:
+                    for kernel_port, d1 in latency_dict.items():
+                        if "input_cgra_stencil" or "in2_output_cgra_stencil" in kernel_port:
+                            d1["latency"] = updated_kernel_latencies[kernel][kernel_port]["latency"]
+                if "_glb_" in kernel:
+                    matched_kernel_latencies[kernel] = copy.deepcopy(
+                        updated_kernel_latencies[kernel]
+                    )
+        if self.ub_latencies is not None:
+            ub_latencies = self.ub_latencies
+            for kernel, latency_dict in matched_kernel_latencies.items():
+                if "hcompute_input_cgra_stencil" in kernel:
+                    for kernel_port, d1 in latency_dict.items():
+                        port_num = kernel_port.split("_")[-1]
+                        d1["latency"] = ub_latencies["input_cgra_stencil"][port_num]["latency"]
+                if "hcompute_kernel_cgra_stencil" in kernel:
+                    for kernel_port, d1 in latency_dict.items():
+                        d1["latency"] = min(value["latency"] for value in ub_latencies["kernel_cgra_stencil"].values())
+        matched_flush_latencies = {
+            id_to_name[str(mem_id)]: latency for mem_id, latency in flush_latencies.items()
+        }
+
+        pond_latencies = {}
+        for pond_node in graph.get_ponds():
+            for port, lat in pond_node.input_port_latencies.items():
+                if port != "flush":
+                    pond_latencies[id_to_name[pond_node.tile_id]] = lat
+
+        kernel_latencies_file = self.kernel_latencies_file
+
+        flush_latencies_file = kernel_latencies_file.replace(
+            "compute_kernel_latencies", "flush_latencies"
+        )
+        pond_latencies_file = kernel_latencies_file.replace(
+            "compute_kernel_latencies", "pond_latencies"
+        )
+        stencil_valid_latencies_file = kernel_latencies_file.replace(
+            "compute_kernel_latencies", "stencil_valid_latencies"
+        )
+
+        return {
+            kernel_latencies_file: matched_kernel_latencies,
+            flush_latencies_file: matched_flush_latencies,
+            pond_latencies_file: pond_latencies,
+            stencil_valid_latencies_file: stencil_valid_adjust,
+        }
+
+    def write(self):
+        for filename, data in self.outputs.items():
+            write_json_atomic(filename, data)
+
+
 def update_kernel_latencies(
     dir_name,
     graph,
@@ -769,94 +1755,20 @@ def update_kernel_latencies(
     pipeline_config_interval,
     pes_with_packed_ponds,
     sparse,
+    config=None,
 ):
-    if sparse:
-        return
-
-    port_remap = json.load(open(f"{dir_name}/design.port_remap"))
-
-    kernel_latencies, node_latencies = branch_delay_match_within_kernels(
-        graph, id_to_name, placement, routing, existing_kernel_latencies, port_remap
-    )
-
-    kernel_graph = construct_kernel_graph(graph, kernel_latencies)
-
-    branch_delay_match_kernels(kernel_graph, graph, id_to_name, placement, routing)
-
-    # branch_delay_match_all_nodes(graph, id_to_name, placement, routing)
-
-    flush_latencies, max_flush_cycles = flush_cycles(
-        graph, id_to_name, harden_flush, pipeline_config_interval, pes_with_packed_ponds
-    )
-    for node in kernel_graph.nodes:
-        if "io16in" in node.kernel or "io1in" in node.kernel:
-            node.latency -= max_flush_cycles
-            assert (
-                node.latency >= 0
-            ), f"{node.kernel} has negative compute kernel latency"
-
-    matched_kernel_latencies, stencil_valid_adjust = calculate_latencies(
-        graph,
-        kernel_graph,
-        node_latencies,
+    latency_state = KernelLatencyState(
+        dir_name,
         existing_kernel_latencies,
-        port_remap,
+        harden_flush,
         instance_to_instr,
+        pipeline_config_interval,
+        pes_with_packed_ponds,
+        sparse,
+        config,
     )
-    # updated_kernel_latencies.json only for residual add and manual placed resnet for now
-    if os.path.exists(f"{dir_name}/updated_kernel_latencies.json"):
-        updated_kernel_latencies = json.load(open(f"{dir_name}/updated_kernel_latencies.json"))
-        for kernel, latency_dict in matched_kernel_latencies.items():
-            if "hcompute_output_cgra_stencil" in kernel:
-                for kernel_port, d1 in latency_dict.items():
-                    if "input_cgra_stencil" or "in2_output_cgra_stencil" in kernel_port:
-                        d1["latency"] = updated_kernel_latencies[kernel][kernel_port]["latency"]
-            if "_glb_" in kernel:
-                matched_kernel_latencies[kernel] = updated_kernel_latencies[kernel]
-    # ub_latency.json only for manual placed resnet
-    if os.path.exists(f"{dir_name}/ub_latency.json"):
-        ub_latencies = json.load(open(f"{dir_name}/ub_latency.json"))
-        for kernel, latency_dict in matched_kernel_latencies.items():
-            if "hcompute_input_cgra_stencil" in kernel:
-                for kernel_port, d1 in latency_dict.items():
-                    port_num = kernel_port.split("_")[-1]
-                    d1["latency"] = ub_latencies["input_cgra_stencil"][port_num]["latency"]
-            if "hcompute_kernel_cgra_stencil" in kernel:
-                for kernel_port, d1 in latency_dict.items():
-                    d1["latency"] = min(value["latency"] for value in ub_latencies["kernel_cgra_stencil"].values())
-    matched_flush_latencies = {
-        id_to_name[str(mem_id)]: latency for mem_id, latency in flush_latencies.items()
-    }
-
-    pond_latencies = {}
-    for pond_node in graph.get_ponds():
-        for port, lat in pond_node.input_port_latencies.items():
-            if port != "flush":
-                pond_latencies[id_to_name[pond_node.tile_id]] = lat
-
-    kernel_latencies_file = glob.glob(f"{dir_name}/*_compute_kernel_latencies.json")[0]
-
-    flush_latencies_file = kernel_latencies_file.replace(
-        "compute_kernel_latencies", "flush_latencies"
-    )
-    pond_latencies_file = kernel_latencies_file.replace(
-        "compute_kernel_latencies", "pond_latencies"
-    )
-    stencil_valid_latencies_file = kernel_latencies_file.replace(
-        "compute_kernel_latencies", "stencil_valid_latencies"
-    )
-
-    fout = open(kernel_latencies_file, "w")
-    fout.write(json.dumps(matched_kernel_latencies, indent=4))
-
-    fout = open(flush_latencies_file, "w")
-    fout.write(json.dumps(matched_flush_latencies, indent=4))
-
-    fout = open(pond_latencies_file, "w")
-    fout.write(json.dumps(pond_latencies, indent=4))
-
-    fout = open(stencil_valid_latencies_file, "w")
-    fout.write(json.dumps(stencil_valid_adjust, indent=4))
+    latency_state.update(graph, id_to_name, placement, routing)
+    latency_state.write()
 
 
 def segment_node_to_string(node):
@@ -926,30 +1838,30 @@ def pipeline_pnr(
     pes_with_packed_ponds,
     sparse,
     west_in_io_sides,
+    config=None,
 ):
+    if config is None:
+        config = PnRConfig.from_env()
+
     if load_only:
         packed_file = os.path.join(app_dir, "design.packed")
         id_to_name = pythunder.io.load_id_to_name(packed_file)
         return placement, routing, id_to_name
 
-    placement_save = copy.deepcopy(placement)
-    routing_save = copy.deepcopy(routing)
-    id_to_name_save = copy.deepcopy(id_to_name)
+    # Edits from here on are journaled so POST_PNR_ITR can roll them back
+    journal = UndoJournal()
+    placement = JournaledDict(placement, journal)
+    routing = JournaledDict(routing, journal)
+    id_to_name = JournaledDict(id_to_name, journal)
+    start = journal.checkpoint()
 
     existing_kernel_latencies = {}
     if not sparse:
         kernel_latencies_file = glob.glob(f"{app_dir}/*_compute_kernel_latencies.json")[0]
         existing_kernel_latencies = json.load(open(kernel_latencies_file, "r"))
 
-    if "PIPELINED" in os.environ and os.environ["PIPELINED"].isnumeric():
-        pe_cycles = int(os.environ["PIPELINED"])
-    else:
-        pe_cycles = 1
-
-    if "IO_DELAY" in os.environ and os.environ["IO_DELAY"] == "0":
-        io_cycles = 0
-    else:
-        io_cycles = 1
+    pe_cycles = config.pe_latency
+    io_cycles = config.io_latency
 
     graph = construct_graph(
         placement,
@@ -970,59 +1882,90 @@ def pipeline_pnr(
     print("\nApplication Frequency:")
     curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
 
-    update_kernel_latencies(
+    latency_state = KernelLatencyState(
         app_dir,
-        graph,
-        id_to_name,
-        placement,
-        routing,
         existing_kernel_latencies,
         harden_flush,
         instance_to_instr,
         pipeline_config_interval,
         pes_with_packed_ponds,
         sparse,
+        config,
     )
+    latency_state.update(graph, id_to_name, placement, routing)
+
+    # Number of candidate register sites to time before breaking a path
+    what_if = config.what_if
+    what_if_jobs = config.what_if_jobs
+
+    if config.post_pnr_itr == "solve":
+        if config.target_freq is None:
+            raise ValueError("POST_PNR_ITR=solve needs PIPELINE_TARGET_FREQ (MHz)")
+        target_freq = config.target_freq
+        starting_regs = graph.added_regs
 
-    if "POST_PNR_ITR" in os.environ:
-        if os.environ["POST_PNR_ITR"] == "max":
+        solve_timing_closure(
+            graph,
+            target_freq,
+            west_in_io_sides,
+            rebalance=functools.partial(
+                latency_state.update, graph, id_to_name, placement, routing
+            ),
+        )
+
+        print("\nFinal application frequency:")
+        curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
+        print(
+            "\nAdded", graph.added_regs - starting_regs, "registers to routing graph\n"
+        )
+    elif config.target_freq is not None:
+        target_freq = config.target_freq
+        pipeline_to_target(
+            graph,
+            id_to_name,
+            placement,
+            routing,
+            target_freq,
+            west_in_io_sides,
+            rebalance=functools.partial(
+                latency_state.update, graph, id_to_name, placement, routing
+            ),
+            what_if=what_if,
+            what_if_jobs=what_if_jobs,
+        )
+
+        print("\nFinal application frequency:")
+        curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
+    elif config.post_pnr_itr is not None:
+        if config.post_pnr_itr == "max":
             max_itr = None
         else:
-            max_itr = int(os.environ["POST_PNR_ITR"])
+            max_itr = int(config.post_pnr_itr)
 
         curr_freq = 0
         itr = 0
 
         while max_itr == None:
             try:
-                break_crit_path(graph, id_to_name, crit_path, placement, routing)
-                graph.regs = None
-                update_kernel_latencies(
-                    app_dir,
-                    graph,
-                    id_to_name,
-                    placement,
-                    routing,
-                    existing_kernel_latencies,
-                    harden_flush,
-                    instance_to_instr,
-                    pipeline_config_interval,
-                    pes_with_packed_ponds,
-                    sparse,
+                break_idx = choose_break_idx(
+                    graph, crit_path, west_in_io_sides, what_if, what_if_jobs
+                )
+                break_crit_path(
+                    graph, id_to_name, crit_path, placement, routing, break_idx
                 )
+                graph.regs = None
+                latency_state.update(graph, id_to_name, placement, routing)
 
                 print("\nIteration", itr + 1, "frequency")
                 curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
-            except:
+            except ValueError:
                 max_itr = itr
             itr += 1
 
         print("\nCan break", max_itr, "critical paths")
 
         # Reloading best result
-        id_to_name = id_to_name_save
-        placement = placement_save
-        routing = routing_save
+        journal.rollback(start)
         graph = construct_graph(
             placement,
             routing,
@@ -1035,37 +1978,18 @@ def pipeline_pnr(
         )
         starting_regs = graph.added_regs
 
-        update_kernel_latencies(
-            app_dir,
-            graph,
-            id_to_name,
-            placement,
-            routing,
-            existing_kernel_latencies,
-            harden_flush,
-            instance_to_instr,
-            pipeline_config_interval,
-            pes_with_packed_ponds,
-            sparse,
-        )
+        latency_state.update(graph, id_to_name, placement, routing)
 
         for _ in range(max_itr):
             curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
-            break_crit_path(graph, id_to_name, crit_path, placement, routing)
+            break_idx = choose_break_idx(
+                graph, crit_path, west_in_io_sides, what_if, what_if_jobs
+            )
+            break_crit_path(
+                graph, id_to_name, crit_path, placement, routing, break_idx
+            )
 
-        update_kernel_latencies(
-            app_dir,
-            graph,
-            id_to_name,
-            placement,
-            routing,
-            existing_kernel_latencies,
-            harden_flush,
-            instance_to_instr,
-            pipeline_config_interval,
-            pes_with_packed_ponds,
-            sparse,
-        )
+        latency_state.update(graph, id_to_name, placement, routing)
         print("\nFinal application frequency:")
         curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
 
@@ -1077,14 +2001,38 @@ def pipeline_pnr(
         print(
             "\nAdded", graph.added_regs - starting_regs, "registers to routing graph\n"
         )
-    elif os.environ.get("EXHAUSTIVE_PIPE") and os.environ["EXHAUSTIVE_PIPE"] != "0":
+    elif config.exhaustive_pipe:
         starting_regs = graph.added_regs
-        exhaustive_pipe(graph, id_to_name, placement, routing)
+        max_regs = config.exhaustive_max_regs
+        max_latency = config.exhaustive_max_latency
+        exhaustive_pipe(
+            graph,
+            id_to_name,
+            placement,
+            routing,
+            max_regs=max_regs,
+            max_latency=max_latency,
+            west_in_io_sides=west_in_io_sides,
+        )
+        latency_state.update(graph, id_to_name, placement, routing)
         curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
         print(
             "\nAdded", graph.added_regs - starting_regs, "registers to routing graph\n"
         )
 
+    if config.retime:
+        retime_registers(
+            graph,
+            west_in_io_sides,
+            rebalance=functools.partial(
+                latency_state.update, graph, id_to_name, placement, routing
+            ),
+        )
+        print("\nApplication frequency after retiming:")
+        curr_freq, crit_path, crit_nets = sta(graph, west_in_io_sides)
+
+    latency_state.write()
+
     freq_file = os.path.join(app_dir, "design.freq")
     fout = open(freq_file, "w")
     fout.write(f"{curr_freq}\n")
@@ -1092,4 +2040,4 @@ def pipeline_pnr(
     dump_routing_result(app_dir, routing)
     dump_placement_result(app_dir, placement, id_to_name)
 
-    return placement, routing, id_to_name
+    return dict(placement), dict(routing), dict(id_to_name)
@@ -1,17 +1,34 @@
 import os
-import subprocess
 import pythunder
+from .cache import cached_check_call, cached_exec
+from .watchdog import Watchdog
 
 
-def place(packed_filename: str, layout_filename: str, placement_filename: str,
-          fixed: bool = False):
+def placer_args(packed_filename: str, layout_filename: str,
+                placement_filename: str, fixed: bool = False):
     path = os.path.abspath(os.path.dirname(pythunder.__file__))
     placer_binary = os.path.join(path, "placer")
     assert os.path.isfile(placer_binary), placer_binary + " not found"
     if fixed:
-        subprocess.check_call([placer_binary, "-f", layout_filename,
-                               packed_filename,
-                               placement_filename])
+        return [placer_binary, "-f", layout_filename, packed_filename,
+                placement_filename]
     else:
-        subprocess.check_call([placer_binary, layout_filename,
-                               packed_filename, placement_filename])
+        return [placer_binary, layout_filename, packed_filename,
+                placement_filename]
+
+
+def place(packed_filename: str, layout_filename: str, placement_filename: str,
+          fixed: bool = False, env=None):
+    cached_check_call(placer_args(packed_filename, layout_filename,
+                                  placement_filename, fixed),
+                      [placement_filename], env=env,
+                      watchdog=Watchdog.for_placer(env))
+
+
+async def place_async(packed_filename: str, layout_filename: str,
+                      placement_filename: str, fixed: bool = False,
+                      env=None, timeout=None):
+    await cached_exec(placer_args(packed_filename, layout_filename,
+                                  placement_filename, fixed),
+                      [placement_filename], env=env,
+                      watchdog=Watchdog.for_placer(env, timeout))
@@ -1,16 +1,31 @@
 import tempfile
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os, re
 import shutil
+import subprocess
+import time
 from .io import dump_packed_result
-from .place import place
-from .route import route
+from .place import place, place_async, placer_args
+from .route import route, route_async, router_args
 from .io import dump_packing_result, load_routing_result, dump_placement_result, generate_packed_from_place_and_route
 from .util import parse_routing_result, get_max_num_col, get_group_size
 import pycyclone
 import pythunder
-from archipelago.pipeline import pipeline_pnr
+from archipelago.pipeline import pipeline_pnr, write_json_atomic
 from .sta import sta, run_sta
 from .pnr_graph import construct_graph
+from .config import PnRConfig
+from .cache import cached_dump_pnr, hash_file, interconnect_fingerprint, tool_env
+from .journal import Journal, journal_key
+from .watchdog import Watchdog, classify, failure_kind
 from canal.util import IOSide
 from typing import List
 
@@ -39,76 +54,57 @@ def pnr(
     pes_with_packed_ponds=None,
     sparse=False,
     west_in_io_sides=False,
+    config=None,
+    arch_dir=None,
 ):
     if input_netlist is None and len(packed_file):
         raise ValueError("Invalid input")
 
+    if config is None:
+        config = PnRConfig.from_env()
     kargs = locals()
-    use_temp = False
-    app_name = "design" if len(app_name) == 0 else app_name
-
-    if len(cwd) == 0:
-        # get a temp cwd
-        use_temp = True
-        cwd_dir = tempfile.TemporaryDirectory()
-        cwd = cwd_dir.name
-    else:
-        cwd_dir = None
-
-    if not isinstance(arch, str):
-        # attempt to treat it as an interconnect object
-        if hasattr(arch, "dump_pnr"):
-            # if virtualization is turned on with canal, we can dynamically
-            # dump the adjusted size and partition
-            # we assume the netlist is already partitioned
-            # if compact is enabled, we need to compute the max_num_col
-            # and re-turn the function until we can have it
-            if compact:
-                kargs["compact"] = False
-                for n in {"arch", "input_netlist"}:
-                    kargs.pop(n)
-                return __compact_pnr(arch, input_netlist, **kargs)
-            arch.dump_pnr(cwd, "design", max_num_col=max_num_col)
-            arch_file = os.path.join(cwd, "design.info")
-        else:
-            raise Exception("arch has to be either string or interconnect")
-    else:
-        arch_file = arch
 
-    # prepare for the netlist
-    if len(packed_file) == 0:
-        packed_file = dump_packed_result(
-            app_name, cwd, input_netlist, id_to_name, copy_to_dir=copy_to_dir
-        )
-    # get the layout and routing file
-    with open(arch_file) as f:
-        layout_line = f.readline()
-        layout_filename = layout_line.split("=")[-1].strip()
-        assert os.path.isfile(layout_filename)
-        graph_path_line = f.readline()
-        graph_path = graph_path_line.split("=")[-1].strip()
-
-    # get placement name
-    placement_filename = os.path.join(cwd, app_name + ".place")
-    route_filename = os.path.join(cwd, app_name + ".route")
-    if max_frequency is not None:
-        wave_filename = os.path.join(cwd, app_name + ".wave")
-    else:
-        wave_filename = None
+    # if virtualization is turned on with canal, we can dynamically
+    # dump the adjusted size and partition
+    # we assume the netlist is already partitioned
+    # if compact is enabled, we need to compute the max_num_col
+    # and re-turn the function until we can have it
+    if compact and not isinstance(arch, str) and hasattr(arch, "dump_pnr"):
+        kargs["compact"] = False
+        for n in {"arch", "input_netlist"}:
+            kargs.pop(n)
+        return __compact_pnr(arch, input_netlist, **kargs)
 
-    if id_to_name is None:
-        id_to_name = pythunder.io.load_id_to_name(
-            os.path.join(cwd, app_name + ".packed")
-        )
+    run = _PnRRun(
+        arch,
+        input_netlist,
+        packed_file,
+        cwd,
+        app_name,
+        id_to_name,
+        max_num_col,
+        copy_to_dir,
+        max_frequency,
+        config,
+        arch_dir,
+    )
+    cwd = run.cwd
+    app_name = run.app_name
+    packed_file = run.packed_file
+    layout_filename = run.layout_filename
+    graph_path = run.graph_path
+    placement_filename = run.placement_filename
+    route_filename = run.route_filename
+    wave_filename = run.wave_filename
+    id_to_name = run.id_to_name
 
-    pnr_placer_exp_set = False
     if not load_only:
         # Three cases:
         # 1. PNR PLACER EXP is set by the user
         # 2. SWEEP_PNR_PLACER_EXP is set
         # 3. Neither is set and we find the first value that routes
 
-        if "PNR_PLACER_EXP" in os.environ and os.environ["PNR_PLACER_EXP"].isnumeric():
+        if config.placer_exp is not None:
             if fixed_pos is not None:
                 assert isinstance(fixed_pos, dict)
                 dump_placement_result(fixed_pos, placement_filename, id_to_name)
@@ -117,9 +113,9 @@ def pnr(
                 has_fixed = False
 
             # PNR_PLACER_EXP is set by the user
-            print("Using PNR_PLACER_EXP:", os.environ["PNR_PLACER_EXP"])
-            pnr_placer_exp_set = True
-            place(packed_file, layout_filename, placement_filename, has_fixed)
+            print("Using PNR_PLACER_EXP:", config.placer_exp)
+            env = config.subprocess_env()
+            place(packed_file, layout_filename, placement_filename, has_fixed, env=env)
             if not os.path.isfile(placement_filename):
                 raise PnRException()
             route(
@@ -131,91 +127,32 @@ def pnr(
                 layout_filename,
                 wave_info=wave_filename,
                 shift_registers=shift_registers,
+                env=env,
             )
 
-        elif "SWEEP_PNR_PLACER_EXP" in os.environ:
+        elif config.sweep_placer_exp:
             # Sweep PNR_PLACER_EXP to find optimal frequency
             print("Finding optimal placement exponent parameter")
-            pnr_placer_exp = 1
-            max_freq = 0
-            opt_pnr_placer_exp = 1
-
-            while pnr_placer_exp <= 30:
-                os.environ["PNR_PLACER_EXP"] = str(pnr_placer_exp)
-
-                if os.path.isfile(placement_filename):
-                    os.remove(placement_filename)
-
-                if fixed_pos is not None:
-                    assert isinstance(fixed_pos, dict)
-                    dump_placement_result(fixed_pos, placement_filename, id_to_name)
-                    has_fixed = True
-                else:
-                    has_fixed = False
-
-                print(
-                    "Trying placement with PnR placer exp:",
-                    os.environ["PNR_PLACER_EXP"],
-                )
-                place(packed_file, layout_filename, placement_filename, has_fixed)
-                if not os.path.isfile(placement_filename):
-                    raise PnRException()
-
-                try:
-                    route(
-                        packed_file,
-                        placement_filename,
-                        graph_path,
-                        route_filename,
-                        max_frequency,
-                        layout_filename,
-                        wave_info=wave_filename,
-                        shift_registers=shift_registers,
-                    )
-                    routed = True
-                except:
-                    print("Unable to route with PNR_PLACER_EXP:", pnr_placer_exp)
-                    routed = False
-
-                if routed:
-                    placement_result = pycyclone.io.load_placement(placement_filename)
-                    routing_result = load_routing_result(route_filename)
-                    placement_result, routing_result, id_to_name = pipeline_pnr(
-                        cwd,
-                        placement_result,
-                        routing_result,
-                        id_to_name,
-                        input_netlist[0],
-                        load_only,
-                        harden_flush,
-                        instance_to_instr,
-                        pipeline_config_interval,
-                        pes_with_packed_ponds,
-                        sparse,
-                        west_in_io_sides,
-                    )
-                    freq = run_sta(
-                        packed_file,
-                        placement_filename,
-                        route_filename,
-                        id_to_name,
-                        sparse,
-                        west_in_io_sides,
-                    )
-                    if freq > max_freq:
-                        max_freq = freq
-                        opt_pnr_placer_exp = pnr_placer_exp
-
-                if fixed_pos is not None:
-                    assert isinstance(fixed_pos, dict)
-                    dump_placement_result(fixed_pos, placement_filename, id_to_name)
-                    has_fixed = True
-                else:
-                    has_fixed = False
-
-                pnr_placer_exp += 1
+            trial_dir, max_freq, opt_pnr_placer_exp = __sweep_placer_exp(
+                cwd,
+                app_name,
+                packed_file,
+                layout_filename,
+                graph_path,
+                max_frequency,
+                shift_registers,
+                fixed_pos,
+                id_to_name,
+                input_netlist[0],
+                harden_flush,
+                instance_to_instr,
+                pipeline_config_interval,
+                pes_with_packed_ponds,
+                sparse,
+                west_in_io_sides,
+                config,
+            )
 
-            # Reloading optimal result
             print("\nFinal maximum frequency:", max_freq, "MHz")
             print("Final optimal PNR_PLACER_EXP:", opt_pnr_placer_exp, "\n")
 
@@ -223,18 +160,40 @@ def pnr(
             f_pnr = open(pnr_exp_file, "w")
             f_pnr.write(str(opt_pnr_placer_exp))
 
-            os.environ["PNR_PLACER_EXP"] = str(opt_pnr_placer_exp)
-            place(packed_file, layout_filename, placement_filename, has_fixed)
-            route(
+            # Promote the winning trial's place and route results
+            for filename in (placement_filename, route_filename, wave_filename):
+                if filename is None:
+                    continue
+                trial_file = os.path.join(trial_dir, os.path.basename(filename))
+                if os.path.isfile(trial_file):
+                    shutil.copy2(trial_file, filename)
+            shutil.rmtree(os.path.dirname(trial_dir))
+
+        elif config.speculative_jobs > 1:
+            # Find the first value that routes, trying several at once
+            pnr_placer_exp = __speculative_placer_exp(
+                cwd,
+                app_name,
                 packed_file,
-                placement_filename,
+                layout_filename,
                 graph_path,
-                route_filename,
                 max_frequency,
-                layout_filename,
-                wave_info=wave_filename,
-                shift_registers=shift_registers,
+                shift_registers,
+                fixed_pos,
+                id_to_name,
+                config,
             )
+            if pnr_placer_exp is not None:
+                trial_dir = os.path.join(
+                    cwd, "pnr_search", f"exp_{pnr_placer_exp}"
+                )
+                for filename in (placement_filename, route_filename, wave_filename):
+                    if filename is None:
+                        continue
+                    trial_file = os.path.join(trial_dir, os.path.basename(filename))
+                    if os.path.isfile(trial_file):
+                        shutil.copy2(trial_file, filename)
+            shutil.rmtree(os.path.join(cwd, "pnr_search"))
 
         else:
             # Find first value of PNR_PLACER_DENSITY that routes
@@ -251,12 +210,12 @@ def pnr(
                 else:
                     has_fixed = False
 
-                os.environ["PNR_PLACER_EXP"] = str(pnr_placer_density)
+                env = config.replace(PNR_PLACER_EXP=pnr_placer_density).subprocess_env()
                 print(
                     "Trying placement with PnR placer exp:",
-                    os.environ["PNR_PLACER_EXP"],
+                    pnr_placer_density,
                 )
-                place(packed_file, layout_filename, placement_filename, has_fixed)
+                place(packed_file, layout_filename, placement_filename, has_fixed, env=env)
                 if not os.path.isfile(placement_filename):
                     raise PnRException()
 
@@ -270,77 +229,1086 @@ def pnr(
                         layout_filename,
                         wave_info=wave_filename,
                         shift_registers=shift_registers,
+                        env=env,
                     )
                     break
-                except:
-                    print("Unable to route with PNR_PLACER_EXP:", pnr_placer_density)
+                except Exception as e:
+                    print(
+                        "Unable to route with PNR_PLACER_EXP:",
+                        pnr_placer_density,
+                        f"({failure_kind(e)})",
+                    )
 
                 pnr_placer_density += 1
 
-    if "PNR_PLACER_EXP" in os.environ and not pnr_placer_exp_set:
-        del os.environ["PNR_PLACER_EXP"]
+    return run.finish(
+        arch,
+        input_netlist,
+        load_only,
+        harden_flush,
+        instance_to_instr,
+        pipeline_config_interval,
+        pes_with_packed_ponds,
+        sparse,
+        west_in_io_sides,
+    )
 
-    # making sure the placement result is there
-    if not os.path.isfile(placement_filename):
-        raise PnRException()
 
-    # making sure the routing result is there
-    if not os.path.isfile(route_filename):
-        raise PnRException()
+async def pnr_async(
+    arch,
+    input_netlist=None,
+    progress=None,
+    place_timeout=None,
+    route_timeout=None,
+    **kargs,
+):
+    """pnr() as a coroutine, so many apps can be placed and routed from one
+    event loop. The placer and router run through
+    asyncio.create_subprocess_exec, the architecture dump and pipelining
+    run in the loop's default executor.
 
-    # need to load it back up
-    placement_result = pycyclone.io.load_placement(placement_filename)
-    routing_result = load_routing_result(route_filename)
+    Cancelling the task kills a running placer or router. The runs are
+    watched as in pnr() and failures raise PnRToolError, place_timeout and
+    route_timeout override PNR_PLACE_TIMEOUT and PNR_ROUTE_TIMEOUT. While
+    searching for the first PNR_PLACER_EXP that routes, a failed route
+    moves on to the next exponent. progress, if
+    given, is called with a dict with app, stage, status and placer_exp
+    whenever a stage starts, ends or fails.
 
-    if id_to_name is not None:
-        placement_result, routing_result, id_to_name = pipeline_pnr(
-            cwd,
-            placement_result,
-            routing_result,
-            id_to_name,
-            input_netlist[0],
-            load_only,
-            harden_flush,
-            instance_to_instr,
-            pipeline_config_interval,
-            pes_with_packed_ponds,
-            sparse,
-            west_in_io_sides,
-        )
-        packed_file = dump_packed_result(
-            app_name, cwd, input_netlist, id_to_name, copy_to_dir=copy_to_dir
-        )
-        post_pipelining_packed_file = os.path.join(cwd, app_name + "_post_pipe.packed")
-        generate_packed_from_place_and_route(cwd, placement_filename, route_filename, post_pipelining_packed_file)
+    compact, the placer exp sweep and the speculative search run the
+    blocking pnr() in the executor."""
+    loop = asyncio.get_running_loop()
+    bound = inspect.signature(pnr).bind(arch, input_netlist, **kargs)
+    bound.apply_defaults()
+    args = bound.arguments
+    if args["config"] is None:
+        args["config"] = PnRConfig.from_env()
+    config = args["config"]
+
+    if (
+        (args["compact"] and not isinstance(arch, str) and hasattr(arch, "dump_pnr"))
+        or (not args["load_only"] and config.placer_exp is None and (
+            config.sweep_placer_exp or config.speculative_jobs > 1
+        ))
+    ):
+        return await loop.run_in_executor(None, functools.partial(pnr, **args))
 
-    # tear down
-    if use_temp:
-        if os.path.isdir(cwd):
-            assert cwd_dir is not None
-            cwd_dir.__exit__(None, None, None)
+    if input_netlist is None and len(args["packed_file"]):
+        raise ValueError("Invalid input")
 
-    if hasattr(arch, "dump_pnr"):
-        routing_result = parse_routing_result(routing_result, arch)
+    app_name = args["app_name"] or "design"
 
-    # copy files over
-    if copy_to_dir is not None:
-        shutil.copy2(placement_filename, copy_to_dir)
-        shutil.copy2(route_filename, copy_to_dir)
-        if wave_filename is not None:
-            shutil.copy2(wave_filename, copy_to_dir)
+    def report(stage, status, placer_exp=None):
+        if progress is not None:
+            progress(
+                {
+                    "app": app_name,
+                    "stage": stage,
+                    "status": status,
+                    "placer_exp": placer_exp,
+                }
+            )
 
-    return placement_result, routing_result, id_to_name
+    report("setup", "start")
+    run = await loop.run_in_executor(
+        None,
+        functools.partial(
+            _PnRRun,
+            arch,
+            input_netlist,
+            args["packed_file"],
+            args["cwd"],
+            args["app_name"],
+            args["id_to_name"],
+            args["max_num_col"],
+            args["copy_to_dir"],
+            args["max_frequency"],
+            config,
+            args["arch_dir"],
+        ),
+    )
+    report("setup", "done")
+
+    if not args["load_only"]:
+        if config.placer_exp is not None:
+            print("Using PNR_PLACER_EXP:", config.placer_exp)
+            exps = [config.placer_exp]
+        else:
+            exps = range(31)
+        search = config.placer_exp is None
+
+        for exp in exps:
+            if search and os.path.isfile(run.placement_filename):
+                os.remove(run.placement_filename)
+            fixed_pos = args["fixed_pos"]
+            if fixed_pos is not None:
+                assert isinstance(fixed_pos, dict)
+                dump_placement_result(fixed_pos, run.placement_filename, run.id_to_name)
+            if search:
+                print("Trying placement with PnR placer exp:", exp)
+            env = config.replace(PNR_PLACER_EXP=exp).subprocess_env()
+
+            report("place", "start", exp)
+            try:
+                await place_async(
+                    run.packed_file,
+                    run.layout_filename,
+                    run.placement_filename,
+                    fixed_pos is not None,
+                    env=env,
+                    timeout=place_timeout,
+                )
+            except Exception:
+                report("place", "failed", exp)
+                raise
+            if not os.path.isfile(run.placement_filename):
+                report("place", "failed", exp)
+                raise PnRException()
+            report("place", "done", exp)
+
+            report("route", "start", exp)
+            try:
+                await route_async(
+                    run.packed_file,
+                    run.placement_filename,
+                    run.graph_path,
+                    run.route_filename,
+                    args["max_frequency"],
+                    run.layout_filename,
+                    wave_info=run.wave_filename,
+                    shift_registers=args["shift_registers"],
+                    env=env,
+                    timeout=route_timeout,
+                )
+            except Exception as e:
+                report("route", "failed", exp)
+                if not search:
+                    raise
+                print(
+                    "Unable to route with PNR_PLACER_EXP:",
+                    exp,
+                    f"({failure_kind(e)})",
+                )
+                continue
+            report("route", "done", exp)
+            break
+
+    report("pipeline", "start")
+    result = await loop.run_in_executor(
+        None,
+        functools.partial(
+            run.finish,
+            arch,
+            input_netlist,
+            args["load_only"],
+            args["harden_flush"],
+            args["instance_to_instr"],
+            args["pipeline_config_interval"],
+            args["pes_with_packed_ponds"],
+            args["sparse"],
+            args["west_in_io_sides"],
+        ),
+    )
+    report("pipeline", "done")
+    return result
+
+
+class _PnRRun:
+    # Working directory and files of one pnr() call. Sets up everything
+    # before placement, finish() loads the place and route results and
+    # pipelines them. Shared by pnr() and pnr_async().
+    def __init__(
+        self,
+        arch,
+        input_netlist,
+        packed_file,
+        cwd,
+        app_name,
+        id_to_name,
+        max_num_col,
+        copy_to_dir,
+        max_frequency,
+        config,
+        arch_dir,
+    ):
+        self.config = config
+        self.copy_to_dir = copy_to_dir
+        self.use_temp = False
+        app_name = "design" if len(app_name) == 0 else app_name
+
+        if len(cwd) == 0:
+            # get a temp cwd
+            self.use_temp = True
+            self.cwd_dir = tempfile.TemporaryDirectory()
+            cwd = self.cwd_dir.name
+        else:
+            self.cwd_dir = None
+
+        if not isinstance(arch, str):
+            # attempt to treat it as an interconnect object
+            if hasattr(arch, "dump_pnr"):
+                if arch_dir is None:
+                    arch_dir = cwd
+                    cached_dump_pnr(arch, arch_dir, max_num_col, config.env)
+                arch_file = os.path.join(arch_dir, "design.info")
+            else:
+                raise Exception("arch has to be either string or interconnect")
+        else:
+            arch_file = arch
+
+        # prepare for the netlist
+        if len(packed_file) == 0:
+            packed_file = dump_packed_result(
+                app_name, cwd, input_netlist, id_to_name, copy_to_dir=copy_to_dir
+            )
+        # get the layout and routing file
+        with open(arch_file) as f:
+            layout_line = f.readline()
+            layout_filename = layout_line.split("=")[-1].strip()
+            assert os.path.isfile(layout_filename)
+            graph_path_line = f.readline()
+            graph_path = graph_path_line.split("=")[-1].strip()
+
+        # get placement name
+        placement_filename = os.path.join(cwd, app_name + ".place")
+        route_filename = os.path.join(cwd, app_name + ".route")
+        if max_frequency is not None:
+            wave_filename = os.path.join(cwd, app_name + ".wave")
+        else:
+            wave_filename = None
+
+        if id_to_name is None:
+            id_to_name = pythunder.io.load_id_to_name(
+                os.path.join(cwd, app_name + ".packed")
+            )
+
+        self.cwd = cwd
+        self.app_name = app_name
+        self.packed_file = packed_file
+        self.layout_filename = layout_filename
+        self.graph_path = graph_path
+        self.placement_filename = placement_filename
+        self.route_filename = route_filename
+        self.wave_filename = wave_filename
+        self.id_to_name = id_to_name
+
+    def finish(
+        self,
+        arch,
+        input_netlist,
+        load_only,
+        harden_flush,
+        instance_to_instr,
+        pipeline_config_interval,
+        pes_with_packed_ponds,
+        sparse,
+        west_in_io_sides,
+    ):
+        cwd = self.cwd
+        app_name = self.app_name
+        placement_filename = self.placement_filename
+        route_filename = self.route_filename
+        wave_filename = self.wave_filename
+        id_to_name = self.id_to_name
+        copy_to_dir = self.copy_to_dir
+
+        # making sure the placement result is there
+        if not os.path.isfile(placement_filename):
+            raise PnRException()
+
+        # making sure the routing result is there
+        if not os.path.isfile(route_filename):
+            raise PnRException()
+
+        # need to load it back up
+        placement_result = pycyclone.io.load_placement(placement_filename)
+        routing_result = load_routing_result(route_filename)
+
+        if id_to_name is not None:
+            placement_result, routing_result, id_to_name = pipeline_pnr(
+                cwd,
+                placement_result,
+                routing_result,
+                id_to_name,
+                input_netlist[0],
+                load_only,
+                harden_flush,
+                instance_to_instr,
+                pipeline_config_interval,
+                pes_with_packed_ponds,
+                sparse,
+                west_in_io_sides,
+                self.config,
+            )
+            packed_file = dump_packed_result(
+                app_name, cwd, input_netlist, id_to_name, copy_to_dir=copy_to_dir
+            )
+            post_pipelining_packed_file = os.path.join(cwd, app_name + "_post_pipe.packed")
+            generate_packed_from_place_and_route(cwd, placement_filename, route_filename, post_pipelining_packed_file)
+
+        # tear down
+        if self.use_temp:
+            if os.path.isdir(cwd):
+                assert self.cwd_dir is not None
+                self.cwd_dir.__exit__(None, None, None)
+
+        if hasattr(arch, "dump_pnr"):
+            routing_result = parse_routing_result(routing_result, arch)
+
+        # copy files over
+        if copy_to_dir is not None:
+            shutil.copy2(placement_filename, copy_to_dir)
+            shutil.copy2(route_filename, copy_to_dir)
+            if wave_filename is not None:
+                shutil.copy2(wave_filename, copy_to_dir)
+
+        return placement_result, routing_result, id_to_name
 
 
 def __compact_pnr(arch, input_netlist, **kargs):
     group_size = get_group_size(arch)
     start_size = get_max_num_col(input_netlist[0], arch)
     # notice that python range is exclusive
-    for col in range(start_size, arch.x_max + 1 + 1, group_size):
+    cols = list(range(start_size, arch.x_max + 1 + 1, group_size))
+    if kargs["config"].compact_jobs is not None:
+        return __bisect_compact_pnr(arch, input_netlist, cols, **kargs)
+    journal = None
+    if len(kargs["cwd"]) > 0:
+        journal_dir = os.path.join(kargs["cwd"], "pnr_compact")
+        journal = __compact_journal(journal_dir, arch, input_netlist, kargs)
+    for col in cols:
+        entry = journal.get(col) if journal is not None else None
+        if entry is not None and not entry["fits"]:
+            print("Skipping column count known not to fit:", col)
+            continue
         try:
             # force it to use the desired column
             kargs["max_num_col"] = col
-            return pnr(arch, input_netlist, **kargs)
+            result = pnr(arch, input_netlist, **kargs)
         except PnRException:
-            pass
+            if journal is not None:
+                journal.record(col, fits=False)
+            continue
+        if journal is not None:
+            shutil.rmtree(journal_dir)
+        return result
+    if journal is not None:
+        shutil.rmtree(journal_dir)
     raise PnRException()
+
+
+def __compact_journal(journal_dir, arch, input_netlist, kargs):
+    # Column counts tried by an earlier, interrupted run of the same search.
+    # Everything else left in journal_dir by that run is removed.
+    os.makedirs(journal_dir, exist_ok=True)
+    journal = Journal(
+        os.path.join(journal_dir, "journal.jsonl"),
+        journal_key(
+            [],
+            kargs["config"],
+            interconnect_fingerprint(arch),
+            input_netlist,
+            sorted(
+                (name, value)
+                for name, value in kargs.items()
+                if name not in {"cwd", "copy_to_dir", "max_num_col", "arch_dir", "config"}
+            ),
+        ),
+    )
+    for filename in os.listdir(journal_dir):
+        path = os.path.join(journal_dir, filename)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif filename != "journal.jsonl":
+            os.remove(path)
+    return journal
+
+
+def __compact_probe(arch, input_netlist, col, probe_dir, arch_dir, kargs):
+    # pnr() at one column count, None if it doesn't fit
+    kargs = dict(
+        kargs, max_num_col=col, cwd=probe_dir, arch_dir=arch_dir, copy_to_dir=None
+    )
+    try:
+        return pnr(arch, input_netlist, **kargs)
+    except PnRException:
+        return None
+
+
+def __bisect_compact_pnr(arch, input_netlist, cols, **kargs):
+    # Whether a design fits only goes up with the column count. Each round
+    # runs PNR_COMPACT_JOBS pnr() probes spread over the column counts that
+    # are still open, in threads and each in its own directory, then keeps
+    # the range between the widest failure and the narrowest success.
+    cwd = kargs["cwd"]
+    copy_to_dir = kargs["copy_to_dir"]
+    app_name = "design" if len(kargs["app_name"]) == 0 else kargs["app_name"]
+    jobs = max(1, kargs["config"].compact_jobs)
+
+    journal = None
+    if len(cwd) > 0:
+        probe_root = os.path.abspath(os.path.join(cwd, "pnr_compact"))
+        journal = __compact_journal(probe_root, arch, input_netlist, kargs)
+    else:
+        probe_root = os.path.abspath(tempfile.mkdtemp(prefix="pnr_compact_"))
+    # Architecture dumped once per column count and shared by its probes
+    arch_dirs = {}
+    # Column index -> (probe directory, pnr result) for successful probes
+    results = {}
+    lo, hi = 0, len(cols)
+    if journal is not None:
+        for idx, col in enumerate(cols):
+            entry = journal.get(col)
+            if entry is not None and entry["fits"]:
+                hi = min(hi, idx)
+        for idx, col in enumerate(cols):
+            entry = journal.get(col)
+            if entry is not None and not entry["fits"] and idx < hi:
+                lo = max(lo, idx + 1)
+        if journal.resumed:
+            print("Resuming column search, already tried:", sorted(journal.entries))
+    finished = False
+    try:
+        # A fit known from the journal is probed again for its result
+        while lo < hi or (hi < len(cols) and hi not in results):
+            n = min(jobs, hi - lo)
+            if lo == hi:
+                probes = [hi]
+            elif n == hi - lo:
+                probes = list(range(lo, hi))
+            else:
+                probes = [lo + (hi - lo) * (k + 1) // (n + 1) for k in range(n)]
+
+            probe_dirs = {}
+            for idx in probes:
+                col = cols[idx]
+                if col not in arch_dirs:
+                    arch_dirs[col] = os.path.join(probe_root, f"arch_{col}")
+                    os.makedirs(arch_dirs[col])
+                    cached_dump_pnr(
+                        arch, arch_dirs[col], col, kargs["config"].env
+                    )
+                probe_dirs[idx] = ""
+                if len(cwd) > 0:
+                    probe_dirs[idx] = os.path.join(probe_root, f"col_{col}")
+                    os.makedirs(probe_dirs[idx])
+                    for filename in os.listdir(cwd):
+                        if os.path.isfile(os.path.join(cwd, filename)):
+                            shutil.copy2(
+                                os.path.join(cwd, filename), probe_dirs[idx]
+                            )
+
+            print("Trying column counts:", [cols[idx] for idx in probes])
+            with concurrent.futures.ThreadPoolExecutor(len(probes)) as executor:
+                futures = {
+                    idx: executor.submit(
+                        __compact_probe,
+                        arch,
+                        input_netlist,
+                        cols[idx],
+                        probe_dirs[idx],
+                        arch_dirs[cols[idx]],
+                        kargs,
+                    )
+                    for idx in probes
+                }
+            outcomes = {idx: future.result() for idx, future in futures.items()}
+            if journal is not None:
+                for idx in probes:
+                    journal.record(cols[idx], fits=outcomes[idx] is not None)
+
+            for idx in probes:
+                if outcomes[idx] is not None and idx <= hi:
+                    hi = idx
+                    results[hi] = (probe_dirs[idx], outcomes[idx])
+            for idx in probes:
+                if outcomes[idx] is None and idx == hi:
+                    # Fit according to the journal but not anymore
+                    hi = len(cols)
+                if outcomes[idx] is None and lo <= idx < hi:
+                    lo = idx + 1
+
+        if hi == len(cols):
+            finished = True
+            raise PnRException()
+
+        col = cols[hi]
+        probe_dir, result = results[hi]
+        print("Smallest column count that fits:", col)
+        if len(cwd) > 0:
+            for filename in os.listdir(probe_dir):
+                if os.path.isfile(os.path.join(probe_dir, filename)):
+                    shutil.copy2(os.path.join(probe_dir, filename), cwd)
+            cached_dump_pnr(arch, cwd, col, kargs["config"].env)
+            if copy_to_dir is not None:
+                for ext in (".place", ".route", ".wave", ".packed"):
+                    filename = os.path.join(cwd, app_name + ext)
+                    if os.path.isfile(filename):
+                        shutil.copy2(filename, copy_to_dir)
+        finished = True
+        return result
+    finally:
+        # Keep the journal of an interrupted search
+        if finished or journal is None:
+            shutil.rmtree(probe_root)
+
+
+# Files of an app directory that pipeline_pnr reads
+PIPELINE_INPUTS = ("design.port_remap", "*_latencies.json", "ub_latency.json")
+
+# Arguments shared by every sweep trial. Only set inside forked workers,
+# which inherit it through the pool initializer so the netlist and
+# id_to_name don't have to be pickled for each trial.
+_sweep_state = None
+
+
+def __init_sweep_worker(state):
+    global _sweep_state
+    _sweep_state = state
+
+
+def __sweep_analyze_in_worker(pnr_placer_exp):
+    return __sweep_analyze(_sweep_state, pnr_placer_exp)
+
+
+def __sweep_trial_files(s, pnr_placer_exp):
+    trial_dir = os.path.join(s["sweep_dir"], f"exp_{pnr_placer_exp}")
+    app_name = s["app_name"]
+    placement_filename = os.path.join(trial_dir, app_name + ".place")
+    route_filename = os.path.join(trial_dir, app_name + ".route")
+    wave_filename = None
+    if s["max_frequency"] is not None:
+        wave_filename = os.path.join(trial_dir, app_name + ".wave")
+    return trial_dir, placement_filename, route_filename, wave_filename
+
+
+def __sweep_route(s, pnr_placer_exp):
+    # Place and route one PNR_PLACER_EXP value in its own directory.
+    # Returns "routed", "unroutable" or "unplaced". Only runs the external
+    # binaries, so several can run from threads.
+    trial_dir, placement_filename, route_filename, wave_filename = (
+        __sweep_trial_files(s, pnr_placer_exp)
+    )
+    pipeline_dir = os.path.join(trial_dir, "pipeline")
+    os.makedirs(pipeline_dir)
+    # pipeline_pnr reads and rewrites these in place, give it a copy. It
+    # writes design.place, design.route and design.freq from scratch.
+    for pattern in PIPELINE_INPUTS:
+        for filename in glob.glob(os.path.join(s["cwd"], pattern)):
+            shutil.copy2(filename, pipeline_dir)
+    env = s["config"].replace(PNR_PLACER_EXP=pnr_placer_exp).subprocess_env()
+
+    if s["fixed_pos"] is not None:
+        assert isinstance(s["fixed_pos"], dict)
+        dump_placement_result(s["fixed_pos"], placement_filename, s["id_to_name"])
+        has_fixed = True
+    else:
+        has_fixed = False
+
+    place(
+        s["packed_file"],
+        s["layout_filename"],
+        placement_filename,
+        has_fixed,
+        env=env,
+    )
+    if not os.path.isfile(placement_filename):
+        return "unplaced"
+
+    try:
+        route(
+            s["packed_file"],
+            placement_filename,
+            s["graph_path"],
+            route_filename,
+            s["max_frequency"],
+            s["layout_filename"],
+            wave_info=wave_filename,
+            shift_registers=s["shift_registers"],
+            env=env,
+        )
+    except Exception as e:
+        print(
+            "Unable to route with PNR_PLACER_EXP:",
+            pnr_placer_exp,
+            f"({failure_kind(e)})",
+        )
+        return "unroutable"
+    return "routed"
+
+
+def __sweep_analyze(s, pnr_placer_exp):
+    # Pipeline and run STA on a routed trial. Returns its frequency.
+    trial_dir, placement_filename, route_filename, _ = __sweep_trial_files(
+        s, pnr_placer_exp
+    )
+    pipeline_dir = os.path.join(trial_dir, "pipeline")
+    config = s["config"].replace(PNR_PLACER_EXP=pnr_placer_exp)
+
+    with open(os.path.join(trial_dir, "pnr.log"), "w") as log:
+        with contextlib.redirect_stdout(log):
+            placement_result = pycyclone.io.load_placement(placement_filename)
+            routing_result = load_routing_result(route_filename)
+            placement_result, routing_result, id_to_name = pipeline_pnr(
+                pipeline_dir,
+                placement_result,
+                routing_result,
+                dict(s["id_to_name"]),
+                s["netlist"],
+                False,
+                *s["pipeline_args"],
+                config,
+            )
+            return run_sta(
+                s["packed_file"],
+                os.path.join(pipeline_dir, "design.place"),
+                os.path.join(pipeline_dir, "design.route"),
+                id_to_name,
+                s["sparse"],
+                s["west_in_io_sides"],
+                config,
+            )
+
+
+def __sweep_trial(s, pnr_placer_exp):
+    # Both stages of one trial. Returns the frequency, None if the design
+    # didn't route, or -1 if placement failed.
+    result = __sweep_route(s, pnr_placer_exp)
+    if result == "unplaced":
+        return -1
+    if result == "unroutable":
+        return None
+    return __sweep_analyze(s, pnr_placer_exp)
+
+
+def __sweep_record(journal, s, pnr_placer_exp, freq):
+    # freq as returned by __sweep_trial, routed trials also keep the hashes
+    # of the files the winner is promoted from
+    hashes = {}
+    if freq is not None and freq != -1:
+        for filename in __sweep_trial_files(s, pnr_placer_exp)[1:]:
+            if filename is not None and os.path.isfile(filename):
+                hashes[os.path.basename(filename)] = hash_file(filename)
+    journal.record(pnr_placer_exp, freq=freq, hashes=hashes)
+
+
+def __sweep_trial_intact(s, pnr_placer_exp, entry):
+    trial_dir = __sweep_trial_files(s, pnr_placer_exp)[0]
+    for name, digest in entry["hashes"].items():
+        filename = os.path.join(trial_dir, name)
+        if not os.path.isfile(filename) or hash_file(filename) != digest:
+            return False
+    return True
+
+
+def __staged_sweep(state, exps, jobs, route_jobs, journal):
+    # Overlap the stages of different trials. Up to route_jobs threads run
+    # the placer and router, each routed trial is queued to a pool of jobs
+    # processes for pipelining and STA while the threads move on to the
+    # next exponents. The workers are daemonic and can't start pools of
+    # their own, so each one pipelines its trial serially.
+    state = dict(state, config=state["config"].replace(PIPELINE_WHAT_IF_JOBS=1))
+    freqs = {}
+
+    def analyzed(exp, freq):
+        freqs[exp] = freq
+        __sweep_record(journal, state, exp, freq)
+
+    # Fork the workers before starting the routing threads
+    with multiprocessing.get_context("fork").Pool(
+        jobs, initializer=__init_sweep_worker, initargs=(state,)
+    ) as pool:
+        with concurrent.futures.ThreadPoolExecutor(route_jobs) as executor:
+            routing = {
+                executor.submit(__sweep_route, state, exp): exp for exp in exps
+            }
+            analyses = []
+            for future in concurrent.futures.as_completed(routing):
+                exp = routing[future]
+                result = future.result()
+                if result == "unplaced":
+                    analyzed(exp, -1)
+                elif result == "unroutable":
+                    analyzed(exp, None)
+                else:
+                    analyses.append(
+                        pool.apply_async(
+                            __sweep_analyze_in_worker,
+                            (exp,),
+                            callback=functools.partial(analyzed, exp),
+                        )
+                    )
+        for analysis in analyses:
+            analysis.get()
+    return freqs
+
+
+def __sweep_placer_exp(
+    cwd,
+    app_name,
+    packed_file,
+    layout_filename,
+    graph_path,
+    max_frequency,
+    shift_registers,
+    fixed_pos,
+    id_to_name,
+    netlist,
+    harden_flush,
+    instance_to_instr,
+    pipeline_config_interval,
+    pes_with_packed_ponds,
+    sparse,
+    west_in_io_sides,
+    config,
+    max_exp=30,
+):
+    # Run one trial per PNR_PLACER_EXP value. PNR_SWEEP_ROUTE_JOBS placer
+    # and router runs overlap with pipelining and STA of routed trials in
+    # PNR_SWEEP_JOBS processes. Returns the winning trial directory, its frequency and
+    # its PNR_PLACER_EXP. Ties go to the smaller exponent.
+    sweep_dir = os.path.join(cwd, "pnr_sweep")
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    state = {
+        "sweep_dir": sweep_dir,
+        "cwd": cwd,
+        "app_name": app_name,
+        "packed_file": packed_file,
+        "layout_filename": layout_filename,
+        "graph_path": graph_path,
+        "max_frequency": max_frequency,
+        "shift_registers": shift_registers,
+        "fixed_pos": fixed_pos,
+        "id_to_name": id_to_name,
+        "netlist": netlist,
+        "sparse": sparse,
+        "west_in_io_sides": west_in_io_sides,
+        "config": config,
+        "pipeline_args": (
+            harden_flush,
+            instance_to_instr,
+            pipeline_config_interval,
+            pes_with_packed_ponds,
+            sparse,
+            west_in_io_sides,
+        ),
+    }
+
+    exps = list(range(1, max_exp + 1))
+    # Trials finished by an earlier, interrupted run of the same sweep
+    journal = Journal(
+        os.path.join(sweep_dir, "journal.jsonl"),
+        journal_key(
+            [packed_file, layout_filename] + graph_path.split()[1::2],
+            config,
+            max_frequency,
+            shift_registers,
+            fixed_pos,
+            id_to_name,
+            netlist,
+            state["pipeline_args"],
+        ),
+    )
+    freqs = {}
+    for exp in exps:
+        entry = journal.get(exp)
+        if entry is not None and __sweep_trial_intact(state, exp, entry):
+            freqs[exp] = entry["freq"]
+    for filename in os.listdir(sweep_dir):
+        if filename != "journal.jsonl" and filename not in {
+            f"exp_{exp}" for exp in freqs
+        }:
+            path = os.path.join(sweep_dir, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    if len(freqs) > 0:
+        print("Resuming sweep, already finished PNR_PLACER_EXP:", sorted(freqs))
+    remaining = [exp for exp in exps if exp not in freqs]
+
+    jobs = config.sweep_jobs
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(remaining)))
+
+    route_jobs = config.sweep_route_jobs
+    if route_jobs is None:
+        route_jobs = jobs
+    route_jobs = max(1, min(route_jobs, len(remaining)))
+
+    if len(remaining) > 0 and "fork" in multiprocessing.get_all_start_methods():
+        freqs.update(__staged_sweep(state, remaining, jobs, route_jobs, journal))
+    else:
+        for exp in remaining:
+            freqs[exp] = __sweep_trial(state, exp)
+            __sweep_record(journal, state, exp, freqs[exp])
+
+    max_freq = 0
+    opt_pnr_placer_exp = None
+    for exp in exps:
+        freq = freqs[exp]
+        if freq == -1:
+            raise PnRException()
+        if freq is None:
+            print("Unable to route with PNR_PLACER_EXP:", exp)
+            continue
+        print("PNR_PLACER_EXP:", exp, "frequency:", freq, "MHz")
+        if freq > max_freq:
+            max_freq = freq
+            opt_pnr_placer_exp = exp
+
+    if opt_pnr_placer_exp is None:
+        shutil.rmtree(sweep_dir)
+        raise PnRException()
+
+    return (
+        os.path.join(sweep_dir, f"exp_{opt_pnr_placer_exp}"),
+        max_freq,
+        opt_pnr_placer_exp,
+    )
+
+
+def __pnr_exp_history_key(
+    packed_file,
+    layout_filename,
+    graph_path,
+    fixed_pos,
+    max_frequency,
+    shift_registers,
+    config,
+):
+    # Same inputs as the placer and router cache keys, except the exponent
+    h = hashlib.sha256()
+    for filename in [packed_file, layout_filename] + graph_path.split()[1::2]:
+        h.update(hash_file(filename).encode())
+    env = tool_env(config.env)
+    env.pop("PNR_PLACER_EXP", None)
+    h.update(
+        json.dumps(
+            [sorted(env.items()), max_frequency, shift_registers],
+            default=str,
+        ).encode()
+    )
+    if fixed_pos is not None:
+        h.update(json.dumps(fixed_pos, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class _PlacerExpTrial:
+    # Placer then router for one PNR_PLACER_EXP value, run in its own
+    # directory as subprocesses so the search can cancel it
+    def __init__(
+        self, exp, trial_dir, placement_filename, place_args, route_args, config
+    ):
+        self.exp = exp
+        self.placement_filename = placement_filename
+        self.route_args = route_args
+        self.env = config.replace(PNR_PLACER_EXP=exp).subprocess_env()
+        self.log_filename = os.path.join(trial_dir, "pnr.log")
+        self.log = open(self.log_filename, "w")
+        self.stage = "place"
+        # None while running, then "routed", "unroutable" or "unplaced"
+        self.result = None
+        # "timeout", "unroutable" or "crash" when it didn't route
+        self.failure = None
+        self.proc = self.launch(place_args, Watchdog.for_placer(self.env))
+
+    def launch(self, args, watchdog):
+        self.watchdog = watchdog
+        if watchdog is not None:
+            watchdog.launched()
+        self.log_offset = self.log.tell()
+        return subprocess.Popen(
+            args, stdout=self.log, stderr=subprocess.STDOUT, env=self.env
+        )
+
+    def check_watchdog(self):
+        if self.watchdog.watches_output:
+            with open(self.log_filename, errors="replace") as f:
+                f.seek(self.log_offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    self.log_offset += len(line.encode())
+                    self.watchdog.feed(line)
+        verdict = self.watchdog.verdict()
+        if verdict is not None:
+            self.proc.kill()
+            self.proc.wait()
+        return verdict
+
+    def poll(self):
+        if self.result is not None:
+            return self.result
+        verdict = None
+        if self.proc.poll() is None:
+            if self.watchdog is None:
+                return None
+            verdict = self.check_watchdog()
+            if verdict is None:
+                return None
+        if self.stage == "place":
+            if verdict is not None or self.proc.returncode != 0 or not os.path.isfile(
+                self.placement_filename
+            ):
+                self.failure = verdict or classify(self.proc.returncode, "crash")
+                self.finish("unplaced")
+            else:
+                self.stage = "route"
+                self.proc = self.launch(
+                    self.route_args, Watchdog.for_router(self.env)
+                )
+        elif verdict is None and self.proc.returncode == 0:
+            self.finish("routed")
+        else:
+            self.failure = verdict or classify(self.proc.returncode, "unroutable")
+            self.finish("unroutable")
+        return self.result
+
+    def finish(self, result):
+        self.result = result
+        self.log.close()
+
+    def cancel(self):
+        if self.result is None:
+            self.proc.kill()
+            self.proc.wait()
+            self.finish("cancelled")
+
+
+def __speculative_placer_exp(
+    cwd,
+    app_name,
+    packed_file,
+    layout_filename,
+    graph_path,
+    max_frequency,
+    shift_registers,
+    fixed_pos,
+    id_to_name,
+    config,
+    max_exp=30,
+):
+    # Place and route up to PNR_SPECULATIVE_JOBS PNR_PLACER_EXP values at once, each under
+    # cwd/pnr_search/exp_N. Higher values are cancelled as soon as a lower
+    # one routes, and the lowest value that routes is returned once every
+    # value below it has failed, so the answer is the same as the serial
+    # search. Values known to fail for this design are skipped.
+    search_dir = os.path.join(cwd, "pnr_search")
+    if os.path.isdir(search_dir):
+        shutil.rmtree(search_dir)
+    os.makedirs(search_dir)
+
+    jobs = config.speculative_jobs
+    history_file = config.exp_history_file
+    history = {}
+    key = None
+    if history_file:
+        key = __pnr_exp_history_key(
+            packed_file,
+            layout_filename,
+            graph_path,
+            fixed_pos,
+            max_frequency,
+            shift_registers,
+            config,
+        )
+        if os.path.isfile(history_file):
+            with open(history_file) as f:
+                history = json.load(f)
+    known_failed = set(history.get(key, {}).get("failed", []))
+    exps = [exp for exp in range(max_exp + 1) if exp not in known_failed]
+    if len(known_failed) > 0:
+        print("Skipping PNR_PLACER_EXP values known not to route:", sorted(known_failed))
+
+    pending = list(exps)
+    active = {}
+    results = {}
+    # Why each unroutable value failed, only real "unroutable" failures
+    # are remembered, timeouts and crashes may go away on a rerun
+    failures = {}
+    winner = None
+    try:
+        while winner is None and (pending or active):
+            routed = [exp for exp, r in results.items() if r == "routed"]
+            while pending and len(active) < jobs and (
+                len(routed) == 0 or pending[0] < min(routed)
+            ):
+                exp = pending.pop(0)
+                trial_dir = os.path.join(search_dir, f"exp_{exp}")
+                os.makedirs(trial_dir)
+                placement_filename = os.path.join(trial_dir, app_name + ".place")
+                route_filename = os.path.join(trial_dir, app_name + ".route")
+                wave_filename = None
+                if max_frequency is not None:
+                    wave_filename = os.path.join(trial_dir, app_name + ".wave")
+                if fixed_pos is not None:
+                    assert isinstance(fixed_pos, dict)
+                    dump_placement_result(fixed_pos, placement_filename, id_to_name)
+                print("Trying placement with PnR placer exp:", exp)
+                active[exp] = _PlacerExpTrial(
+                    exp,
+                    trial_dir,
+                    placement_filename,
+                    placer_args(
+                        packed_file,
+                        layout_filename,
+                        placement_filename,
+                        fixed_pos is not None,
+                    ),
+                    router_args(
+                        packed_file,
+                        placement_filename,
+                        graph_path,
+                        route_filename,
+                        max_frequency,
+                        layout_filename,
+                        wave_info=wave_filename,
+                        shift_registers=shift_registers,
+                    ),
+                    config,
+                )
+
+            time.sleep(0.1)
+            for exp in sorted(active):
+                if exp not in active:
+                    # Cancelled by a lower value that routed
+                    continue
+                result = active[exp].poll()
+                if result is None:
+                    continue
+                trial = active.pop(exp)
+                results[exp] = result
+                failures[exp] = trial.failure
+                if result == "unplaced":
+                    raise PnRException()
+                if result == "unroutable":
+                    print(
+                        "Unable to route with PNR_PLACER_EXP:",
+                        exp,
+                        f"({trial.failure})",
+                    )
+                else:
+                    for higher in [e for e in active if e > exp]:
+                        active.pop(higher).cancel()
+
+            for exp in exps:
+                if results.get(exp) == "routed":
+                    winner = exp
+                if results.get(exp) != "unroutable":
+                    break
+    finally:
+        for trial in active.values():
+            trial.cancel()
+
+    if key is not None:
+        failed = known_failed | {
+            e for e, failure in failures.items() if failure == "unroutable"
+        }
+        history[key] = {"failed": sorted(failed), "routable": winner}
+        os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+        write_json_atomic(history_file, history)
+
+    return winner
@@ -145,11 +145,220 @@ class TileNode:
         return f"{self.tile_id}"
 
 
+class UndoJournal:
+    """Undo closures for the edits made to a design's placement, routing and
+    id_to_name, newest last. Rolling back to a checkpoint costs time in the
+    number of edits since it, nothing is copied up front. Graphs built on
+    the rolled back data have to be reconstructed."""
+
+    def __init__(self):
+        self.undo = []
+
+    def record(self, undo):
+        self.undo.append(undo)
+
+    def checkpoint(self):
+        return len(self.undo)
+
+    def rollback(self, checkpoint=0):
+        while len(self.undo) > checkpoint:
+            self.undo.pop()()
+
+
+class JournaledDict(dict):
+    """dict that records how to undo every key it sets or deletes"""
+
+    def __init__(self, data, journal):
+        super().__init__(data)
+        self.journal = journal
+
+    def __setitem__(self, key, value):
+        if key in self:
+            old_value = self[key]
+            self.journal.record(lambda: dict.__setitem__(self, key, old_value))
+        else:
+            self.journal.record(lambda: dict.__delitem__(self, key))
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        old_value = self[key]
+        self.journal.record(lambda: dict.__setitem__(self, key, old_value))
+        super().__delitem__(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class RouteIndex:
+    """Maps a routing segment to the first (net_id, route index, position)
+    it appears at, so registers can be spliced into the routing result
+    without scanning every net. Positions are kept valid across insertions:
+    a splice only shifts the entries of the one route that was modified."""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.locations = {}
+        for net_id, net in routes.items():
+            for route_idx, route in enumerate(net):
+                for pos, segment in enumerate(route):
+                    self.locations.setdefault(tuple(segment), [net_id, route_idx, pos])
+
+    def find(self, segment):
+        location = self.locations.get(tuple(segment))
+        if location is None:
+            return None
+        return tuple(location)
+
+    def insert_after(self, segment, new_segment):
+        location = self.locations.get(tuple(segment))
+        if location is None:
+            return False
+
+        net_id, route_idx, pos = location
+        route = self.routes[net_id][route_idx]
+        route.insert(pos + 1, new_segment)
+        journal = getattr(self.routes, "journal", None)
+        if journal is not None:
+            journal.record(lambda: route.pop(pos + 1))
+
+        for shifted in route[pos + 2 :]:
+            shifted_location = self.locations[tuple(shifted)]
+            if shifted_location[0] == net_id and shifted_location[1] == route_idx:
+                shifted_location[2] += 1
+
+        self.locations.setdefault(tuple(new_segment), [net_id, route_idx, pos + 1])
+        return True
+
+    def remove(self, segment):
+        location = self.locations.pop(tuple(segment), None)
+        if location is None:
+            return False
+
+        net_id, route_idx, pos = location
+        route = self.routes[net_id][route_idx]
+        removed = route.pop(pos)
+        journal = getattr(self.routes, "journal", None)
+        if journal is not None:
+            journal.record(lambda: route.insert(pos, removed))
+
+        for shifted in route[pos:]:
+            shifted_location = self.locations[tuple(shifted)]
+            if shifted_location[0] == net_id and shifted_location[1] == route_idx:
+                shifted_location[2] -= 1
+        return True
+
+
+class RegisterSiteIndex:
+    """Every SB -> RMUX register slot in the routing graph and whether a
+    register already sits in it. Built once per graph and kept up to date
+    by RoutingResultGraph.splice_register."""
+
+    def __init__(self, graph):
+        self.sparse = graph.sparse
+        # SB node -> RMUX it drives when the slot is free
+        self.free = {}
+        # SB node -> register tile occupying the slot
+        self.occupied = {}
+
+        for node in graph.nodes:
+            if not (isinstance(node, RouteNode) and node.route_type == RouteType.SB):
+                continue
+            for sink in graph.sinks[node]:
+                if isinstance(sink, RouteNode) and sink.route_type == RouteType.RMUX:
+                    self.free[node] = sink
+                elif isinstance(sink, RouteNode) and sink.route_type == RouteType.REG:
+                    self.occupied[node] = graph.sinks[sink][0]
+
+    def is_free(self, node):
+        return node in self.free
+
+    def occupy(self, node, reg_tile):
+        self.free.pop(node, None)
+        self.occupied[node] = reg_tile
+
+    def release(self, node, rmux):
+        self.occupied.pop(node, None)
+        self.free[node] = rmux
+
+    def is_site(self, path, idx):
+        # Dense: free SB -> RMUX. Sparse: free SB/RMUX/SB/SB/RMUX FIFO pair
+        if self.sparse:
+            return (
+                idx + 4 < len(path)
+                and self.free.get(path[idx]) is path[idx + 1]
+                and isinstance(path[idx + 2], RouteNode)
+                and path[idx + 2].route_type == RouteType.SB
+                and self.free.get(path[idx + 3]) is path[idx + 4]
+            )
+        return idx + 1 < len(path) and self.free.get(path[idx]) is path[idx + 1]
+
+    def free_sites(self, path):
+        return [idx for idx in range(len(path)) if self.is_site(path, idx)]
+
+    def count_free_sites(self, path):
+        return len(self.free_sites(path))
+
+    def nearest_free_site(self, path, delays):
+        # Index of the free site whose arrival time is closest to half the
+        # path delay, or -1 when there is none
+        ranked = self.ranked_free_sites(path, delays, 1)
+        return ranked[0] if ranked else -1
+
+    def ranked_free_sites(self, path, delays, count):
+        # Up to count free sites ordered by how close their arrival time is
+        # to half the path delay, earlier sites first on ties
+        target = delays[-1] / 2
+        ranked = [
+            idx
+            for idx in self.free_sites(path)
+            if abs(delays[idx] - target) < delays[-1]
+        ]
+        ranked.sort(key=lambda idx: abs(delays[idx] - target))
+        return ranked[:count]
+
+    def spread_free_sites(self, path, count):
+        # Up to count non-overlapping free sites, each the closest to its
+        # share of the path. With count == 1 this is the middle of the path.
+        span = 5 if self.sparse else 2
+        sites = self.free_sites(path)
+        blocked = set()
+        chosen = []
+        for k in range(count):
+            target = (len(path) - 1) * (k + 1) / (count + 1)
+            best = -1
+            for idx in sites:
+                if idx in blocked:
+                    continue
+                if best == -1 or abs(idx - target) < abs(best - target):
+                    best = idx
+            if best == -1:
+                break
+            chosen.append(best)
+            blocked.update(range(best - span + 1, best + span))
+        return sorted(chosen)
+
+
 class RoutingResultGraph:
     def __init__(self):
         self.nodes: List[Union[RouteNode, TileNode]] = []
         self.tile_id_to_tile: Dict[str, Union[RouteNode, TileNode]] = {}
-        self.edges: List[(Union[RouteNode, TileNode], Union[RouteNode, TileNode])] = []
+        # Insertion ordered, used as a set so edges can be removed in O(1)
+        self.edges: Dict[
+            (Union[RouteNode, TileNode], Union[RouteNode, TileNode]), None
+        ] = {}
         self.edge_weights: Dict[
             (Union[RouteNode, TileNode], Union[RouteNode, TileNode]), int
         ] = {}
@@ -174,12 +383,41 @@ class RoutingResultGraph:
         self.shift_regs = None
         self.roms = None
         self.removed_edges = []
+        self.route_index = None
+        self.placement_result = None
+        self.register_sites = None
+        # Nodes whose timing changed through splice_register, in order
+        self.change_log = []
+        self.flush_arrivals = None
 
     def get_tile(self, tile_id):
         if tile_id in self.tile_id_to_tile:
             return self.tile_id_to_tile[tile_id]
         return None
 
+    def get_flush_arrivals(self, reset_io):
+        # Cycles from the reset IO to every node of the flush tree, following
+        # the first source of each node. Cached until a register lands on it.
+        if self.flush_arrivals is None:
+            arrivals = {reset_io: 0}
+            stack = [reset_io]
+            while stack:
+                parent = stack.pop()
+                if isinstance(parent, TileNode) and parent.tile_type in (
+                    TileType.MEM,
+                    TileType.POND,
+                ):
+                    continue
+                for node in self.sinks[parent]:
+                    if node in arrivals or self.sources[node][0] is not parent:
+                        continue
+                    arrivals[node] = arrivals[parent]
+                    if isinstance(node, TileNode) and parent is not reset_io:
+                        arrivals[node] += node.input_port_latencies[parent.port]
+                    stack.append(node)
+            self.flush_arrivals = arrivals
+        return self.flush_arrivals
+
     def get_tiles(self):
         tiles = []
         for node in self.nodes:
@@ -235,6 +473,11 @@ class RoutingResultGraph:
             self.shift_regs = regs
         return self.shift_regs
 
+    def get_register_sites(self):
+        if self.register_sites is None:
+            self.register_sites = RegisterSiteIndex(self)
+        return self.register_sites
+
     def get_ponds(self):
         if not self.ponds:
             ponds = []
@@ -384,7 +627,7 @@ class RoutingResultGraph:
         assert isinstance(node2, TileNode) or isinstance(node2, RouteNode)
 
         if (node1, node2) not in self.edges:
-            self.edges.append((node1, node2))
+            self.edges[(node1, node2)] = None
 
         if node2 not in self.sources:
             self.sources[node2] = []
@@ -441,12 +684,195 @@ class RoutingResultGraph:
         node1 = edge[1]
 
         if edge in self.edges:
-            self.edges.remove(edge)
+            del self.edges[edge]
         if node0 in self.sources[node1]:
             self.sources[node1].remove(node0)
         if node1 in self.sinks[node0]:
             self.sinks[node0].remove(node1)
 
+    def remove_node(self, node):
+        for source in list(self.sources.get(node, [])):
+            self.remove_edge((source, node))
+        for sink in list(self.sinks.get(node, [])):
+            self.remove_edge((node, sink))
+        self.nodes.remove(node)
+        if self.tile_id_to_tile.get(node.tile_id) is node:
+            del self.tile_id_to_tile[node.tile_id]
+        del self.sources[node]
+        del self.sinks[node]
+
+    def reg_segment_at(self, node):
+        dir_map = {0: "EAST", 1: "SOUTH", 2: "WEST", 3: "NORTH"}
+        reg_name = f"T{node.track}_{dir_map[node.side]}"
+        return ["REG", reg_name, node.track, node.x, node.y, node.bit_width]
+
+    def check_register_site(self, edge):
+        source, dest = edge
+        if edge not in self.edges:
+            raise ValueError(f"Edge {source} -> {dest} not in graph")
+        if not (
+            isinstance(source, RouteNode)
+            and source.route_type == RouteType.SB
+            and isinstance(dest, RouteNode)
+            and dest.route_type == RouteType.RMUX
+        ):
+            raise ValueError(f"Edge {source} -> {dest} is not an SB -> RMUX edge")
+        if (
+            self.route_index is None
+            or self.route_index.find(source.to_route()) is None
+        ):
+            raise ValueError(f"Couldn't find segment {source.to_route()} in routing")
+
+    def find_paired_fifo_edge(self, edge):
+        # Sparse registers come in pairs: SB -> RMUX -> SB -> SB -> RMUX
+        curr_node = edge[1]
+        for _ in range(2):
+            if len(self.sinks[curr_node]) == 0:
+                raise ValueError(f"Can't find paired FIFO for {edge[0]}")
+            curr_node = self.sinks[curr_node][0]
+        if len(self.sinks[curr_node]) == 0:
+            raise ValueError(f"Can't find paired FIFO for {edge[0]}")
+        return (curr_node, self.sinks[curr_node][0])
+
+    def insert_register(self, edge, reg_spec=None, paired_edge=None):
+        """Splice a pipeline register into an SB -> RMUX edge.
+
+        reg_spec is the REG routing segment to use, by default the register
+        attached to the SB. Adjacency, kernel labels, the register registry,
+        the routing result, placement and id_to_name are all updated locally,
+        so no global refresh is needed afterwards. In sparse mode the paired
+        FIFO register is inserted as well. Nothing is modified if any of the
+        sites is invalid. Returns the new register tiles."""
+        edges = self.register_site_edges(edge, paired_edge)
+        reg_specs = [reg_spec] + [None] * (len(edges) - 1)
+
+        for e in edges:
+            self.check_register_site(e)
+
+        return [self.splice_register(e, spec) for e, spec in zip(edges, reg_specs)]
+
+    def insert_registers(self, sites):
+        """Insert a batch of registers in one edit. sites is a list of
+        (edge, paired_edge) as taken by insert_register. Every site is
+        checked before the first register is spliced in."""
+        edges = []
+        for edge, paired_edge in sites:
+            edges += self.register_site_edges(edge, paired_edge)
+
+        if len(set(edges)) != len(edges):
+            raise ValueError("Register sites overlap")
+        for e in edges:
+            self.check_register_site(e)
+
+        return [self.splice_register(e) for e in edges]
+
+    def register_site_edges(self, edge, paired_edge=None):
+        if not self.sparse:
+            return [edge]
+        if paired_edge is None:
+            paired_edge = self.find_paired_fifo_edge(edge)
+        return [edge, paired_edge]
+
+    def splice_register(self, edge, reg_spec=None, tile_id=None, name=None):
+        source, dest = edge
+        if reg_spec is None:
+            reg_spec = self.reg_segment_at(source)
+        _, reg_name, track, x, y, bit_width = reg_spec
+        net_id = source.net_id
+        kernel = source.kernel
+
+        reg_route_source = self.segment_to_node(reg_spec, net_id, kernel)
+        reg_route_source.reg = True
+        reg_route_source.update_tile_id()
+        reg_route_dest = self.segment_to_node(reg_spec, net_id, kernel)
+        if tile_id is None:
+            tile_id = f"r{self.added_regs}"
+            self.added_regs += 1
+            name = f"pnr_pipelining_{self.added_regs}"
+        reg_tile = TileNode(x, y, tile_id=tile_id, kernel=kernel)
+
+        reg_tile.input_port_latencies["reg"] = 1
+        reg_tile.input_port_break_path["reg"] = True
+
+        self.remove_edge(edge)
+        for node in (reg_route_source, reg_tile, reg_route_dest):
+            self.add_node(node)
+            self.sources.setdefault(node, [])
+            self.sinks.setdefault(node, [])
+        for node1, node2 in (
+            (source, reg_route_source),
+            (reg_route_source, reg_tile),
+            (reg_tile, reg_route_dest),
+            (reg_route_dest, dest),
+        ):
+            self.edges[(node1, node2)] = None
+            self.sinks[node1].append(node2)
+            self.sources[node2].append(node1)
+
+        if self.regs:
+            self.regs.append(reg_tile)
+        if self.register_sites is not None:
+            self.register_sites.occupy(source, reg_tile)
+        if self.flush_arrivals is not None and source in self.flush_arrivals:
+            self.flush_arrivals = None
+        self.change_log += [source, reg_route_source, reg_tile, reg_route_dest, dest]
+
+        self.route_index.insert_after(source.to_route(), reg_route_source.to_route())
+        if self.placement_result is not None:
+            self.placement_result[reg_tile.tile_id] = (x, y)
+        self.placement.setdefault((x, y), []).append(reg_tile.tile_id)
+        self.id_to_name[reg_tile.tile_id] = f"{name}@{reg_name}"
+
+        return reg_tile
+
+    def remove_register(self, reg_tile):
+        """Take a register off the SB -> RMUX edge it sits on, the inverse of
+        splice_register. Returns the restored edge."""
+        if reg_tile not in self.sinks or reg_tile.tile_type != TileType.REG:
+            raise ValueError(f"{reg_tile} is not a register in the routing graph")
+        reg_route_source = self.sources[reg_tile][0]
+        reg_route_dest = self.sinks[reg_tile][0]
+        source = self.sources[reg_route_source][0]
+        dest = self.sinks[reg_route_dest][0]
+        if not (
+            len(self.sources[reg_route_source]) == 1
+            and len(self.sinks[reg_route_dest]) == 1
+            and isinstance(source, RouteNode)
+            and source.route_type == RouteType.SB
+            and isinstance(dest, RouteNode)
+            and dest.route_type == RouteType.RMUX
+        ):
+            raise ValueError(f"Register {reg_tile} doesn't sit on an SB -> RMUX edge")
+
+        reg_spec = reg_route_source.to_route()
+        for node in (reg_route_source, reg_tile, reg_route_dest):
+            self.remove_node(node)
+        self.edges[(source, dest)] = None
+        self.sinks[source].append(dest)
+        self.sources[dest].append(source)
+
+        if self.regs and reg_tile in self.regs:
+            self.regs.remove(reg_tile)
+        if self.shift_regs and reg_tile in self.shift_regs:
+            self.shift_regs = None
+        if self.register_sites is not None:
+            self.register_sites.release(source, dest)
+        if self.flush_arrivals is not None and source in self.flush_arrivals:
+            self.flush_arrivals = None
+        self.change_log += [reg_route_source, reg_tile, reg_route_dest, source, dest]
+
+        self.route_index.remove(reg_spec)
+        if self.placement_result is not None:
+            self.placement_result.pop(reg_tile.tile_id, None)
+        coords = (reg_tile.x, reg_tile.y)
+        if reg_tile.tile_id in self.placement.get(coords, []):
+            self.placement[coords].remove(reg_tile.tile_id)
+            if len(self.placement[coords]) == 0:
+                del self.placement[coords]
+        self.id_to_name.pop(reg_tile.tile_id, None)
+
+        return (source, dest)
+
     def is_cyclic_util(self, v, visited, rec_stack):
         visited.append(v)
         rec_stack.append(v)
@@ -832,6 +1258,8 @@ def construct_graph(
     graph.id_to_name = id_to_name
     graph.sparse = sparse
     graph.gen_placement(placement, netlist)
+    graph.route_index = RouteIndex(routes)
+    graph.placement_result = placement
 
     max_reg_id = 0
 
@@ -1,12 +1,13 @@
 import os
-import subprocess
 import pycyclone
+from .cache import cached_check_call, cached_exec
+from .watchdog import Watchdog
 
 
-def route(packed_filename: str, placement_filename,
-          graph_paths: str, route_result: str,
-          max_frequency, layout=None, wave_info=None,
-          shift_registers=False):
+def router_args(packed_filename: str, placement_filename,
+                graph_paths: str, route_result: str,
+                max_frequency, layout=None, wave_info=None,
+                shift_registers=False):
     # check input
     tokens = graph_paths.split()
     assert len(tokens) % 2 == 0
@@ -33,4 +34,29 @@ def route(packed_filename: str, placement_filename,
     elif shift_registers:
         assert os.path.exists(layout)
         args += ["-t", "register", "-l", layout]
-    subprocess.check_call(args)
+    return args
+
+
+def route(packed_filename: str, placement_filename,
+          graph_paths: str, route_result: str,
+          max_frequency, layout=None, wave_info=None,
+          shift_registers=False, env=None):
+    cached_check_call(router_args(packed_filename, placement_filename,
+                                  graph_paths, route_result,
+                                  max_frequency, layout, wave_info,
+                                  shift_registers),
+                      [route_result, wave_info], env=env,
+                      watchdog=Watchdog.for_router(env), failure="unroutable")
+
+
+async def route_async(packed_filename: str, placement_filename,
+                      graph_paths: str, route_result: str,
+                      max_frequency, layout=None, wave_info=None,
+                      shift_registers=False, env=None, timeout=None):
+    await cached_exec(router_args(packed_filename, placement_filename,
+                                  graph_paths, route_result,
+                                  max_frequency, layout, wave_info,
+                                  shift_registers),
+                      [route_result, wave_info], env=env,
+                      watchdog=Watchdog.for_router(env, timeout),
+                      failure="unroutable")
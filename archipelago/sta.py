@@ -1,5 +1,5 @@
 import os
-import copy
+import functools
 import json
 import argparse
 import sys
@@ -7,6 +7,7 @@ from pycyclone.io import load_placement
 import pycyclone
 import pythunder
 from archipelago.io import load_routing_result
+from archipelago.config import PnRConfig
 from archipelago.pnr_graph import (
     RoutingResultGraph,
     construct_graph,
@@ -19,6 +20,12 @@ from archipelago.visualize import visualize_pnr
 from canal.util import IOSide
 
 
+@functools.lru_cache(maxsize=None)
+def load_sta_delays():
+    with open(os.path.dirname(os.path.realpath(__file__)) + "/sta_delays.json") as f:
+        return json.load(f)
+
+
 class PathComponents:
     def __init__(
         self,
@@ -41,8 +48,19 @@ class PathComponents:
         self.rmux = rmux
         self.available_regs = available_regs
         self.parent = parent
-        self.delays = json.load(
-            open(os.path.dirname(os.path.realpath(__file__)) + "/sta_delays.json")
+        self.delays = load_sta_delays()
+
+    def copy(self):
+        return PathComponents(
+            glbs=self.glbs,
+            sb_delay=list(self.sb_delay),
+            sb_delay_rv=list(self.sb_delay_rv),
+            sb_clk_delay=list(self.sb_clk_delay),
+            pes=self.pes,
+            mems=self.mems,
+            rmux=self.rmux,
+            available_regs=self.available_regs,
+            parent=self.parent,
         )
 
     def get_total(self):
@@ -224,109 +242,118 @@ def calc_fifo_to_out(graph, node, parent, comp, mem_tile_column, mem_col_index_i
         comp.sb_delay_rv.append(comp.delays[f"ready_and_valid_{tile_suffix}"])
 
 
-def sta(graph, west_in_io_sides):
-    mem_col_index_increment = 0 if west_in_io_sides else 1 
+def node_timing(graph, node, timing_info, mem_tile_column, mem_col_index_increment):
+    comp = PathComponents()
+    components = [comp]
+
+    if len(graph.sources[node]) == 0 and (
+        node.tile_type == TileType.IO16 or node.tile_type == TileType.IO1
+    ):
+        if not node.input_port_break_path["output"]:
+            comp = PathComponents()
+            comp.glbs = 1
+            components = [comp]
+
+    for parent in graph.sources[node]:
+        comp = PathComponents()
+
+        if parent in timing_info:
+            comp = timing_info[parent].copy()
+            comp.parent = parent
+
+        if isinstance(node, TileNode):
+            if node.input_port_break_path[parent.port]:
+                comp = PathComponents()
+        else:
+            if node.route_type == RouteType.PORT and isinstance(parent, TileNode):
+                if parent.tile_type == TileType.PE:
+                    comp.pes += 1
+                elif parent.tile_type == TileType.MEM:
+                    comp.mems += 1
+                elif (
+                    parent.tile_type == TileType.IO16
+                    or parent.tile_type == TileType.IO1
+                ):
+                    comp.glbs += 1
+
+            elif node.route_type == RouteType.SB:
+                calc_sb_delay(
+                    graph, node, parent, comp, mem_tile_column, graph.sparse, mem_col_index_increment
+                )
+
+            elif node.route_type == RouteType.RMUX:
+                if graph.sparse:
+                    calc_fifo_to_out(graph, node, parent, comp, mem_tile_column, mem_col_index_increment)
+                else:
+                    # Make sure to check this later, not sure if we only want to count rmux when reg is used
+                    if (
+                        isinstance(parent, RouteNode)
+                        and parent.route_type == RouteType.REG
+                    ):
+                        comp.rmux += 1
+                    if parent.route_type != RouteType.REG:
+                        comp.available_regs += 1
+            elif (
+                node.route_type == RouteType.PORT
+                and isinstance(parent, TileNode)
+                and parent.tile_type == TileType.IO16
+            ):
+                comp.sb_delay_rv.append(300)
+                comp.sb_delay_rv.append(635)
+
+        components.append(comp)
+
+    maxt = 0
+    max_comp = components[0]
+    for comp in components:
+        if comp.get_total() > maxt:
+            maxt = comp.get_total()
+            max_comp = comp
+
+    return max_comp
+
+
+def compute_timing(graph, west_in_io_sides):
+    mem_col_index_increment = 0 if west_in_io_sides else 1
     mem_tile_column = get_mem_tile_columns(graph, mem_col_index_increment)
     nodes = graph.topological_sort()
     timing_info = {}
 
     for node in nodes:
-        comp = PathComponents()
-        components = [comp]
+        timing_info[node] = node_timing(
+            graph, node, timing_info, mem_tile_column, mem_col_index_increment
+        )
 
-        if len(graph.sources[node]) == 0 and (
-            node.tile_type == TileType.IO16 or node.tile_type == TileType.IO1
-        ):
-            if not node.input_port_break_path["output"]:
-                comp = PathComponents()
-                comp.glbs = 1
-                components = [comp]
+    return timing_info
 
-        for parent in graph.sources[node]:
-            comp = PathComponents()
 
-            if parent in timing_info:
-                comp = copy.deepcopy(timing_info[parent])
-                comp.parent = parent
+def summarize_timing(graph, timing_info, totals=None, verbose=True):
+    if totals is None:
+        totals = {node: timing_info[node].get_total() for node in graph.nodes}
 
-            if isinstance(node, TileNode):
-                if node.input_port_break_path[parent.port]:
-                    comp = PathComponents()
-            else:
-                if node.route_type == RouteType.PORT and isinstance(parent, TileNode):
-                    if parent.tile_type == TileType.PE:
-                        comp.pes += 1
-                    elif parent.tile_type == TileType.MEM:
-                        comp.mems += 1
-                    elif (
-                        parent.tile_type == TileType.IO16
-                        or parent.tile_type == TileType.IO1
-                    ):
-                        comp.glbs += 1
-
-                elif node.route_type == RouteType.SB:
-                    calc_sb_delay(
-                        graph, node, parent, comp, mem_tile_column, graph.sparse, mem_col_index_increment
-                    )
-
-                elif node.route_type == RouteType.RMUX:
-                    if graph.sparse:
-                        calc_fifo_to_out(graph, node, parent, comp, mem_tile_column, mem_col_index_increment)
-                    else:
-                        # Make sure to check this later, not sure if we only want to count rmux when reg is used
-                        if (
-                            isinstance(parent, RouteNode)
-                            and parent.route_type == RouteType.REG
-                        ):
-                            comp.rmux += 1
-                        if parent.route_type != RouteType.REG:
-                            comp.available_regs += 1
-                elif (
-                    node.route_type == RouteType.PORT
-                    and isinstance(parent, TileNode)
-                    and parent.tile_type == TileType.IO16
-                ):
-                    comp.sb_delay_rv.append(300)
-                    comp.sb_delay_rv.append(635)
-
-            components.append(comp)
-
-        maxt = 0
-        max_comp = components[0]
-        for comp in components:
-            if comp.get_total() > maxt:
-                maxt = comp.get_total()
-                max_comp = comp
-
-        timing_info[node] = max_comp
-
-    node_to_timing = {node: timing_info[node].get_total() for node in graph.nodes}
-    node_to_timing = dict(
-        sorted(
-            reversed(list(node_to_timing.items())),
-            key=lambda item: item[1],
-            reverse=True,
-        )
-    )
-    max_node = list(node_to_timing.keys())[0]
-    max_delay = list(node_to_timing.values())[0]
+    # Ties go to the node added last
+    max_node = None
+    for node in graph.nodes:
+        if max_node is None or totals[node] >= max_delay:
+            max_node = node
+            max_delay = totals[node]
 
     clock_speed = int(1.0e12 / max_delay / 1e6)
 
-    print("\tMaximum clock frequency:", clock_speed, "MHz")
-    print("\tCritical Path:", max_delay, "ps")
-    print("\tCritical Path Info:")
-    timing_info[max_node].print()
+    if verbose:
+        print("\tMaximum clock frequency:", clock_speed, "MHz")
+        print("\tCritical Path:", max_delay, "ps")
+        print("\tCritical Path Info:")
+        timing_info[max_node].print()
 
-    max_node = list(node_to_timing.keys())[0]
     curr_node = max_node
     crit_path = []
-    crit_path.append((curr_node, timing_info[curr_node].get_total()))
+    crit_path.append((curr_node, totals[curr_node]))
     crit_nodes = []
     while True:
         crit_nodes.append(curr_node)
         curr_node = timing_info[curr_node].parent
-        crit_path.append((curr_node, timing_info[curr_node].get_total()))
+        crit_path.append((curr_node, totals[curr_node]))
         if timing_info[curr_node].parent is None:
             break
 
@@ -335,6 +362,78 @@ def sta(graph, west_in_io_sides):
     return clock_speed, crit_path, crit_nodes
 
 
+def sta(graph, west_in_io_sides):
+    timing_info = compute_timing(graph, west_in_io_sides)
+    return summarize_timing(graph, timing_info)
+
+
+class TimingState:
+    """Arrival times kept in sync with registers spliced into the graph.
+    update() only re-evaluates the fanout cone of the edits recorded in
+    graph.change_log, stopping at tile inputs that break the path."""
+
+    def __init__(self, graph, west_in_io_sides):
+        self.graph = graph
+        self.mem_col_index_increment = 0 if west_in_io_sides else 1
+        self.mem_tile_column = get_mem_tile_columns(
+            graph, self.mem_col_index_increment
+        )
+        self.timing_info = compute_timing(graph, west_in_io_sides)
+        self.totals = {
+            node: comp.get_total() for node, comp in self.timing_info.items()
+        }
+        self.synced = len(graph.change_log)
+
+    def update(self):
+        graph = self.graph
+        seeds = graph.change_log[self.synced :]
+        self.synced = len(graph.change_log)
+
+        cone = set()
+        stack = list(seeds)
+        while stack:
+            node = stack.pop()
+            if node not in graph.sinks:
+                # Removed from the graph, e.g. by remove_register
+                self.timing_info.pop(node, None)
+                self.totals.pop(node, None)
+                continue
+            if node in cone:
+                continue
+            cone.add(node)
+            for sink in graph.sinks[node]:
+                if isinstance(sink, TileNode) and sink.input_port_break_path.get(
+                    node.port
+                ):
+                    continue
+                stack.append(sink)
+
+        indegree = {
+            node: len([s for s in graph.sources[node] if s in cone]) for node in cone
+        }
+        ready = [node for node in cone if indegree[node] == 0]
+        while ready:
+            node = ready.pop()
+            comp = node_timing(
+                graph,
+                node,
+                self.timing_info,
+                self.mem_tile_column,
+                self.mem_col_index_increment,
+            )
+            self.timing_info[node] = comp
+            self.totals[node] = comp.get_total()
+            for sink in graph.sinks[node]:
+                if sink in indegree:
+                    indegree[sink] -= 1
+                    if indegree[sink] == 0:
+                        ready.append(sink)
+
+    def sta(self, verbose=True):
+        self.update()
+        return summarize_timing(self.graph, self.timing_info, self.totals, verbose)
+
+
 def load_id_to_name(id_filename):
     fin = open(id_filename, "r")
     lines = fin.readlines()
@@ -375,20 +474,23 @@ def parse_args():
     return netlist, placement, route, id_to_name_filename, args.visualize, args.sparse
 
 
-def run_sta(packed_file, placement_file, routing_file, id_to_name, sparse, west_in_io_sides):
+def run_sta(
+    packed_file,
+    placement_file,
+    routing_file,
+    id_to_name,
+    sparse,
+    west_in_io_sides,
+    config=None,
+):
+    if config is None:
+        config = PnRConfig.from_env()
     netlist, buses = pythunder.io.load_netlist(packed_file)
     placement = load_placement(placement_file)
     routing = load_routing_result(routing_file)
 
-    if "PIPELINED" in os.environ and os.environ["PIPELINED"].isnumeric():
-        pe_latency = int(os.environ["PIPELINED"])
-    else:
-        pe_latency = 1
-
-    if "IO_DELAY" in os.environ and os.environ["IO_DELAY"] == "0":
-        io_cycles = 0
-    else:
-        io_cycles = 1
+    pe_latency = config.pe_latency
+    io_cycles = config.io_latency
 
     routing_result_graph = construct_graph(
         placement, routing, id_to_name, netlist, pe_latency, 0, io_cycles, sparse
@@ -419,15 +521,9 @@ def main():
     placement = load_placement(placement_file)
     routing = load_routing_result(routing_file)
 
-    if "PIPELINED" in os.environ and os.environ["PIPELINED"].isnumeric():
-        pe_latency = int(os.environ["PIPELINED"])
-    else:
-        pe_latency = 1
-
-    if "IO_DELAY" in os.environ and os.environ["IO_DELAY"] == "0":
-        io_cycles = 0
-    else:
-        io_cycles = 1
+    config = PnRConfig.from_env()
+    pe_latency = config.pe_latency
+    io_cycles = config.io_latency
 
     routing_result_graph = construct_graph(
         placement, routing, id_to_name, netlist, pe_latency, 0, io_cycles, sparse
@@ -0,0 +1,196 @@
+import asyncio
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from .config import PnRConfig
+
+# Limits on a placer or router run, from PNR_PLACE_TIMEOUT and
+# PNR_ROUTE_TIMEOUT (wall clock), PNR_STALL_TIMEOUT (no output) and
+# PNR_ROUTE_MAX_FAILED, the number of router log lines matching
+# PNR_ROUTE_FAIL_PATTERN after which the placement is given up as
+# unroutable. All times are in seconds and every limit is off by default.
+
+
+class PnRToolError(subprocess.CalledProcessError):
+    """A placer or router run that failed. kind is "timeout",
+    "unroutable" or "crash"."""
+
+    def __init__(self, kind, returncode, cmd):
+        super(PnRToolError, self).__init__(returncode, cmd)
+        self.kind = kind
+
+    def __str__(self):
+        return f"{self.cmd[0]} failed ({self.kind}, exit status {self.returncode})"
+
+
+def failure_kind(error):
+    if isinstance(error, PnRToolError):
+        return error.kind
+    return "crash"
+
+
+def classify(returncode, failure):
+    # Kind of a finished run that exited with returncode, failure is what a
+    # plain non-zero exit means for this binary
+    if returncode == 0:
+        return None
+    if returncode < 0:
+        # Killed by a signal, e.g. an assertion
+        return "crash"
+    return failure
+
+
+class Watchdog:
+    def __init__(
+        self, timeout=None, stall_timeout=None, fail_pattern=None, max_failed=None
+    ):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.fail_pattern = re.compile(fail_pattern) if fail_pattern else None
+        self.max_failed = max_failed
+        self.start = self.last_output = None
+        self.failed = 0
+
+    @classmethod
+    def for_placer(cls, env=None, timeout=None):
+        # timeout overrides PNR_PLACE_TIMEOUT
+        config = PnRConfig(env)
+        if timeout is None:
+            timeout = config.place_timeout
+        return cls.make(timeout, config.stall_timeout)
+
+    @classmethod
+    def for_router(cls, env=None, timeout=None):
+        # timeout overrides PNR_ROUTE_TIMEOUT
+        config = PnRConfig(env)
+        if timeout is None:
+            timeout = config.route_timeout
+        return cls.make(
+            timeout,
+            config.stall_timeout,
+            config.route_fail_pattern,
+            config.route_max_failed,
+        )
+
+    @classmethod
+    def make(cls, *limits):
+        # None when no limit is set, so the run isn't watched at all
+        if all(limit is None for limit in limits):
+            return None
+        return cls(*limits)
+
+    @property
+    def watches_output(self):
+        return self.stall_timeout is not None or (
+            self.fail_pattern is not None and self.max_failed is not None
+        )
+
+    def launched(self):
+        # Limits count from here, not from when the run was set up
+        self.start = self.last_output = time.monotonic()
+        self.failed = 0
+
+    def feed(self, line):
+        self.last_output = time.monotonic()
+        if self.fail_pattern is not None and self.fail_pattern.search(line):
+            self.failed += 1
+
+    def verdict(self):
+        # None while the run may go on, otherwise why it should be killed
+        now = time.monotonic()
+        if self.timeout is not None and now - self.start > self.timeout:
+            return "timeout"
+        if self.stall_timeout is not None and now - self.last_output > self.stall_timeout:
+            return "timeout"
+        if self.max_failed is not None and self.failed >= self.max_failed:
+            return "unroutable"
+        return None
+
+
+def run_watched(args, env, watchdog):
+    """subprocess.call(args, env=env) that kills the process once watchdog
+    says so. The output is passed through to stdout line by line when the
+    watchdog needs to see it. Returns the returncode and the verdict, None
+    if the process wasn't killed."""
+    watchdog.launched()
+    if not watchdog.watches_output:
+        proc = subprocess.Popen(args, env=env)
+        reader = None
+    else:
+        proc = subprocess.Popen(
+            args,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+
+        def pump():
+            for line in proc.stdout:
+                sys.stdout.write(line)
+                watchdog.feed(line)
+
+        reader = threading.Thread(target=pump, daemon=True)
+        reader.start()
+
+    verdict = None
+    while proc.poll() is None:
+        verdict = watchdog.verdict()
+        if verdict is not None:
+            proc.kill()
+            proc.wait()
+            break
+        time.sleep(0.1)
+    if reader is not None:
+        reader.join()
+    return proc.returncode, verdict
+
+
+async def run_watched_async(args, env, watchdog):
+    """run_watched() on an asyncio event loop. The process is also killed
+    when the awaiting task is cancelled."""
+    watchdog.launched()
+    if not watchdog.watches_output:
+        proc = await asyncio.create_subprocess_exec(*args, env=env)
+        reader = None
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        async def pump():
+            async for line in proc.stdout:
+                line = line.decode(errors="replace")
+                sys.stdout.write(line)
+                watchdog.feed(line)
+
+        reader = asyncio.ensure_future(pump())
+
+    verdict = None
+    try:
+        while proc.returncode is None:
+            verdict = watchdog.verdict()
+            if verdict is not None:
+                proc.kill()
+                await proc.wait()
+                break
+            try:
+                await asyncio.wait_for(proc.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+        if reader is not None:
+            await reader
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if reader is not None:
+            reader.cancel()
+    return proc.returncode, verdict
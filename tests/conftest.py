@@ -0,0 +1,212 @@
+import copy
+
+import pytest
+
+
+def hop(x0, x1, y, track, bw=16):
+    # Straight east route on row y from tile x0 to tile x1
+    segs = [["SB", track, x0, y, 0, 1, bw], ["RMUX", f"T{track}_EAST_B{bw}", x0, y, bw]]
+    for x in range(x0 + 1, x1):
+        segs.append(["SB", track, x, y, 2, 0, bw])
+        segs.append(["SB", track, x, y, 0, 1, bw])
+        segs.append(["RMUX", f"T{track}_EAST_B{bw}", x, y, bw])
+    segs.append(["SB", track, x1, y, 2, 0, bw])
+    return segs
+
+
+def design(n=4, span=4, branch=True):
+    """Placement, routing, id_to_name and netlist of a chain of n PEs span
+    tiles apart on row 1, fed by an IO. With branch the first PE also feeds
+    a PE on row 3."""
+    placement = {"I0": (0, 1)}
+    id_to_name = {"I0": "io16in_in$x"}
+    netlist = {}
+    routes = {}
+    prev, prev_port, x = "I0", "io2f_16", 0
+    for i in range(1, n + 1):
+        blk = f"p{i}"
+        x += span
+        placement[blk] = (x, 1)
+        id_to_name[blk] = f"op_hcompute_k{i % 2}$inner_compute$p{i}"
+        netlist[f"e{i}"] = [(prev, prev_port), (blk, "data0")]
+        routes[f"e{i}"] = [
+            [["PORT", prev_port, placement[prev][0], 1, 16]]
+            + hop(placement[prev][0], x, 1, 0)
+            + [["PORT", "data0", x, 1, 16]]
+        ]
+        prev, prev_port = blk, "O0"
+
+    x += span
+    placement["I9"] = (x, 1)
+    id_to_name["I9"] = "io16_out$y"
+    netlist["e99"] = [(prev, "O0"), ("I9", "f2io_16")]
+    routes["e99"] = [
+        [["PORT", "O0", placement[prev][0], 1, 16]]
+        + hop(placement[prev][0], x, 1, 0)
+        + [["PORT", "f2io_16", x, 1, 16]]
+    ]
+
+    if branch:
+        x1 = span
+        placement["p9"] = (span * 2, 3)
+        id_to_name["p9"] = "op_hcompute_k1$inner_compute$p9"
+        netlist["e1"].append(("p9", "data1"))
+        branch_route = copy.deepcopy(routes["e1"][0][:4]) + [
+            ["SB", 1, x1 + 1, 1, 1, 1, 16],
+            ["RMUX", "T1_SOUTH_B16", x1 + 1, 1, 16],
+            ["SB", 1, x1 + 1, 2, 3, 0, 16],
+            ["SB", 1, x1 + 1, 2, 0, 1, 16],
+            ["RMUX", "T1_EAST_B16", x1 + 1, 2, 16],
+            ["SB", 1, x1 + 2, 2, 2, 0, 16],
+            ["SB", 1, x1 + 2, 2, 1, 1, 16],
+            ["RMUX", "T1_SOUTH_B16", x1 + 2, 2, 16],
+            ["SB", 1, x1 + 2, 3, 3, 0, 16],
+            ["SB", 1, x1 + 2, 3, 0, 1, 16],
+            ["RMUX", "T1_EAST_B16", x1 + 2, 3, 16],
+        ]
+        branch_route += hop(x1 + 3, span * 2, 3, 1)[1:]
+        branch_route += [["PORT", "data1", span * 2, 3, 16]]
+        routes["e1"].append(branch_route[3:])
+        placement["I8"] = (span * 2 + 2, 3)
+        id_to_name["I8"] = "io16_out2$z"
+        netlist["e100"] = [("p9", "O0"), ("I8", "f2io_16")]
+        routes["e100"] = [
+            [["PORT", "O0", span * 2, 3, 16]]
+            + hop(span * 2, span * 2 + 2, 3, 2)
+            + [["PORT", "f2io_16", span * 2 + 2, 3, 16]]
+        ]
+    return placement, routes, id_to_name, netlist
+
+
+def fork_design(trunk=2, length=4):
+    """A PE p1 fed by an IO whose output forks trunk hops east of it: one
+    branch runs east on row 1 to p2, the other turns south and runs east on
+    row 2 to p3. Each branch is length hops long. p1, p2 and p3 are one
+    kernel."""
+    x0 = 4
+    fork = x0 + trunk
+    x1 = fork + length
+    placement = {"I0": (0, 1), "p1": (x0, 1), "p2": (x1, 1), "p3": (x1, 2)}
+    id_to_name = {"I0": "io16in_in$x"}
+    for blk in ["p1", "p2", "p3"]:
+        id_to_name[blk] = f"op_hcompute_k$inner_compute${blk}"
+    netlist = {
+        "e1": [("I0", "io2f_16"), ("p1", "data0")],
+        "e2": [("p1", "O0"), ("p2", "data0"), ("p3", "data0")],
+    }
+    trunk_route = [["PORT", "O0", x0, 1, 16]] + hop(x0, fork, 1, 0)
+    routes = {
+        "e1": [
+            [["PORT", "io2f_16", 0, 1, 16]]
+            + hop(0, x0, 1, 0)
+            + [["PORT", "data0", x0, 1, 16]]
+        ],
+        "e2": [
+            trunk_route + hop(fork, x1, 1, 0) + [["PORT", "data0", x1, 1, 16]],
+            trunk_route
+            + [
+                ["SB", 0, fork, 1, 1, 1, 16],
+                ["RMUX", "T0_SOUTH_B16", fork, 1, 16],
+                ["SB", 0, fork, 2, 3, 0, 16],
+            ]
+            + hop(fork, x1, 2, 0)
+            + [["PORT", "data0", x1, 2, 16]],
+        ],
+    }
+    return placement, routes, id_to_name, netlist
+
+
+def pond_design():
+    """An IO feeding a pond M1 that feeds a PE p2 on row 1. The pond and
+    the PE are one kernel."""
+    placement = {"I0": (0, 1), "M1": (4, 1), "p2": (8, 1)}
+    id_to_name = {
+        "I0": "io16in_in$x",
+        "M1": "op_hcompute_k$pond$M1",
+        "p2": "op_hcompute_k$inner_compute$p2",
+    }
+    netlist = {
+        "e1": [("I0", "io2f_16"), ("M1", "data_in_pond")],
+        "e2": [("M1", "data_out_pond"), ("p2", "data0")],
+    }
+    routes = {
+        "e1": [
+            [["PORT", "io2f_16", 0, 1, 16]]
+            + hop(0, 4, 1, 0)
+            + [["PORT", "data_in_pond", 4, 1, 16]]
+        ],
+        "e2": [
+            [["PORT", "data_out_pond", 4, 1, 16]]
+            + hop(4, 8, 1, 0)
+            + [["PORT", "data0", 8, 1, 16]]
+        ],
+    }
+    return placement, routes, id_to_name, netlist
+
+
+def flush_design(east=5, south=9):
+    """A reset IO whose 1-bit flush net forks two hops east of it: one
+    branch runs east hops on row 1 to m1, the other turns south and runs
+    south hops on row 2 to m2. A separate 16-bit net on row 3 feeds p1.
+    The default lengths put the MEMs in MEM columns."""
+    fork = 2
+    placement = {
+        "i0": (0, 1),
+        "m1": (fork + east, 1),
+        "m2": (fork + south, 2),
+        "I1": (0, 3),
+        "p1": (4, 3),
+    }
+    id_to_name = {
+        "i0": "io1in_reset$reset",
+        "m1": "mem_k$ub$m1",
+        "m2": "mem_k$ub$m2",
+        "I1": "io16in_in$x",
+        "p1": "op_hcompute_k$inner_compute$p1",
+    }
+    netlist = {
+        "e1": [("i0", "io2f_1"), ("m1", "flush"), ("m2", "flush")],
+        "e2": [("I1", "io2f_16"), ("p1", "data0")],
+    }
+    trunk = [["PORT", "io2f_1", 0, 1, 1]] + hop(0, fork, 1, 0, bw=1)
+    routes = {
+        "e1": [
+            trunk
+            + hop(fork, fork + east, 1, 0, bw=1)
+            + [["PORT", "flush", fork + east, 1, 1]],
+            trunk
+            + [
+                ["SB", 0, fork, 1, 1, 1, 1],
+                ["RMUX", "T0_SOUTH_B1", fork, 1, 1],
+                ["SB", 0, fork, 2, 3, 0, 1],
+            ]
+            + hop(fork, fork + south, 2, 0, bw=1)
+            + [["PORT", "flush", fork + south, 2, 1]],
+        ],
+        "e2": [
+            [["PORT", "io2f_16", 0, 3, 16]]
+            + hop(0, 4, 3, 0)
+            + [["PORT", "data0", 4, 3, 16]]
+        ],
+    }
+    return placement, routes, id_to_name, netlist
+
+
+@pytest.fixture
+def make_design():
+    return design
+
+
+@pytest.fixture
+def make_fork_design():
+    return fork_design
+
+
+@pytest.fixture
+def make_pond_design():
+    return pond_design
+
+
+@pytest.fixture
+def make_flush_design():
+    return flush_design
@@ -0,0 +1,324 @@
+import asyncio
+import gc
+import os
+import sys
+import types
+import weakref
+
+import pytest
+
+from archipelago import cache
+from archipelago.cache import (
+    cached_check_call,
+    cached_dump_pnr,
+    cached_exec,
+    evict,
+    hash_file,
+    restore_entry,
+    store_entry,
+)
+from archipelago.watchdog import PnRToolError, Watchdog
+
+
+def make_entry(cache_dir, name, size, last_used):
+    output = cache_dir / f"{name}.out"
+    output.write_bytes(b"x" * size)
+    entry = str(cache_dir / name)
+    store_entry(str(cache_dir), entry, [str(output)], 0)
+    os.utime(os.path.join(entry, "result.json"), (last_used, last_used))
+    output.unlink()
+    return entry
+
+
+def entry_names(cache_dir):
+    return sorted(
+        name for name in os.listdir(cache_dir) if os.path.isdir(cache_dir / name)
+    )
+
+
+def test_evict_least_recently_used(tmp_path):
+    for name, last_used in [("a", 300), ("b", 100), ("c", 200)]:
+        make_entry(tmp_path, name, 1000, last_used)
+
+    evict(str(tmp_path), 2500)
+    assert entry_names(tmp_path) == ["a", "c"]
+
+    evict(str(tmp_path), 1500)
+    assert entry_names(tmp_path) == ["a"]
+
+
+def test_evict_nothing_when_it_fits(tmp_path):
+    for name, last_used in [("a", 100), ("b", 200)]:
+        make_entry(tmp_path, name, 1000, last_used)
+
+    evict(str(tmp_path), 10000)
+    assert entry_names(tmp_path) == ["a", "b"]
+
+
+def test_evict_keeps_entry(tmp_path):
+    for name, last_used in [("a", 100), ("b", 200), ("c", 300)]:
+        make_entry(tmp_path, name, 1000, last_used)
+
+    evict(str(tmp_path), 2500, keep="a")
+    assert entry_names(tmp_path) == ["a", "c"]
+
+    evict(str(tmp_path), 0, keep="a")
+    assert entry_names(tmp_path) == ["a"]
+
+
+def test_restore_marks_entry_used(tmp_path):
+    for name, last_used in [("a", 100), ("b", 200)]:
+        make_entry(tmp_path, name, 1000, last_used)
+
+    output = tmp_path / "a.out"
+    assert restore_entry(str(tmp_path / "a"), [str(output)]) == 0
+    assert output.read_bytes() == b"x" * 1000
+    output.unlink()
+
+    evict(str(tmp_path), 1500)
+    assert entry_names(tmp_path) == ["a"]
+
+
+def test_evict_skips_partial_entries(tmp_path):
+    make_entry(tmp_path, "a", 1000, 100)
+    # Being stored by another run
+    (tmp_path / ".tmpxyz").mkdir()
+    (tmp_path / ".tmpxyz" / "0").write_bytes(b"x" * 1000)
+    # No result.json
+    (tmp_path / "b").mkdir()
+
+    evict(str(tmp_path), 0)
+    assert entry_names(tmp_path) == [".tmpxyz", "b"]
+
+
+@pytest.mark.parametrize("replace", [False, True])
+def test_hash_file_sees_same_size_rewrite(tmp_path, monkeypatch, replace):
+    monkeypatch.setattr(cache, "RACY_NS", 0)
+    filename = tmp_path / "design.place"
+    filename.write_bytes(b"a" * 100)
+    st = os.stat(filename)
+    old_hash = hash_file(str(filename))
+    assert hash_file(str(filename)) == old_hash
+
+    if replace:
+        (tmp_path / "tmp").write_bytes(b"b" * 100)
+        os.replace(tmp_path / "tmp", filename)
+    else:
+        filename.write_bytes(b"b" * 100)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert hash_file(str(filename)) != old_hash
+
+
+def test_hash_file_rehashes_recent_files(tmp_path, monkeypatch):
+    # A rewrite that no stat field shows, as on a filesystem with coarse
+    # timestamps
+    filename = tmp_path / "design.place"
+    filename.write_bytes(b"a" * 100)
+    st = os.stat(filename)
+    monkeypatch.setattr(cache.os, "stat", lambda _: st)
+    old_hash = hash_file(str(filename))
+
+    filename.write_bytes(b"b" * 100)
+    new_hash = hash_file(str(filename))
+    assert new_hash != old_hash
+
+    monkeypatch.setattr(cache, "RACY_NS", 0)
+    assert hash_file(str(filename)) == new_hash
+    filename.write_bytes(b"a" * 100)
+    assert hash_file(str(filename)) == new_hash
+
+
+def run_sync(args, env, watchdog, failure):
+    cached_check_call(args, [], env=env, watchdog=watchdog, failure=failure)
+
+
+def run_async(args, env, watchdog, failure):
+    asyncio.run(cached_exec(args, [], env=env, watchdog=watchdog, failure=failure))
+
+
+@pytest.fixture
+def env():
+    return {k: v for k, v in os.environ.items() if not k.startswith("PNR_")}
+
+
+@pytest.mark.parametrize("run", [run_sync, run_async])
+@pytest.mark.parametrize(
+    "script, watchdog, failure, kind",
+    [
+        ("pass", None, "unroutable", None),
+        ("raise SystemExit(1)", None, "unroutable", "unroutable"),
+        ("raise SystemExit(1)", None, "crash", "crash"),
+        ("import os; os.abort()", None, "unroutable", "crash"),
+        ("import time; time.sleep(30)", Watchdog(timeout=0.5), "crash", "timeout"),
+        (
+            "import time; time.sleep(30)",
+            Watchdog(stall_timeout=0.5),
+            "crash",
+            "timeout",
+        ),
+        (
+            "import time\nfor i in range(3): print('Failed', i, flush=True)\n"
+            "time.sleep(30)",
+            Watchdog(fail_pattern="Failed", max_failed=2),
+            "crash",
+            "unroutable",
+        ),
+    ],
+)
+def test_run_failure_kind(run, env, script, watchdog, failure, kind):
+    args = [sys.executable, "-c", script]
+    if kind is None:
+        run(args, env, watchdog, failure)
+        return
+    with pytest.raises(PnRToolError) as e:
+        run(args, env, watchdog, failure)
+    assert e.value.kind == kind
+    assert e.value.cmd == args
+
+
+@pytest.mark.parametrize("watchdog", [None, Watchdog(stall_timeout=60)])
+def test_cancel_kills_async_run(env, tmp_path, watchdog):
+    pid_file = tmp_path / "pid"
+    script = (
+        f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); "
+        "time.sleep(30)"
+    )
+
+    async def main():
+        task = asyncio.ensure_future(
+            cached_exec([sys.executable, "-c", script], [], env=env, watchdog=watchdog)
+        )
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+class FakeNode:
+    def __init__(self, name):
+        self.name = name
+        self.sinks = []
+        self.sources = []
+
+    def add_edge(self, node):
+        self.sinks.append(node)
+        node.sources.append(self)
+
+    def __iter__(self):
+        return iter(self.sinks)
+
+    def get_conn_in(self):
+        return self.sources
+
+    def __str__(self):
+        return self.name
+
+
+class FakeCore:
+    def pnr_info(self):
+        return types.SimpleNamespace(tag_name="p", priority_major=20, priority_minor=0)
+
+
+class FakeInterconnect:
+    """Two tiles whose switch boxes connect through a register mux, and a
+    dump_pnr that counts its calls."""
+
+    def __init__(self, reg_mux=True):
+        self.x_max, self.y_max = 1, 0
+        self.tile_circuits = {
+            (x, 0): types.SimpleNamespace(core=FakeCore()) for x in range(2)
+        }
+        sbs = [FakeNode(f"SB ({x}, 0)") for x in range(2)]
+        if reg_mux:
+            rmux = FakeNode("RMUX (0, 0)")
+            sbs[0].add_edge(rmux)
+            rmux.add_edge(sbs[1])
+        else:
+            sbs[0].add_edge(sbs[1])
+        self.graph = {
+            (x, 0): types.SimpleNamespace(
+                switchbox=types.SimpleNamespace(get_all_sbs=lambda x=x: [sbs[x]])
+            )
+            for x in range(2)
+        }
+        self.dumps = 0
+
+    def get_bit_widths(self):
+        return [16]
+
+    def get_graph(self, bit_width):
+        return self.graph
+
+    def dump_pnr(self, dir_name, design_name, max_num_col=None):
+        self.dumps += 1
+        dir_name = os.path.abspath(dir_name)
+        with open(os.path.join(dir_name, "16.graph"), "w") as f:
+            f.write(f"cols {max_num_col}")
+        with open(os.path.join(dir_name, f"{design_name}.info"), "w") as f:
+            f.write(f"graph={os.path.join(dir_name, '16.graph')}\n")
+
+
+def test_cached_dump_pnr_without_cache_dir(tmp_path):
+    interconnect = FakeInterconnect()
+    for _ in range(2):
+        cached_dump_pnr(interconnect, str(tmp_path), 4, env={})
+    assert interconnect.dumps == 2
+
+
+def test_cached_dump_pnr_hit_and_miss(tmp_path):
+    env = {"PNR_ARCH_CACHE_DIR": str(tmp_path / "arch_cache")}
+    interconnect = FakeInterconnect()
+
+    def dump(interconnect, name, col):
+        dir_name = tmp_path / name
+        dir_name.mkdir(exist_ok=True)
+        cached_dump_pnr(interconnect, str(dir_name), col, env=env)
+        assert (dir_name / "16.graph").read_text() == f"cols {col}"
+        # design.info points into dir_name, not the cache entry
+        assert (dir_name / "design.info").read_text() == (
+            f"graph={dir_name / '16.graph'}\n"
+        )
+
+    dump(interconnect, "a", 4)
+    assert interconnect.dumps == 1
+    dump(interconnect, "b", 4)
+    assert interconnect.dumps == 1
+    # Another column count is another entry
+    dump(interconnect, "c", 6)
+    assert interconnect.dumps == 2
+
+    # A fresh interconnect with the same fabric hits the same entry, one
+    # wired differently doesn't
+    same = FakeInterconnect()
+    dump(same, "d", 4)
+    assert same.dumps == 0
+    rewired = FakeInterconnect(reg_mux=False)
+    dump(rewired, "e", 4)
+    assert rewired.dumps == 1
+
+    env["PNR_ARCH_KEY"] = "pinned"
+    dump(rewired, "f", 4)
+    dump(interconnect, "g", 4)
+    assert rewired.dumps == 2 and interconnect.dumps == 2
+    assert sorted(os.listdir(tmp_path / "arch_cache")) == sorted(
+        [
+            f"{cache.interconnect_fingerprint(interconnect)}_4",
+            f"{cache.interconnect_fingerprint(interconnect)}_6",
+            f"{cache.interconnect_fingerprint(rewired)}_4",
+            "pinned_4",
+        ]
+    )
+
+
+def test_interconnect_fingerprint_is_released():
+    interconnect = FakeInterconnect()
+    cache.interconnect_fingerprint(interconnect)
+    ref = weakref.ref(interconnect)
+    del interconnect
+    gc.collect()
+    assert ref() is None
@@ -0,0 +1,84 @@
+import os
+
+from archipelago.config import PnRConfig
+
+
+def test_config_is_a_snapshot(monkeypatch):
+    monkeypatch.setenv("PIPELINED", "0")
+    config = PnRConfig.from_env()
+    monkeypatch.setenv("PIPELINED", "3")
+    assert config.pe_latency == 0
+    assert PnRConfig.from_env().pe_latency == 3
+
+    env = {"PNR_PLACER_EXP": "4"}
+    config = PnRConfig(env)
+    env["PNR_PLACER_EXP"] = "5"
+    assert config.placer_exp == 4
+    config.subprocess_env()["PNR_PLACER_EXP"] = "6"
+    assert config.placer_exp == 4
+
+
+def test_replace_leaves_original_alone():
+    config = PnRConfig({"PNR_PLACER_EXP": "4", "IO_DELAY": "0"})
+    replaced = config.replace(PNR_PLACER_EXP=7, IO_DELAY=None)
+    assert replaced.env == {"PNR_PLACER_EXP": "7"}
+    assert replaced.placer_exp == 7
+    assert replaced.io_latency == 1
+    assert config.env == {"PNR_PLACER_EXP": "4", "IO_DELAY": "0"}
+    assert config.io_latency == 0
+
+    # Without an env, overrides go on top of os.environ
+    assert PnRConfig.from_env(PNR_PLACER_EXP=2).env == dict(
+        os.environ, PNR_PLACER_EXP="2"
+    )
+
+
+def test_typed_settings():
+    config = PnRConfig({})
+    assert config.pe_latency == 1
+    assert config.io_latency == 1
+    assert config.placer_exp is None
+    assert config.target_freq is None
+    assert not config.exhaustive_pipe
+    assert config.what_if == 1
+    assert config.what_if_jobs is None
+    assert not config.retime
+    assert not config.reg_chain
+    assert not config.sweep_placer_exp
+    assert config.speculative_jobs == 0
+    assert config.pipeline_settings() == {}
+
+    config = PnRConfig(
+        {
+            "PIPELINED": "2",
+            "PNR_PLACER_EXP": "not a number",
+            "PIPELINE_TARGET_FREQ": "612.5",
+            "EXHAUSTIVE_PIPE": "1",
+            "PIPELINE_WHAT_IF": "8",
+            "PIPELINE_RETIME": "1",
+            "MEM2PE_REG_CHAIN": "",
+            "SWEEP_PNR_PLACER_EXP": "",
+            "PNR_ROUTE_TIMEOUT": "1.5",
+            "PNR_SWEEP_JOBS": "3",
+        }
+    )
+    assert config.pe_latency == 2
+    assert config.placer_exp is None
+    assert config.target_freq == 612.5
+    assert config.exhaustive_pipe
+    assert config.what_if == 8
+    assert config.retime
+    assert config.reg_chain
+    assert config.sweep_placer_exp
+    assert config.route_timeout == 1.5
+    assert config.place_timeout is None
+    assert config.sweep_jobs == 3
+    # Only the settings that change pipelining results
+    assert config.pipeline_settings() == {
+        "PIPELINED": "2",
+        "PIPELINE_TARGET_FREQ": "612.5",
+        "EXHAUSTIVE_PIPE": "1",
+        "PIPELINE_WHAT_IF": "8",
+        "PIPELINE_RETIME": "1",
+        "MEM2PE_REG_CHAIN": "",
+    }
@@ -0,0 +1,68 @@
+import json
+
+from archipelago.journal import Journal
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f.read().splitlines()]
+
+
+def test_new_journal(tmp_path):
+    filename = str(tmp_path / "search.journal")
+    journal = Journal(filename, "k")
+    assert not journal.resumed
+    assert journal.get(1) is None
+
+    journal.record(1, fits=True)
+    journal.record(2, fits=False)
+    assert journal.get(1) == {"trial": 1, "fits": True}
+    assert read_lines(filename) == [
+        {"key": "k"},
+        {"trial": 1, "fits": True},
+        {"trial": 2, "fits": False},
+    ]
+
+
+def test_resume_after_truncated_line(tmp_path):
+    filename = str(tmp_path / "search.journal")
+    journal = Journal(filename, "k")
+    journal.record(1, fits=True)
+    journal.record(2, fits=False)
+    # Preempted halfway through writing the third trial
+    with open(filename, "a") as f:
+        f.write('{"trial": 3, "fi')
+
+    journal = Journal(filename, "k")
+    assert journal.resumed
+    assert journal.get(1) == {"trial": 1, "fits": True}
+    assert journal.get(2) == {"trial": 2, "fits": False}
+    assert journal.get(3) is None
+
+    journal.record(3, fits=True)
+    assert read_lines(filename) == [
+        {"key": "k"},
+        {"trial": 1, "fits": True},
+        {"trial": 2, "fits": False},
+        {"trial": 3, "fits": True},
+    ]
+    assert Journal(filename, "k").get(3) == {"trial": 3, "fits": True}
+
+
+def test_other_key_starts_over(tmp_path):
+    filename = str(tmp_path / "search.journal")
+    Journal(filename, "k").record(1, fits=True)
+
+    journal = Journal(filename, "other")
+    assert not journal.resumed
+    assert journal.get(1) is None
+    assert read_lines(filename) == [{"key": "other"}]
+
+
+def test_empty_file_starts_over(tmp_path):
+    filename = tmp_path / "search.journal"
+    filename.write_text("")
+
+    journal = Journal(str(filename), "k")
+    assert not journal.resumed
+    assert read_lines(str(filename)) == [{"key": "k"}]
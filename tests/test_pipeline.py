@@ -0,0 +1,553 @@
+import json
+import sys
+
+import pytest
+
+from archipelago import pipeline
+from archipelago.config import PnRConfig
+from archipelago.pipeline import find_closest_match
+from archipelago.pnr_graph import TileNode, construct_graph
+from archipelago.sta import compute_timing, sta
+
+
+KERNELS = [
+    "op_hcompute_conv_stencil",
+    "io1_hw_input_global_wrapper_stencil_read",
+    "hw_input_global_wrapper_stencil_op_hcompute_hw_input_global_wrapper_stencil_write",
+    "hw_output_glb_stencil_op_hcompute_hw_output_stencil_read",
+    "conv_stencil_op_hcompute_conv_stencil_1_read",
+    "conv_stencil_op_hcompute_conv_stencil_1_write",
+]
+
+
+def test_find_closest_match():
+    assert find_closest_match("hcompute_conv_stencil", KERNELS) == KERNELS[0]
+    assert (
+        find_closest_match("op_hcompute_hw_input_global_wrapper_stencil", KERNELS)
+        == KERNELS[2]
+    )
+    # _write is preferred over _read
+    assert (
+        find_closest_match("conv_stencil_op_hcompute_conv_stencil_1", KERNELS)
+        == KERNELS[5]
+    )
+    assert (
+        find_closest_match(
+            "hw_output_global_wrapper_global_wrapper_stencil_op_hcompute_hw_output_stencil",
+            KERNELS,
+        )
+        is None
+    )
+    assert (
+        find_closest_match("hw_output_cgra_stencil_op_hcompute_hw_output_stencil", KERNELS)
+        == KERNELS[3]
+    )
+
+
+def test_find_closest_match_skips_io1():
+    kernels = ["io1_hw_input_stencil_read", "hw_input_stencil_read"]
+    assert find_closest_match("hw_input_stencil", kernels) == kernels[1]
+    assert find_closest_match("hw_input_stencil", kernels[:1]) is None
+
+
+def test_no_match_is_reported(capsys):
+    for _ in range(2):
+        assert find_closest_match("hcompute_missing", KERNELS) is None
+        assert capsys.readouterr().out == "No match for hcompute_missing\n"
+
+
+def build_graph(make_design, sparse=False, **kwargs):
+    placement, routing, id_to_name, netlist = make_design(**kwargs)
+    return construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, sparse)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_exhaustive_pipe_fills_every_site(make_design, sparse):
+    graph = build_graph(make_design, sparse)
+    sites = pipeline.find_exhaustive_sites(graph)
+    assert len(sites) > 0
+    assert pipeline.plan_exhaustive_pipe(graph) == sites
+
+    starting_regs = graph.added_regs
+    pipeline.exhaustive_pipe(graph, None, None, None)
+    assert graph.added_regs - starting_regs == len(sites) * (2 if sparse else 1)
+    assert pipeline.find_exhaustive_sites(graph) == []
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_exhaustive_pipe_register_budget(make_design, sparse):
+    graph = build_graph(make_design, sparse)
+    timing_info = compute_timing(graph, False)
+    ranked = pipeline.rank_register_sites(
+        graph, pipeline.find_exhaustive_sites(graph), timing_info
+    )
+    regs_per_site = 2 if sparse else 1
+
+    for max_regs in [0, 1, 2, 5]:
+        planned = pipeline.plan_exhaustive_pipe(graph, timing_info, max_regs=max_regs)
+        assert planned == ranked[: max_regs // regs_per_site]
+
+    starting_regs = graph.added_regs
+    pipeline.exhaustive_pipe(graph, None, None, None, max_regs=4)
+    assert graph.added_regs - starting_regs == 4
+
+
+def test_exhaustive_pipe_latency_budget(make_design):
+    graph = build_graph(make_design)
+    leaves = pipeline.get_route_leaves(graph)
+    timing_info = compute_timing(graph, False)
+    planned = pipeline.plan_exhaustive_pipe(graph, timing_info, max_latency=2)
+    assert len(planned) > 0
+
+    leaf_latency = {}
+    for (node, _), _ in planned:
+        for leaf in leaves[node]:
+            leaf_latency[leaf] = leaf_latency.get(leaf, 0) + 1
+    assert max(leaf_latency.values()) == 2
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("speedup", [1.5, 2])
+def test_solve_timing_closure_reaches_target(make_design, sparse, speedup):
+    graph = build_graph(make_design, sparse, n=4, span=8)
+    target_freq = sta(graph, False)[0] * speedup
+    starting_regs = graph.added_regs
+    rounds = []
+
+    added = pipeline.solve_timing_closure(
+        graph, target_freq, False, rebalance=lambda: rounds.append(graph.added_regs)
+    )
+    assert sta(graph, False)[0] >= target_freq
+    assert added == graph.added_regs - starting_regs > 0
+    assert len(rounds) > 0 and rounds[-1] == graph.added_regs
+
+
+def test_solve_timing_closure_met_target(make_design):
+    graph = build_graph(make_design)
+    starting_regs = graph.added_regs
+    assert pipeline.solve_timing_closure(graph, sta(graph, False)[0], False) == 0
+    assert graph.added_regs == starting_regs
+
+
+def test_solve_timing_closure_unreachable_target(make_design, capsys):
+    graph = build_graph(make_design, n=2, span=3)
+    pipeline.solve_timing_closure(graph, 1.0e6, False)
+    assert "No register sites left" in capsys.readouterr().out
+    assert pipeline.find_exhaustive_sites(graph) == []
+
+
+def test_select_register_cover_greedy(monkeypatch):
+    # Without scipy: the site covering most paths first, ties to the site
+    # leaving the shortest remaining path
+    monkeypatch.setitem(sys.modules, "scipy.optimize", None)
+    path_sites = [{"a": 5, "b": 4}, {"b": 6, "c": 3}, {"c": 2, "d": 1}]
+    assert pipeline.select_register_cover(path_sites) == ["c", "a"]
+    assert pipeline.select_register_cover([{"a": 5, "b": 4}]) == ["b"]
+    assert pipeline.select_register_cover([]) == []
+
+
+def test_select_register_cover_ilp():
+    pytest.importorskip("scipy")
+    # Greedy takes a first and needs three, the cover is b and c
+    path_sites = [
+        {"a": 1, "b": 1},
+        {"a": 1, "c": 1},
+        {"a": 1, "b": 1},
+        {"b": 1},
+        {"c": 1},
+    ]
+    assert sorted(pipeline.select_register_cover(path_sites)) == ["b", "c"]
+
+
+def unbalanced_fork(make_fork_design, cycles):
+    # cycles registers on the east branch of the fork, none on the south one
+    placement, routing, id_to_name, netlist = make_fork_design(length=6)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    east, south = sorted(graph.sinks[fork], key=lambda node: node.side)
+    branch = pipeline.branch_segment(graph, fork, east)
+    assert branch[0] is fork
+    idxs = graph.get_register_sites().free_sites(branch)[::2][:cycles]
+    graph.insert_registers([((branch[idx], branch[idx + 1]), None) for idx in idxs])
+    return graph, fork, south
+
+
+@pytest.mark.parametrize("cycles", [1, 2, 3])
+def test_materialize_branch_delays_matches_break_at(make_fork_design, cycles):
+    config = PnRConfig({})
+    port_remap = {"pe": {}}
+
+    graph, fork, south = unbalanced_fork(make_fork_design, cycles)
+    _, node_cycles, edge_delays = pipeline.solve_branch_delays(
+        graph, {}, port_remap, config
+    )
+    assert edge_delays == {(fork, south): cycles}
+    starting_regs = graph.added_regs
+    assert pipeline.materialize_branch_delays(graph, edge_delays, node_cycles) == cycles
+    assert graph.added_regs - starting_regs == cycles
+    kernel_latencies, _, edge_delays = pipeline.solve_branch_delays(
+        graph, {}, port_remap, config
+    )
+    assert edge_delays == {}
+
+    expected, _, expected_south = unbalanced_fork(make_fork_design, cycles)
+    pipeline.break_at(expected, expected_south, None, None, None, cycles=cycles)
+    expected_latencies, _, edge_delays = pipeline.solve_branch_delays(
+        expected, {}, port_remap, config
+    )
+    assert edge_delays == {}
+    assert kernel_latencies == expected_latencies
+
+
+def test_materialize_branch_delays_needs_free_sites(make_fork_design):
+    graph, fork, south = unbalanced_fork(make_fork_design, 1)
+    with pytest.raises(ValueError):
+        pipeline.materialize_branch_delays(graph, {(fork, south): 100})
+
+
+def branch_path(graph, start, end):
+    # The single-fanout chain from start to end, as break_at walks it
+    path = [start]
+    while path[-1] is not end:
+        path.append(graph.sinks[path[-1]][0])
+    return path
+
+
+@pytest.mark.parametrize("cycles", [1, 2, 3])
+def test_break_at_spreads_cycles(make_fork_design, cycles):
+    placement, routing, id_to_name, netlist = make_fork_design(length=8)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    south = max(graph.sinks[fork], key=lambda node: node.side)
+    path = branch_path(graph, south, graph.tile_id_to_tile["p3"])
+    idxs = graph.get_register_sites().spread_free_sites(path, cycles)
+    assert len(idxs) == cycles
+    assert all(b - a >= 2 for a, b in zip(idxs, idxs[1:]))
+    if cycles == 1:
+        middle = (len(path) - 1) / 2
+        free = graph.get_register_sites().free_sites(path)
+        assert idxs == [min(free, key=lambda idx: abs(idx - middle))]
+
+    starting_regs = graph.added_regs
+    pipeline.break_at(graph, south, None, None, None, cycles=cycles)
+    assert graph.added_regs - starting_regs == cycles
+    for idx in idxs:
+        detour = branch_path(graph, path[idx], path[idx + 1])
+        assert [node.tile_id for node in detour if isinstance(node, TileNode)] == [
+            f"r{starting_regs + idxs.index(idx)}"
+        ]
+
+    # Now the east branch is the short one
+    east = min(graph.sinks[fork], key=lambda node: node.side)
+    _, _, edge_delays = pipeline.solve_branch_delays(
+        graph, {}, {"pe": {}}, PnRConfig({})
+    )
+    assert edge_delays == {(fork, east): cycles}
+
+
+def test_break_at_all_or_nothing(make_fork_design):
+    placement, routing, id_to_name, netlist = make_fork_design()
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    south = max(graph.sinks[fork], key=lambda node: node.side)
+    edges = list(graph.edges)
+    starting_regs = graph.added_regs
+
+    pipeline.break_at(graph, south, None, None, None, cycles=0)
+    with pytest.raises(ValueError):
+        pipeline.break_at(graph, south, None, None, None, cycles=100)
+    assert list(graph.edges) == edges
+    assert graph.added_regs == starting_regs
+
+
+def test_break_at_absorbs_into_pond(make_pond_design):
+    placement, routing, id_to_name, netlist = make_pond_design()
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    pond = graph.tile_id_to_tile["M1"]
+    p2 = graph.tile_id_to_tile["p2"]
+    starting_regs = graph.added_regs
+
+    pipeline.break_at(graph, graph.sources[p2][0], None, None, None, cycles=3)
+    assert pond.input_port_latencies["data_in_pond"] == 3
+    assert graph.added_regs == starting_regs
+
+
+def scan_port_sources(graph, tile, port, port_remap_r):
+    # The per-port scan KernelPortIndex replaced
+    sources = [
+        source
+        for source in graph.sources[tile]
+        if port_remap_r.get(source.port) == port
+    ]
+    removed = [
+        source
+        for source, dest in graph.removed_edges
+        if dest == tile and port_remap_r.get(source.port) == port
+    ]
+    return sources, removed
+
+
+def test_kernel_port_index_matches_scan(make_design):
+    placement, routing, id_to_name, netlist = make_design(n=3)
+    id_to_name["p2"] += "@track1"
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    # A cycle break moves the edge into the port to removed_edges
+    p9 = graph.tile_id_to_tile["p9"]
+    port_node = graph.sources[p9][0]
+    graph.removed_edges.append((port_node, p9))
+    graph.removed_edges.append((graph.sources[port_node][0], p9))
+    port_remap_r = {"data0": "in0", "data1": "in1"}
+
+    index = pipeline.KernelPortIndex(graph, port_remap_r)
+    for tile in graph.get_tiles():
+        name = graph.id_to_name[str(tile)]
+        assert tile in index.tiles_by_name[name]
+        assert tile in index.tiles_by_stripped_name[name.split("@")[0]]
+        for port in ["in0", "in1", "out"]:
+            sources, removed = scan_port_sources(graph, tile, port, port_remap_r)
+            assert index.port_sources.get((tile, port), []) == sources
+            assert index.removed_port_sources.get((tile, port), []) == removed
+
+    assert index.tiles_by_name["op_hcompute_k0$inner_compute$p2@track1"] == [
+        graph.tile_id_to_tile["p2"]
+    ]
+    assert index.tiles_by_stripped_name["op_hcompute_k0$inner_compute$p2"] == [
+        graph.tile_id_to_tile["p2"]
+    ]
+    assert "op_hcompute_k0$inner_compute$p2" not in index.tiles_by_name
+    assert index.removed_port_sources[(p9, "in1")] == [port_node]
+
+
+def test_ports_with_unique_latencies(make_design):
+    graph = build_graph(make_design, n=3)
+    p1, p3, p9 = (graph.tile_id_to_tile[blk] for blk in ["p1", "p3", "p9"])
+    kernel_latencies = {
+        "hcompute_k1": {
+            "in": {"pe_port": [["p1", "in0"], ["p3", "in0"], ["p9", "in1"]]},
+            "unused": {"pe_port": []},
+        },
+        "hcompute_k0": {"in": {"pe_port": [["p2", "in0"]]}},
+        "hw_input_glb_stencil": {"in": {"pe_port": [["p1", "in0"]]}},
+    }
+    node_cycles = {"op_hcompute_k0": {}, "op_hcompute_k1": {}}
+
+    groups = pipeline.get_ports_with_unique_latencies(
+        graph, kernel_latencies, node_cycles, {"data0": "in0", "data1": "in1"}
+    )
+    assert groups == {
+        "op_hcompute_k1": [
+            [graph.sources[p1][0], graph.sources[p3][0], graph.sources[p9][0]]
+        ],
+        "op_hcompute_k0": [[graph.sources[graph.tile_id_to_tile["p2"]][0]]],
+    }
+
+
+def walk_flush_cycles(graph, io, mem):
+    # The per-memory walk back to the reset IO that get_flush_arrivals replaced
+    parent_node = next(node for node in graph.sources[mem] if node.port == "flush")
+    cycles = 0
+    curr_node = mem
+    while parent_node != io:
+        if isinstance(curr_node, TileNode):
+            cycles += curr_node.input_port_latencies[parent_node.port]
+        curr_node = parent_node
+        parent_node = graph.sources[parent_node][0]
+    return cycles
+
+
+def test_flush_arrivals_follow_registers(make_flush_design):
+    placement, routing, id_to_name, netlist = make_flush_design()
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    io = graph.tile_id_to_tile["i0"]
+    m1, m2 = graph.tile_id_to_tile["m1"], graph.tile_id_to_tile["m2"]
+
+    def check(expected):
+        flush_cycles, max_flush_cycles = pipeline.flush_cycles(
+            graph, id_to_name, False, 0, None
+        )
+        walked = {mem: walk_flush_cycles(graph, io, mem) for mem in [m1, m2]}
+        assert max_flush_cycles == max(walked.values())
+        assert flush_cycles == {
+            mem: max_flush_cycles - cycles for mem, cycles in walked.items()
+        }
+        assert flush_cycles == expected
+
+    check({m1: 0, m2: 0})
+    arrivals = graph.flush_arrivals
+    assert graph.get_flush_arrivals(io) is arrivals
+
+    # Off the flush tree the cached arrivals stay
+    p1 = graph.tile_id_to_tile["p1"]
+    path = branch_path(graph, graph.tile_id_to_tile["I1"], p1)
+    idx = graph.get_register_sites().free_sites(path)[0]
+    graph.insert_registers([((path[idx], path[idx + 1]), None)])
+    assert graph.get_flush_arrivals(io) is arrivals
+
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    south = max(graph.sinks[fork], key=lambda node: node.side)
+    path = branch_path(graph, south, m2)
+    idxs = graph.get_register_sites().free_sites(path)[::2][:2]
+    graph.insert_registers([((path[idx], path[idx + 1]), None) for idx in idxs])
+    assert graph.flush_arrivals is None
+    check({m1: 2, m2: 0})
+
+
+def latency_state(tmp_path, sparse=False):
+    (tmp_path / "design.port_remap").write_text(json.dumps({"pe": {}}))
+    (tmp_path / "app_compute_kernel_latencies.json").write_text("{}")
+    return pipeline.KernelLatencyState(
+        str(tmp_path), {}, False, {}, 0, None, sparse, PnRConfig({})
+    )
+
+
+def fake_compute(state, computed):
+    # Stands in for latency matching, which logs the registers it inserts
+    def compute(graph, id_to_name, placement, routing):
+        computed.append(graph)
+        graph.change_log.append(graph.nodes[0])
+        return {f"{state.dir_name}/out.json": {"n": len(computed)}}
+
+    return compute
+
+
+def test_latency_state_recomputes_after_splice(make_fork_design, tmp_path):
+    state = latency_state(tmp_path)
+    computed = []
+    state.compute = fake_compute(state, computed)
+    graph = build_graph(make_fork_design)
+
+    state.update(graph, None, None, None)
+    state.update(graph, None, None, None)
+    assert computed == [graph]
+
+    # Inputs are only read on the first update
+    (tmp_path / "design.port_remap").unlink()
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    path = branch_path(graph, graph.sinks[fork][0], graph.tile_id_to_tile["p2"])
+    idx = graph.get_register_sites().free_sites(path)[0]
+    graph.insert_registers([((path[idx], path[idx + 1]), None)])
+    state.update(graph, None, None, None)
+    state.update(graph, None, None, None)
+    assert computed == [graph, graph]
+
+    other = build_graph(make_fork_design)
+    state.update(other, None, None, None)
+    assert computed == [graph, graph, other]
+
+    assert not (tmp_path / "out.json").exists()
+    state.write()
+    assert json.loads((tmp_path / "out.json").read_text()) == {"n": 3}
+
+
+def test_latency_state_sparse_skips_matching(make_fork_design, tmp_path):
+    state = latency_state(tmp_path, sparse=True)
+    computed = []
+    state.compute = fake_compute(state, computed)
+    state.update(build_graph(make_fork_design), None, None, None)
+    assert computed == []
+    state.write()
+    assert not (tmp_path / "out.json").exists()
+
+
+def edge_names(graph):
+    return sorted((str(node1), str(node2)) for node1, node2 in graph.edges)
+
+
+def trunk_register(make_fork_design, first=True):
+    # A fork with a long trunk and a register at one end of it
+    placement, routing, id_to_name, netlist = make_fork_design(trunk=8, length=2)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    p1 = graph.tile_id_to_tile["p1"]
+    fork = next(node for node in graph.nodes if len(graph.sinks[node]) > 1)
+    path = branch_path(graph, graph.sinks[p1][0], fork)
+    idx = graph.get_register_sites().free_sites(path)[0 if first else -1]
+    (reg,) = graph.insert_registers([((path[idx], path[idx + 1]), None)])
+    return graph, reg, path
+
+
+def test_register_segment(make_fork_design):
+    graph, reg, trunk = trunk_register(make_fork_design, first=False)
+    segment = pipeline.register_segment(graph, reg)
+    # The trunk from p1's output port up to the fork, without the register
+    assert segment == trunk
+    idx = segment.index(graph.sources[graph.sources[reg][0]][0])
+    assert graph.sinks[graph.sinks[reg][0]][0] is segment[idx + 1]
+
+
+def test_get_retimable_regs(make_fork_design):
+    graph, reg, _ = trunk_register(make_fork_design)
+    movable, removable = pipeline.get_retimable_regs(graph)
+    assert movable == [reg] and removable == [reg]
+
+    # A register from the netlist can be moved but not removed
+    graph.id_to_name[reg.tile_id] = "reg_k$r0@" + reg.tile_id
+    movable, removable = pipeline.get_retimable_regs(graph)
+    assert movable == [reg] and removable == []
+
+
+def test_retime_moves_register(make_fork_design):
+    graph, reg, _ = trunk_register(make_fork_design)
+    freq, _, _ = sta(graph, False)
+    segment = [str(node) for node in pipeline.register_segment(graph, reg)]
+
+    assert pipeline.retime_registers(graph, False) == 0
+    (reg,) = graph.get_regs()
+    assert sta(graph, False)[0] > freq
+    assert [str(node) for node in pipeline.register_segment(graph, reg)] == segment
+
+
+def test_retime_removes_unneeded_register(make_flush_design):
+    # The unregistered flush net is the critical path, the register on the
+    # short data net doesn't help it
+    placement, routing, id_to_name, netlist = make_flush_design()
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    path = branch_path(graph, graph.tile_id_to_tile["I1"], graph.tile_id_to_tile["p1"])
+    idx = graph.get_register_sites().free_sites(path)[0]
+    graph.insert_registers([((path[idx], path[idx + 1]), None)])
+    freq, _, _ = sta(graph, False)
+    edges = edge_names(graph)
+
+    def rebalance_adds_register():
+        if graph.get_regs() == []:
+            graph.insert_registers([((path[idx + 3], path[idx + 4]), None)])
+
+    # Rejected when latency matching puts a register back
+    assert pipeline.retime_registers(graph, False, rebalance_adds_register) == 0
+    assert edge_names(graph) == edges
+
+    assert pipeline.retime_registers(graph, False, lambda: None) == -1
+    assert graph.get_regs() == []
+    assert sta(graph, False)[0] == freq
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_what_if_parallel_matches_serial(make_design, sparse):
+    graph = build_graph(make_design, sparse, n=2, span=10, branch=False)
+    _, crit_path, _ = sta(graph, False)
+    edges = edge_names(graph)
+    added_regs = graph.added_regs
+
+    serial = pipeline.what_if_break_idx(graph, crit_path, False, 6, jobs=1)
+    assert edge_names(graph) == edges
+    assert graph.added_regs == added_regs
+    parallel = pipeline.what_if_break_idx(graph, crit_path, False, 6, jobs=4)
+    assert parallel == serial
+    assert edge_names(graph) == edges
+    assert graph.added_regs == added_regs
+
+    # Each candidate timed on its own copy of the graph
+    candidates = graph.get_register_sites().ranked_free_sites(
+        [n for n, c in crit_path], [c for n, c in crit_path], 6
+    )
+    assert len(candidates) == 6
+    delays = []
+    for idx in candidates:
+        trial = build_graph(make_design, sparse, n=2, span=10, branch=False)
+        _, trial_path, _ = sta(trial, False)
+        pipeline.break_crit_path(trial, None, trial_path, None, None, idx)
+        delays.append(sta(trial, False)[1][-1][1])
+    assert serial == candidates[delays.index(min(delays))]
+
+    assert pipeline.choose_break_idx(
+        graph, crit_path, False, what_if=1
+    ) == pipeline.find_break_idx(graph, crit_path)
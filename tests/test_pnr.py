@@ -0,0 +1,360 @@
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from archipelago import pnr_
+from archipelago.config import PnRConfig
+from archipelago.watchdog import PnRToolError
+
+
+# Frequency of each PNR_PLACER_EXP trial, None if it doesn't route
+FREQS = {1: 100, 2: 300, 3: 300, 4: None}
+
+
+class FakeTools:
+    """Placer, router, pipelining and STA stand-ins for the sweep. Each
+    trial's pipeline dir records what pipeline_pnr saw in seen.json."""
+
+    def __init__(self, wait_for_next=False):
+        # With wait_for_next, pipelining a trial waits for the next trial to
+        # be placed, which only happens when the two stages overlap
+        self.wait_for_next = wait_for_next
+
+    def place(self, packed_file, layout_filename, placement_filename, has_fixed, env):
+        with open(placement_filename, "w") as f:
+            f.write(env["PNR_PLACER_EXP"])
+
+    def route(
+        self,
+        packed_file,
+        placement_filename,
+        graph_path,
+        route_filename,
+        max_frequency,
+        layout_filename,
+        wave_info,
+        shift_registers,
+        env,
+    ):
+        exp = int(env["PNR_PLACER_EXP"])
+        if FREQS[exp] is None:
+            raise PnRToolError("unroutable", 1, ["router"])
+        with open(route_filename, "w") as f:
+            f.write(str(exp))
+
+    def pipeline_pnr(
+        self,
+        pipeline_dir,
+        placement,
+        routing,
+        id_to_name,
+        netlist,
+        load_only,
+        *args,
+    ):
+        config = args[-1]
+        latencies = os.path.join(pipeline_dir, "app_compute_kernel_latencies.json")
+        with open(latencies) as f:
+            seen_latencies = json.load(f)
+        overlapped = None
+        if self.wait_for_next:
+            next_place = os.path.join(
+                os.path.dirname(pipeline_dir),
+                os.pardir,
+                f"exp_{config.placer_exp + 1}",
+                "app.place",
+            )
+            deadline = time.time() + 10
+            while not os.path.exists(next_place) and time.time() < deadline:
+                time.sleep(0.01)
+            overlapped = os.path.exists(next_place)
+        seen = {
+            "files": sorted(os.listdir(pipeline_dir)),
+            "latencies": seen_latencies,
+            "what_if_jobs": config.what_if_jobs,
+            "overlapped": overlapped,
+        }
+        with open(latencies, "w") as f:
+            json.dump({"exp": config.placer_exp}, f)
+        with open(os.path.join(pipeline_dir, "seen.json"), "w") as f:
+            json.dump(seen, f)
+        for name in ["design.place", "design.route"]:
+            open(os.path.join(pipeline_dir, name), "w").close()
+        return placement, routing, id_to_name
+
+    def run_sta(
+        self,
+        packed_file,
+        placement_filename,
+        route_filename,
+        id_to_name,
+        sparse,
+        west_in_io_sides,
+        config,
+    ):
+        return FREQS[config.placer_exp]
+
+
+@pytest.fixture
+def sweep(tmp_path, monkeypatch):
+    def run(staged=True, jobs=2, route_jobs=2, tools=None):
+        tools = FakeTools() if tools is None else tools
+        for name in ["place", "route", "pipeline_pnr", "run_sta"]:
+            monkeypatch.setattr(pnr_, name, getattr(tools, name))
+        monkeypatch.setattr(pnr_, "load_routing_result", lambda filename: {})
+        monkeypatch.setattr(pnr_.pycyclone.io, "load_placement", lambda f: {})
+        if not staged:
+            monkeypatch.setattr(
+                multiprocessing, "get_all_start_methods", lambda: ["spawn"]
+            )
+
+        cwd = tmp_path / "app"
+        cwd.mkdir(exist_ok=True)
+        (cwd / "design.port_remap").write_text("{}")
+        (cwd / "app_compute_kernel_latencies.json").write_text('{"k": 1}')
+        (cwd / "ub_latency.json").write_text("{}")
+        # Not read by pipeline_pnr, so not copied into the trials
+        (cwd / "design.place").write_text("old")
+        for name in ["app.packed", "app.layout", "16.graph"]:
+            (cwd / name).write_text(name)
+
+        config = PnRConfig({}, PNR_SWEEP_JOBS=jobs, PNR_SWEEP_ROUTE_JOBS=route_jobs)
+        trial_dir, freq, exp = pnr_.__sweep_placer_exp(
+            str(cwd),
+            "app",
+            str(cwd / "app.packed"),
+            str(cwd / "app.layout"),
+            f"16 {cwd / '16.graph'}",
+            None,
+            False,
+            None,
+            {},
+            {},
+            False,
+            {},
+            0,
+            None,
+            False,
+            False,
+            config,
+            max_exp=len(FREQS),
+        )
+        seen = {}
+        for e in FREQS:
+            filename = cwd / "pnr_sweep" / f"exp_{e}" / "pipeline" / "seen.json"
+            if filename.exists():
+                seen[e] = json.loads(filename.read_text())
+        return trial_dir, freq, exp, seen, cwd
+
+    return run
+
+
+@pytest.mark.parametrize("staged", [True, False])
+def test_sweep_picks_fastest_smallest_exp(sweep, staged):
+    trial_dir, freq, exp, seen, cwd = sweep(staged)
+    assert (freq, exp) == (300, 2)
+    assert trial_dir == str(cwd / "pnr_sweep" / "exp_2")
+    assert sorted(seen) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("staged", [True, False])
+def test_sweep_trials_pipeline_private_copies(sweep, staged):
+    _, _, _, seen, cwd = sweep(staged)
+    for s in seen.values():
+        assert s["files"] == [
+            "app_compute_kernel_latencies.json",
+            "design.port_remap",
+            "ub_latency.json",
+        ]
+        assert s["latencies"] == {"k": 1}
+    assert json.loads((cwd / "app_compute_kernel_latencies.json").read_text()) == {
+        "k": 1
+    }
+    assert (cwd / "design.place").read_text() == "old"
+
+
+def test_staged_sweep_overlaps_stages(sweep):
+    _, freq, exp, seen, _ = sweep(
+        jobs=1, route_jobs=1, tools=FakeTools(wait_for_next=True)
+    )
+    assert (freq, exp) == (300, 2)
+    # Trial 1 was pipelined while trial 2 was placed
+    assert seen[1]["overlapped"]
+    # The analysis workers can't fork what-if pools of their own
+    assert all(s["what_if_jobs"] == 1 for s in seen.values())
+
+
+# How the fake router ends for each PNR_PLACER_EXP: 0 doesn't route, 1
+# crashes, 2 routes and anything higher would route if it wasn't cancelled
+ROUTER = """
+import os, sys, time
+exp = int(os.environ["PNR_PLACER_EXP"])
+if exp == 0:
+    sys.exit(1)
+if exp == 1:
+    os.abort()
+time.sleep(0.2 if exp == 2 else 30)
+"""
+
+
+@pytest.fixture
+def speculative(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        pnr_,
+        "placer_args",
+        lambda packed, layout, placement, fixed: [
+            sys.executable,
+            "-c",
+            f"open({placement!r}, 'w').close()",
+        ],
+    )
+    monkeypatch.setattr(
+        pnr_,
+        "router_args",
+        lambda *args, **kwargs: [sys.executable, "-c", ROUTER],
+    )
+    for name in ["app.packed", "app.layout", "16.graph"]:
+        (tmp_path / name).write_text(name)
+
+    def run(**env):
+        config = PnRConfig(
+            {},
+            PNR_SPECULATIVE_JOBS=3,
+            PNR_EXP_HISTORY=tmp_path / "history.json",
+            **env,
+        )
+        return pnr_.__speculative_placer_exp(
+            str(tmp_path),
+            "app",
+            str(tmp_path / "app.packed"),
+            str(tmp_path / "app.layout"),
+            f"16 {tmp_path / '16.graph'}",
+            None,
+            False,
+            None,
+            {},
+            config,
+            max_exp=5,
+        )
+
+    return run
+
+
+def test_speculative_search_remembers_unroutable(speculative, tmp_path, capsys):
+    start = time.time()
+    assert speculative() == 2
+    # Higher values are cancelled, not waited for
+    assert time.time() - start < 20
+    out = capsys.readouterr().out
+    assert "Unable to route with PNR_PLACER_EXP: 0 (unroutable)" in out
+    assert "Unable to route with PNR_PLACER_EXP: 1 (crash)" in out
+
+    # The crash isn't remembered, it may not happen again
+    (history,) = json.loads((tmp_path / "history.json").read_text()).values()
+    assert history == {"failed": [0], "routable": 2}
+
+    assert speculative() == 2
+    out = capsys.readouterr().out
+    assert "Skipping PNR_PLACER_EXP values known not to route: [0]" in out
+    assert not (tmp_path / "pnr_search" / "exp_0").exists()
+
+    # A different placer or router setting starts a new history
+    assert speculative(PNR_TEST_SETTING=1) == 2
+    assert "Skipping" not in capsys.readouterr().out
+    assert len(json.loads((tmp_path / "history.json").read_text())) == 2
+
+
+def test_exp_history_key(tmp_path):
+    for name in ["app.packed", "app.layout", "16.graph"]:
+        (tmp_path / name).write_text(name)
+
+    def key(config, fixed_pos=None):
+        return pnr_.__pnr_exp_history_key(
+            str(tmp_path / "app.packed"),
+            str(tmp_path / "app.layout"),
+            f"16 {tmp_path / '16.graph'}",
+            fixed_pos,
+            None,
+            False,
+            config,
+        )
+
+    base = key(PnRConfig({}))
+    assert key(PnRConfig({}, PNR_PLACER_EXP=3, PNR_SPECULATIVE_JOBS=4)) == base
+    # Watchdog settings are archipelago's own, the tools never see them
+    assert key(PnRConfig({}, PNR_ROUTE_TIMEOUT=60)) == base
+    assert key(PnRConfig({}, PNR_TEST_SETTING=1)) != base
+    assert key(PnRConfig({}), fixed_pos={"p1": (1, 1)}) != base
+    (tmp_path / "16.graph").write_text("another fabric")
+    assert key(PnRConfig({})) != base
+
+
+@pytest.fixture
+def compact(monkeypatch):
+    # Column counts 3, 5, ..., 21, the design fits from fits_from on
+    monkeypatch.setattr(pnr_, "get_group_size", lambda arch: 2)
+    monkeypatch.setattr(pnr_, "get_max_num_col", lambda netlist, arch: 3)
+    monkeypatch.setattr(pnr_, "cached_dump_pnr", lambda *args: None)
+    monkeypatch.setattr(pnr_, "interconnect_fingerprint", lambda arch: "arch")
+    arch = types.SimpleNamespace(x_max=20)
+
+    def run(fits_from, cwd="", jobs=None):
+        probed = []
+        lock = threading.Lock()
+
+        def pnr(arch, input_netlist, **kargs):
+            col = kargs["max_num_col"]
+            with lock:
+                probed.append(col)
+            if col < fits_from:
+                raise pnr_.PnRException()
+            if len(kargs["cwd"]) > 0:
+                with open(os.path.join(kargs["cwd"], "design.place"), "w") as f:
+                    f.write(str(col))
+            return col
+
+        monkeypatch.setattr(pnr_, "pnr", pnr)
+        config = PnRConfig({}, PNR_COMPACT_JOBS=jobs)
+        try:
+            return pnr_.__compact_pnr(
+                arch,
+                ({}, {}),
+                cwd=cwd,
+                copy_to_dir=None,
+                app_name="",
+                config=config,
+            ), probed
+        except pnr_.PnRException:
+            return None, probed
+
+    return run
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 3, 16])
+def test_bisect_compact_matches_linear_scan(compact, jobs):
+    for fits_from in [0, 3, 4, 9, 15, 21, 22]:
+        expected, scanned = compact(fits_from)
+        col, probed = compact(fits_from, jobs=jobs)
+        assert col == expected
+        if expected is not None:
+            assert scanned[-1] == expected
+        # Every round narrows the range, nothing is probed twice
+        assert len(set(probed)) == len(probed)
+        if jobs == 1:
+            assert len(probed) <= 5
+
+
+def test_bisect_compact_keeps_narrowest_probe(compact, tmp_path):
+    (tmp_path / "design.packed").write_text("packed")
+    col, probed = compact(12, cwd=str(tmp_path), jobs=3)
+    assert col == 13
+    assert (tmp_path / "design.place").read_text() == "13"
+    assert (tmp_path / "design.packed").read_text() == "packed"
+    # The search is done, its journal and probe directories are gone
+    assert not (tmp_path / "pnr_compact").exists()
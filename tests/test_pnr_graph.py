@@ -0,0 +1,251 @@
+import copy
+import random
+
+import pytest
+
+from archipelago import pipeline
+from archipelago.pnr_graph import (
+    JournaledDict,
+    RegisterSiteIndex,
+    RouteIndex,
+    RouteNode,
+    RouteType,
+    TileType,
+    UndoJournal,
+    construct_graph,
+)
+from archipelago.sta import sta
+
+
+def test_rollback_undoes_dict_edits():
+    journal = UndoJournal()
+    original = {"a": 1, "b": 2, "c": 3}
+    data = JournaledDict(original, journal)
+
+    data["a"] = 10
+    data["d"] = 4
+    del data["b"]
+    assert data.pop("c") == 3
+    assert data.pop("missing", None) is None
+    data.setdefault("e", 5)
+    data.setdefault("a", 0)
+    data.update({"d": 40, "f": 6}, g=7)
+    assert data == {"a": 10, "d": 40, "e": 5, "f": 6, "g": 7}
+
+    journal.rollback()
+    assert data == original
+    assert journal.checkpoint() == 0
+
+
+def test_rollback_to_checkpoint():
+    journal = UndoJournal()
+    data = JournaledDict({"a": 1}, journal)
+
+    data["a"] = 2
+    data["b"] = 3
+    checkpoint = journal.checkpoint()
+    data["a"] = 4
+    del data["b"]
+    data["c"] = 5
+
+    journal.rollback(checkpoint)
+    assert data == {"a": 2, "b": 3}
+    assert journal.checkpoint() == checkpoint
+
+    journal.rollback()
+    assert data == {"a": 1}
+
+
+def test_rollback_undoes_route_splices(make_design):
+    _, routes, _, _ = make_design()
+    original = copy.deepcopy(routes)
+    journal = UndoJournal()
+    routing = JournaledDict(routes, journal)
+    index = RouteIndex(routing)
+
+    route = routing["e2"][0]
+    reg = ["REG", "T0_EAST", 0, 0, 0, 16]
+    assert index.insert_after(route[2], reg)
+    assert index.remove(route[5])
+    assert index.find(reg) == ("e2", 0, 3)
+    assert routing != original
+
+    journal.rollback()
+    assert routing == original
+
+
+def scan(routes, segment):
+    # First (net_id, route index, position) of segment, the linear search
+    # RouteIndex replaces
+    for net_id, net in routes.items():
+        for route_idx, route in enumerate(net):
+            for pos, s in enumerate(route):
+                if s == segment:
+                    return (net_id, route_idx, pos)
+    return None
+
+
+def test_route_index_matches_scan(make_design):
+    _, routes, _, _ = make_design(n=3, span=5)
+    index = RouteIndex(routes)
+    segments = [s for net in routes.values() for route in net for s in route]
+
+    random.seed(1)
+    inserted = []
+    for i in range(40):
+        if inserted and random.random() < 0.3:
+            reg = inserted.pop(random.randrange(len(inserted)))
+            assert index.remove(reg)
+            assert not index.remove(reg)
+        else:
+            reg = ["REG", f"T{i}_EAST", i, 0, 0, 16]
+            assert index.insert_after(random.choice(segments + inserted), reg)
+            inserted.append(reg)
+
+        for segment in segments + inserted:
+            assert index.find(segment) == scan(routes, segment)
+
+    assert index.find(["REG", "T99_EAST", 99, 0, 0, 16]) is None
+    assert not index.insert_after(["REG", "T99_EAST", 99, 0, 0, 16], ["REG"])
+
+
+def test_route_index_first_match():
+    # The branch to n2 shares its first hops with the one to n1
+    shared = [["PORT", "O0", 0, 0, 16], ["SB", 0, 0, 0, 0, 1, 16]]
+    routes = {
+        "e1": [
+            shared + [["RMUX", "T0_EAST_B16", 0, 0, 16]],
+            shared + [["RMUX", "T0_SOUTH_B16", 0, 0, 16]],
+        ]
+    }
+    index = RouteIndex(routes)
+    reg = ["REG", "T0_EAST", 0, 0, 0, 16]
+    assert index.insert_after(shared[1], reg)
+    assert routes["e1"][0][2] == reg
+    assert routes["e1"][1] == shared + [["RMUX", "T0_SOUTH_B16", 0, 0, 16]]
+    assert index.find(["RMUX", "T0_EAST_B16", 0, 0, 16]) == ("e1", 0, 3)
+    assert index.find(["RMUX", "T0_SOUTH_B16", 0, 0, 16]) == ("e1", 1, 2)
+
+
+def node_key(node):
+    # Kernel labels, register tile ids and which of a register's two REG
+    # nodes is flagged depend on how the graph was built, not on the design
+    if isinstance(node, RouteNode):
+        segment = node.to_route()
+        return ("route", tuple(segment), node.port, node.net_id)
+    if node.tile_type == TileType.REG:
+        return ("reg", node.x, node.y)
+    return ("tile", node.tile_id)
+
+
+def edge_keys(graph):
+    return sorted((node_key(a), node_key(b)) for a, b in graph.edges)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_insert_register_matches_rebuild(make_design, sparse):
+    placement, routing, id_to_name, netlist = make_design(n=3, span=6)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, sparse)
+
+    random.seed(2)
+    regs = []
+    for _ in range(4):
+        edge, paired_edge = random.choice(pipeline.find_exhaustive_sites(graph))
+        regs += graph.insert_register(edge, paired_edge=paired_edge)
+    assert len(regs) == (8 if sparse else 4)
+    for reg in regs:
+        assert placement[reg.tile_id] == (reg.x, reg.y)
+        assert id_to_name[reg.tile_id].startswith("pnr_pipelining_")
+
+    rebuilt = construct_graph(
+        copy.deepcopy(placement),
+        copy.deepcopy(routing),
+        copy.deepcopy(id_to_name),
+        netlist,
+        1,
+        0,
+        1,
+        sparse,
+    )
+    assert edge_keys(graph) == edge_keys(rebuilt)
+    assert sta(graph, False)[0] == sta(rebuilt, False)[0]
+
+
+def test_insert_register_rejects_bad_site(make_design):
+    placement, routing, id_to_name, netlist = make_design(n=2)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    edges = edge_keys(graph)
+    original = copy.deepcopy(routing)
+
+    port_edge = next(
+        (a, b)
+        for a, b in graph.edges
+        if isinstance(a, RouteNode) and a.route_type == RouteType.PORT
+    )
+    with pytest.raises(ValueError):
+        graph.insert_register(port_edge)
+    (sb, rmux), _ = pipeline.find_exhaustive_sites(graph)[0]
+    with pytest.raises(ValueError):
+        graph.insert_register((rmux, sb))
+
+    assert edge_keys(graph) == edges
+    assert routing == original
+
+
+def site_state(sites):
+    return (
+        {str(node): str(rmux) for node, rmux in sites.free.items()},
+        {str(node): str(reg) for node, reg in sites.occupied.items()},
+    )
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_register_sites_follow_splices(make_design, sparse):
+    placement, routing, id_to_name, netlist = make_design(n=4, span=5)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, sparse)
+    sites = graph.get_register_sites()
+    free = len(sites.free)
+    assert free > 0 and len(sites.occupied) == 0
+
+    random.seed(3)
+    regs = []
+    for _ in range(5):
+        edge, paired_edge = random.choice(pipeline.find_exhaustive_sites(graph))
+        new_regs = graph.insert_register(edge, paired_edge=paired_edge)
+        for reg in new_regs:
+            assert not sites.is_free(graph.sources[graph.sources[reg][0]][0])
+        regs += new_regs
+        assert graph.get_register_sites() is sites
+        assert site_state(sites) == site_state(RegisterSiteIndex(graph))
+    assert len(sites.occupied) == len(regs)
+    assert len(sites.free) == free - len(regs)
+
+    random.shuffle(regs)
+    for reg in regs:
+        source, _ = graph.remove_register(reg)
+        assert sites.is_free(source)
+        assert site_state(sites) == site_state(RegisterSiteIndex(graph))
+    assert len(sites.free) == free and len(sites.occupied) == 0
+
+
+
+def test_nearest_free_site(make_design):
+    placement, routing, id_to_name, netlist = make_design(n=1, span=6, branch=False)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, False)
+    sites = graph.get_register_sites()
+    # I0 -> p1 -> I9, six hops each
+    path = [graph.tile_id_to_tile["I0"]]
+    while len(graph.sinks[path[-1]]) == 1:
+        path.append(graph.sinks[path[-1]][0])
+    delays = list(range(len(path)))
+    free = sites.free_sites(path)
+    assert len(free) == 12
+
+    target = delays[-1] / 2
+    nearest = sites.nearest_free_site(path, delays)
+    assert nearest == min(free, key=lambda idx: abs(delays[idx] - target))
+    assert sites.ranked_free_sites(path, delays, 2)[0] == nearest
+
+    graph.insert_register((path[nearest], path[nearest + 1]))
+    assert sites.count_free_sites(path) == 11
+    assert sites.nearest_free_site(path, delays) != nearest
@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+from archipelago import pipeline
+from archipelago.pnr_graph import construct_graph
+from archipelago.sta import sta, TimingState
+
+
+def timing_result(result):
+    freq, crit_path, _ = result
+    return freq, [(str(node), delay) for node, delay in crit_path]
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_incremental_sta_matches_full_sta(make_design, sparse):
+    placement, routing, id_to_name, netlist = make_design(n=6, span=7)
+    graph = construct_graph(placement, routing, id_to_name, netlist, 1, 0, 1, sparse)
+    timing = TimingState(graph, False)
+    assert timing_result(timing.sta(verbose=False)) == timing_result(
+        sta(graph, False)
+    )
+
+    random.seed(0)
+    inserted = []
+    for _ in range(8):
+        sites = pipeline.find_exhaustive_sites(graph)
+        if len(sites) == 0:
+            break
+        edge, paired_edge = random.choice(sites)
+        inserted.append(graph.insert_register(edge, paired_edge=paired_edge))
+        assert timing_result(timing.sta(verbose=False)) == timing_result(
+            sta(graph, False)
+        )
+    assert len(inserted) > 0
+
+    for regs in reversed(inserted):
+        for reg in reversed(regs):
+            graph.remove_register(reg)
+        assert timing_result(timing.sta(verbose=False)) == timing_result(
+            sta(graph, False)
+        )
@@ -0,0 +1,45 @@
+import subprocess
+
+import pytest
+
+from archipelago.watchdog import PnRToolError, Watchdog, classify, failure_kind
+
+
+@pytest.mark.parametrize(
+    "returncode, failure, kind",
+    [
+        (0, "crash", None),
+        (0, "unroutable", None),
+        (-6, "unroutable", "crash"),
+        (-9, "crash", "crash"),
+        (1, "unroutable", "unroutable"),
+        (1, "crash", "crash"),
+    ],
+)
+def test_classify(returncode, failure, kind):
+    assert classify(returncode, failure) == kind
+
+
+def test_failure_kind():
+    for kind in ["timeout", "unroutable", "crash"]:
+        error = PnRToolError(kind, 1, ["router"])
+        assert isinstance(error, subprocess.CalledProcessError)
+        assert failure_kind(error) == kind
+    assert failure_kind(subprocess.CalledProcessError(1, ["router"])) == "crash"
+    assert failure_kind(FileNotFoundError("router")) == "crash"
+
+
+def test_unroutable_verdict():
+    watchdog = Watchdog.make(None, None, "Failed to route", 2)
+    assert watchdog.watches_output
+    watchdog.launched()
+    watchdog.feed("Routing net 1\n")
+    watchdog.feed("Failed to route net 2\n")
+    assert watchdog.verdict() is None
+    watchdog.feed("Failed to route net 3\n")
+    assert watchdog.verdict() == "unroutable"
+
+
+def test_no_limits():
+    assert Watchdog.make(None, None) is None
+    assert Watchdog.for_placer({}) is None